@@ -1,18 +1,78 @@
-import json
-import time
+from itertools import chain
+from operator import itemgetter
 
+import click
 from api.config import app_config
-from api.helpers import get_median, get_quartiles
-from api.validators import validate_sensor_value
-from flask import Flask, request
+from api.helpers import (
+    decode_cursor,
+    encode_cursor,
+    get_histogram_summary,
+    get_median,
+    get_median_positions,
+    get_positional_summary,
+    get_summary_positions,
+    iter_ndjson,
+)
+from api.storage import Database
+from flask import Flask, Response, g, request, stream_with_context
 from flask.json import jsonify
-from flask_sqlalchemy import SQLAlchemy
 
-db = SQLAlchemy()
+db = Database()
+
+NDJSON = 'application/x-ndjson'
 
 
 def create_app(config_name=None):
+    from api.batch import BATCH_METRICS, batch_metrics
+    from api.cache import MetricCache, cached_metric
+    from api.conditional import conditional_get
+    from api.formats import load_reading, load_readings
+    from api.histograms import histogram_counts, uses_histograms
+    from api.ingest import (
+        WriteBehindBuffer,
+        build_reading,
+        build_readings,
+        insert_readings,
+    )
+    from api.metrics import (
+        CONTENT_TYPE,
+        Registry,
+        cache_gauges,
+        finish_response_metrics,
+        ingest_gauges,
+        record_request_metrics,
+        render,
+        start_request_metrics,
+    )
     from api.models import Reading
+    from api.partitions import (
+        compact_cold_partitions,
+        drop_expired_partitions,
+    )
+    from api.queries import (
+        aggregate_query,
+        extreme_readings_query,
+        page_readings,
+        readings_query,
+        summarize_devices,
+        summary_query,
+        values_at_positions,
+    )
+    from api.rollups import rollup_aggregates
+    from api.series import (
+        SERIES_AGGREGATES,
+        bucket_series,
+        lttb_series,
+    )
+    from api.shards import (
+        bind_request_shard,
+        fan_out,
+        rebalance_shards,
+        shard_bind,
+        use_shard,
+    )
+    from api.sketches import get_sketch_summary, merged_sketch, uses_sketches
+    from api.storage import shard_binds
 
     if config_name is None:
         config_name = 'development'
@@ -21,10 +81,64 @@ def create_app(config_name=None):
     app.config.from_object(app_config[config_name])
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     db.init_app(app)
+    app.extensions['ingest_buffer'] = WriteBehindBuffer(app)
+    app.extensions['metrics'] = Registry()
+    if app.config['METRIC_CACHE_SIZE']:
+        app.extensions['metric_cache'] = MetricCache(
+            app.config['METRIC_CACHE_SIZE'], app.config['METRIC_CACHE_TTL']
+        )
+
+    app.before_request(start_request_metrics)
+    app.before_request(bind_request_shard)
+    app.after_request(finish_response_metrics)
+    app.teardown_request(record_request_metrics)
+
+    @app.cli.command('rebalance-shards')
+    @click.option(
+        '--previous-count',
+        type=int,
+        required=True,
+        help='SHARD_COUNT the readings are currently sharded with',
+    )
+    def rebalance_shards_command(previous_count):
+        """
+        Move devices to their shard after SHARD_COUNT changed.
+        """
+
+        moved = rebalance_shards(previous_count)
+        click.echo(f'Moved {moved} devices')
+
+    @app.cli.command('drop-expired-partitions')
+    def drop_expired_partitions_command():
+        """
+        Drop the partitions older than RETENTION_SECONDS on every shard.
+        """
+
+        dropped = 0
+        for bind in shard_binds(app):
+            with use_shard(bind):
+                dropped += drop_expired_partitions()
+
+        click.echo(f'Dropped {dropped} partitions')
+
+    @app.cli.command('compact-cold-partitions')
+    def compact_cold_partitions_command():
+        """
+        Move the partitions older than COLD_AFTER_SECONDS to cold segment
+        files on every shard.
+        """
+
+        compacted = 0
+        for bind in shard_binds(app):
+            with use_shard(bind):
+                compacted += compact_cold_partitions()
+
+        click.echo(f'Compacted {compacted} partitions')
 
     @app.route(
         '/devices/<string:device_uuid>/readings', methods=['POST', 'GET']
     )
+    @conditional_get
     def request_device_readings(device_uuid):
         """
         This endpoint allows clients to POST or GET data specific sensor types.
@@ -35,39 +149,51 @@ def create_app(config_name=None):
         * date_created -> The epoch date of the sensor reading.
             If none provided, we set to now.
 
+        The reading is sent as JSON, msgpack (application/msgpack) or a
+        single binary record (application/x-sensor-readings).
+
+        When the write-behind buffer is enabled the reading is queued and
+        acknowledged with a 202 instead of being committed inline.
+
         Optional Query Parameters:
         * start -> The epoch start time for a sensor being created
         * end -> The epoch end time for a sensor being created
         * type -> The type of sensor value a client is looking for
+        * type_match -> Set to substring to match types containing the type
+            parameter instead of matching it exactly
+        * stream -> Set to 1 to stream the readings as newline delimited
+            JSON, also selected by an Accept: application/x-ndjson header
+        * limit -> The maximum number of readings per page. Pages are
+            returned as {'readings': [...], 'next': <cursor>}
+        * cursor -> The next cursor of the previous page
         """
 
         if request.method == 'POST':
             # Grab the post parameters
-            post_data = json.loads(request.data)
-            sensor_type = post_data.get('type')
-            value = post_data.get('value')
-            date_created = post_data.get('date_created', int(time.time()))
+            try:
+                post_data = load_reading(
+                    request.data,
+                    request.mimetype,
+                    app.config['BINARY_TYPE_CODES'],
+                )
+            except ValueError:
+                return 'Validation fields error', 400
+
+            reading = build_reading(device_uuid, post_data)
 
             # Field validation
-            if not all(
-                (
-                    sensor_type,
-                    value,
-                    date_created,
-                    validate_sensor_value(sensor_type, value),
-                )
-            ):
+            if reading is None:
                 return 'Validation fields error', 400
 
+            # Queue the reading for the background writer when enabled
+            if app.config['INGEST_BUFFER_ENABLED']:
+                if not app.extensions['ingest_buffer'].submit(reading):
+                    return 'Ingest queue is full', 503
+
+                return 'accepted', 202
+
             # Insert data into db
-            reading = Reading(
-                device_uuid=device_uuid,
-                type=sensor_type,
-                value=value,
-                date_created=date_created,
-            )
-            db.session.add(reading)
-            db.session.commit()
+            insert_readings([reading])
 
             # Return success
             return 'success', 201
@@ -76,17 +202,72 @@ def create_app(config_name=None):
             type = request.args.get('type')
             start = request.args.get('start')
             end = request.args.get('end')
-            readings = Reading.query
-            readings = readings.filter(Reading.device_uuid == device_uuid)
-
-            if type:
-                readings = readings.filter(Reading.type.like(f'%{type}%'))
+            substring = request.args.get('type_match') == 'substring'
+            limit = request.args.get('limit')
+            cursor = request.args.get('cursor')
+
+            # Page through the readings in (date_created, id) order
+            if limit or cursor:
+                try:
+                    limit = int(limit or app.config['PAGE_DEFAULT_LIMIT'])
+                except ValueError:
+                    return 'limit must be an integer', 400
+
+                if not 0 < limit <= app.config['PAGE_MAX_LIMIT']:
+                    return 'limit is out of range', 400
+
+                after = decode_cursor(cursor) if cursor else None
+                if cursor and after is None:
+                    return 'Invalid cursor', 400
+
+                readings = readings_query(
+                    device_uuid,
+                    type,
+                    start,
+                    end,
+                    substring,
+                    page=(after, limit + 1),
+                )
+                readings = page_readings(readings, after, limit + 1).all()
+                next_cursor = None
+                if len(readings) > limit:
+                    last = readings[limit - 1]
+                    next_cursor = encode_cursor(last.date_created, last.id)
+
+                result = {
+                    'readings': [
+                        {
+                            'device_uuid': reading.device_uuid,
+                            'type': reading.type,
+                            'value': reading.value,
+                            'date_created': reading.date_created,
+                        }
+                        for reading in readings[:limit]
+                    ],
+                    'next': next_cursor,
+                }
 
-            if start:
-                readings = readings.filter(Reading.date_created >= int(start))
+                return (
+                    jsonify(result),
+                    200,
+                )
 
-            if end:
-                readings = readings.filter(Reading.date_created <= int(end))
+            readings = readings_query(device_uuid, type, start, end, substring)
+
+            # Stream large results one JSON document per line
+            if wants_stream():
+                rows = readings.with_entities(
+                    Reading.device_uuid,
+                    Reading.type,
+                    Reading.value,
+                    Reading.date_created,
+                ).yield_per(app.config['STREAM_CHUNK_SIZE'])
+                chunks = iter_ndjson(rows, app.config['STREAM_CHUNK_SIZE'])
+                return Response(
+                    stream_with_context(chunks),
+                    200,
+                    mimetype=NDJSON,
+                )
 
             readings = readings.all()
             results = []
@@ -106,7 +287,103 @@ def create_app(config_name=None):
                 200,
             )
 
+    def wants_stream():
+        if request.args.get('stream') in ('1', 'true'):
+            return True
+
+        mimetypes = request.accept_mimetypes
+        return mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+
+    def ingest_batch(device_uuid=None):
+        try:
+            items = load_readings(
+                request.data,
+                request.mimetype,
+                app.config['BINARY_TYPE_CODES'],
+                multi_device=device_uuid is None,
+            )
+        except ValueError:
+            return 'An array of readings is required', 400
+
+        if not isinstance(items, list):
+            return 'An array of readings is required', 400
+
+        if len(items) > app.config['INGEST_BATCH_MAX_SIZE']:
+            return 'Too many readings in a single batch', 413
+
+        rows, errors = build_readings(items, device_uuid)
+        inserted = insert_readings(rows)
+        result = {'inserted': inserted, 'errors': errors}
+
+        return (
+            jsonify(result),
+            201 if inserted or not errors else 400,
+        )
+
+    @app.route(
+        '/devices/<string:device_uuid>/readings/batch', methods=['POST']
+    )
+    def request_device_readings_batch(device_uuid):
+        """
+        This endpoint allows clients to POST many readings for a device at
+        once. The readings are inserted in a single transaction and invalid
+        items are reported without rejecting the rest of the batch.
+
+        POST Body:
+        * A JSON or msgpack array of readings, each with the type, value
+            and optional date_created parameters of the single reading
+            endpoint, or a stream of binary records.
+        """
+
+        return ingest_batch(device_uuid)
+
+    @app.route('/devices/readings/batch', methods=['POST'])
+    def request_readings_batch():
+        """
+        This endpoint allows clients to POST readings for many devices at
+        once. The readings are inserted in a single transaction and invalid
+        items are reported without rejecting the rest of the batch.
+
+        POST Body:
+        * A JSON or msgpack array of readings, each with a device_uuid in
+            addition to the type, value and optional date_created parameters
+            of the single reading endpoint, or a sequence of binary device
+            sections.
+        """
+
+        return ingest_batch()
+
+    @app.route('/ingest/stats', methods=['GET'])
+    def request_ingest_stats():
+        """
+        This endpoint allows clients to GET the write-behind buffer counters:
+        queue depth, rows queued, rejected and flushed, and flush latency.
+        """
+
+        return (
+            jsonify(app.extensions['ingest_buffer'].stats()),
+            200,
+        )
+
+    @app.route('/metrics', methods=['GET'])
+    def request_metrics():
+        """
+        This endpoint allows clients to GET the request metrics and the
+        write-behind buffer counters in the Prometheus text format.
+        """
+
+        collected = app.extensions['metrics'].collect()
+        gauges = ingest_gauges(app.extensions['ingest_buffer'].stats())
+        if 'metric_cache' in app.extensions:
+            gauges += cache_gauges(app.extensions['metric_cache'].stats())
+
+        return Response(
+            render(collected, gauges), 200, content_type=CONTENT_TYPE
+        )
+
     @app.route('/devices/<string:device_uuid>/readings/max', methods=['GET'])
+    @conditional_get
+    @cached_metric
     def request_device_readings_max(device_uuid):
         """
         This endpoint allows clients to GET the max sensor reading for a device
@@ -117,6 +394,8 @@ def create_app(config_name=None):
         Optional Query Parameters
         * start -> The epoch start time for a sensor being created
         * end -> The epoch end time for a sensor being created
+        * type_match -> Set to substring to match types containing the type
+            parameter instead of matching it exactly
         """
 
         type = request.args.get('type')
@@ -125,27 +404,18 @@ def create_app(config_name=None):
 
         start = request.args.get('start')
         end = request.args.get('end')
-        max_value = (
-            db.session.query(db.func.max(Reading.value))
-            .filter(
-                Reading.device_uuid == device_uuid,
-                Reading.type.like(f'%{type}%'),
-            )
-            .scalar()
+        substring = request.args.get('type_match') == 'substring'
+        readings = extreme_readings_query(
+            device_uuid, type, start, end, substring
         )
-
-        readings = Reading.query
-        readings = readings.filter(Reading.value == max_value)
-        if start:
-            readings = readings.filter(Reading.date_created >= int(start))
-
-        if end:
-            readings = readings.filter(Reading.date_created <= int(end))
-
-        readings = readings.all()
         results = []
 
-        for reading in readings:
+        # Walk down from the highest value until it changes, so only the
+        # readings tied for the max are fetched
+        for reading in readings.yield_per(100):
+            if results and reading.value != results[0]['value']:
+                break
+
             obj = {
                 'device_uuid': reading.device_uuid,
                 'type': reading.type,
@@ -160,9 +430,89 @@ def create_app(config_name=None):
             200,
         )
 
+    def extreme_readings(device_uuid, descending):
+        type = request.args.get('type')
+        if not type:
+            return 'A type query parameter is required', 400
+
+        try:
+            k = int(request.args.get('k', app.config['TOP_K_DEFAULT']))
+        except ValueError:
+            return 'k must be an integer', 400
+
+        if not 0 < k <= app.config['TOP_K_MAX']:
+            return 'k is out of range', 400
+
+        start = request.args.get('start')
+        end = request.args.get('end')
+        substring = request.args.get('type_match') == 'substring'
+        readings = extreme_readings_query(
+            device_uuid, type, start, end, substring, descending, k
+        )
+
+        results = [
+            {
+                'device_uuid': reading.device_uuid,
+                'type': reading.type,
+                'value': reading.value,
+                'date_created': reading.date_created,
+            }
+            for reading in readings
+        ]
+
+        # Return the JSON
+        return (
+            jsonify(results),
+            200,
+        )
+
+    @app.route('/devices/<string:device_uuid>/readings/top', methods=['GET'])
+    @conditional_get
+    def request_device_readings_top(device_uuid):
+        """
+        This endpoint allows clients to GET the k highest sensor readings for
+        a device, highest first.
+
+        Mandatory Query Parameters:
+        * type -> The type of sensor value a client is looking for
+
+        Optional Query Parameters
+        * k -> The number of readings to return, 10 by default
+        * start -> The epoch start time for a sensor being created
+        * end -> The epoch end time for a sensor being created
+        * type_match -> Set to substring to match types containing the type
+            parameter instead of matching it exactly
+        """
+
+        return extreme_readings(device_uuid, descending=True)
+
+    @app.route(
+        '/devices/<string:device_uuid>/readings/bottom', methods=['GET']
+    )
+    @conditional_get
+    def request_device_readings_bottom(device_uuid):
+        """
+        This endpoint allows clients to GET the k lowest sensor readings for
+        a device, lowest first.
+
+        Mandatory Query Parameters:
+        * type -> The type of sensor value a client is looking for
+
+        Optional Query Parameters
+        * k -> The number of readings to return, 10 by default
+        * start -> The epoch start time for a sensor being created
+        * end -> The epoch end time for a sensor being created
+        * type_match -> Set to substring to match types containing the type
+            parameter instead of matching it exactly
+        """
+
+        return extreme_readings(device_uuid, descending=False)
+
     @app.route(
         '/devices/<string:device_uuid>/readings/median', methods=['GET']
     )
+    @conditional_get
+    @cached_metric
     def request_device_readings_median(device_uuid):
         """
         This endpoint allows clients to GET the median sensor reading for a
@@ -174,6 +524,10 @@ def create_app(config_name=None):
         Optional Query Parameters
         * start -> The epoch start time for a sensor being created
         * end -> The epoch end time for a sensor being created
+        * type_match -> Set to substring to match types containing the type
+            parameter instead of matching it exactly
+        * approx -> Set to true to estimate the value from quantile sketches
+            for types other than temperature and humidity
         """
 
         type = request.args.get('type')
@@ -182,19 +536,28 @@ def create_app(config_name=None):
 
         start = request.args.get('start')
         end = request.args.get('end')
-        readings = Reading.query.filter(
-            Reading.device_uuid == device_uuid, Reading.type.like(f'%{type}%'),
-        )
-
-        if start:
-            readings = readings.filter(Reading.date_created >= int(start))
-
-        if end:
-            readings = readings.filter(Reading.date_created <= int(end))
+        substring = request.args.get('type_match') == 'substring'
+        approx = request.args.get('approx') == 'true'
+        readings = readings_query(device_uuid, type, start, end, substring)
+
+        if uses_histograms(type, substring):
+            counts = histogram_counts(type, start, end, device_uuid)
+            median = get_histogram_summary(counts.get(device_uuid, []))[3]
+            readings = readings.filter(Reading.value == median).all()
+        elif approx and uses_sketches(type, substring):
+            sketch = merged_sketch(device_uuid, type, start, end)
+            median = get_sketch_summary(sketch)[0]
+            readings = readings.filter(Reading.value == median).all()
+        else:
+            # Select the middle values in the database
+            count = aggregate_query(
+                db.func.count, device_uuid, type, start, end, substring
+            ).scalar()
+            positions = get_median_positions(0, count)
+            picked = values_at_positions(readings, positions)
+            median = get_median([picked[p] for p in positions])
+            readings = readings.filter(Reading.value == median).all()
 
-        readings = readings.all()
-        values = [reading.value for reading in readings]
-        median = get_median(values)
         results = [
             {
                 'device_uuid': reading.device_uuid,
@@ -213,6 +576,8 @@ def create_app(config_name=None):
         )
 
     @app.route('/devices/<string:device_uuid>/readings/mean', methods=['GET'])
+    @conditional_get
+    @cached_metric
     def request_device_readings_mean(device_uuid):
         """
         This endpoint allows clients to GET the mean sensor readings for a
@@ -224,6 +589,8 @@ def create_app(config_name=None):
         Optional Query Parameters
         * start -> The epoch start time for a sensor being created
         * end -> The epoch end time for a sensor being created
+        * type_match -> Set to substring to match types containing the type
+            parameter instead of matching it exactly
         """
 
         type = request.args.get('type')
@@ -232,17 +599,14 @@ def create_app(config_name=None):
 
         start = request.args.get('start')
         end = request.args.get('end')
-        readings = db.session.query(db.func.avg(Reading.value)).filter(
-            Reading.device_uuid == device_uuid, Reading.type.like(f'%{type}%'),
-        )
-
-        if start:
-            readings = readings.filter(Reading.date_created >= int(start))
-
-        if end:
-            readings = readings.filter(Reading.date_created <= int(end))
-
-        mean_value = readings.scalar()
+        substring = request.args.get('type_match') == 'substring'
+        if substring:
+            mean_value = aggregate_query(
+                db.func.avg, device_uuid, type, start, end, substring
+            ).scalar()
+        else:
+            count, total = rollup_aggregates(device_uuid, type, start, end)[:2]
+            mean_value = total / count if count else None
         result = {'value': mean_value}
 
         return (
@@ -253,6 +617,8 @@ def create_app(config_name=None):
     @app.route(
         '/devices/<string:device_uuid>/readings/quartiles', methods=['GET']
     )
+    @conditional_get
+    @cached_metric
     def request_device_readings_quartiles(device_uuid):
         """
         This endpoint allows clients to GET the 1st and 3rd quartile
@@ -262,6 +628,12 @@ def create_app(config_name=None):
         * type -> The type of sensor value a client is looking for
         * start -> The epoch start time for a sensor being created
         * end -> The epoch end time for a sensor being created
+
+        Optional Query Parameters
+        * type_match -> Set to substring to match types containing the type
+            parameter instead of matching it exactly
+        * approx -> Set to true to estimate the value from quantile sketches
+            for types other than temperature and humidity
         """
 
         type = request.args.get('type')
@@ -270,16 +642,23 @@ def create_app(config_name=None):
         if not all((type, start, end,)):
             return 'type, start and end query parameters are required', 400
 
-        readings = Reading.query.filter(
-            Reading.device_uuid == device_uuid,
-            Reading.type.like(f'%{type}%'),
-            Reading.date_created >= int(start),
-            Reading.date_created <= int(end),
-        )
-
-        readings = readings.all()
-        values = [reading.value for reading in readings]
-        quartiles = get_quartiles(values)
+        substring = request.args.get('type_match') == 'substring'
+        approx = request.args.get('approx') == 'true'
+        if uses_histograms(type, substring):
+            counts = histogram_counts(type, start, end, device_uuid)
+            quartiles = get_histogram_summary(counts.get(device_uuid, []))[4]
+        elif approx and uses_sketches(type, substring):
+            sketch = merged_sketch(device_uuid, type, start, end)
+            quartiles = get_sketch_summary(sketch)[1]
+        else:
+            # Select the values around each quartile in the database
+            count = aggregate_query(
+                db.func.count, device_uuid, type, start, end, substring
+            ).scalar()
+            readings = readings_query(device_uuid, type, start, end, substring)
+            positions = chain.from_iterable(get_summary_positions(count))
+            picked = values_at_positions(readings, positions)
+            quartiles = get_positional_summary(picked, count)[1]
 
         result = {'quartile_1': quartiles[0], 'quartile_3': quartiles[1]}
 
@@ -288,6 +667,79 @@ def create_app(config_name=None):
             200,
         )
 
+    @app.route(
+        '/devices/<string:device_uuid>/readings/series', methods=['GET']
+    )
+    @conditional_get
+    @cached_metric
+    def request_device_readings_series(device_uuid):
+        """
+        This endpoint allows clients to GET a device's readings downsampled
+        for charts, either aggregated per bucket of interval seconds, one
+        point per bucket with readings, or picked by Largest-Triangle-Three-
+        Buckets to at most points readings.
+
+        Mandatory Query Parameters:
+        * type -> The type of sensor value a client is looking for
+        * interval -> The width of the buckets in seconds, or
+        * points -> The number of readings to keep
+
+        Optional Query Parameters
+        * agg -> A comma separated list of count, sum, mean, min and max
+            to compute per bucket, mean by default
+        * start -> The epoch start time for a sensor being created
+        * end -> The epoch end time for a sensor being created
+        * type_match -> Set to substring to match types containing the type
+            parameter instead of matching it exactly
+        """
+
+        type = request.args.get('type')
+        if not type:
+            return 'A type query parameter is required', 400
+
+        interval = request.args.get('interval', type=int)
+        points = request.args.get('points', type=int)
+        if (interval is None) == (points is None):
+            return 'Either an interval or points is required', 400
+
+        start = request.args.get('start')
+        end = request.args.get('end')
+        substring = request.args.get('type_match') == 'substring'
+
+        if points is not None:
+            if not 3 <= points <= app.config['SERIES_MAX_POINTS']:
+                return 'points is out of range', 400
+
+            results = [
+                {'date_created': date_created, 'value': value}
+                for date_created, value in lttb_series(
+                    device_uuid, type, points, start, end, substring
+                )
+            ]
+        else:
+            aggregates = request.args.get('agg', 'mean').split(',')
+            if interval <= 0:
+                return 'interval must be positive', 400
+
+            if not set(aggregates) <= set(SERIES_AGGREGATES):
+                return 'agg must be count, sum, mean, min or max', 400
+
+            results = []
+            for bucket, *summary in bucket_series(
+                device_uuid, type, interval, start, end, substring
+            ):
+                obj = {'date_created': bucket}
+                for aggregate in aggregates:
+                    obj[aggregate] = SERIES_AGGREGATES[aggregate](*summary)
+
+                results.append(obj)
+
+        # Return the JSON
+        return (
+            jsonify(results),
+            200,
+        )
+
     @app.route('/devices/readings', methods=['GET'])
     def request_readings_summary():
         """
@@ -296,6 +748,8 @@ def create_app(config_name=None):
 
         Optional Query Parameters
         * type -> The type of sensor value a client is looking for
+        * type_match -> Set to substring to match types containing the type
+            parameter instead of matching it exactly
         * start -> The epoch start time for a sensor being created
         * end -> The epoch end time for a sensor being created
         """
@@ -303,48 +757,137 @@ def create_app(config_name=None):
         type = request.args.get('type')
         start = request.args.get('start')
         end = request.args.get('end')
+        substring = request.args.get('type_match') == 'substring'
+
+        def summarize_shard():
+            if uses_histograms(type, substring):
+                # Restricted types are summarized from the value histograms
+                counts = histogram_counts(type, start, end)
+                summaries = (
+                    (device_uuid,) + get_histogram_summary(values)
+                    for device_uuid, values in counts.items()
+                )
+            else:
+                summaries = summarize_devices(
+                    summary_query(type, start, end, substring)
+                )
 
-        readings = db.session.query(
-            Reading.device_uuid.label('device_uuid'),
-            db.func.max(Reading.value).label('max_reading_value'),
-            db.func.avg(Reading.value).label('mean_reading_value'),
-            db.func.count(Reading.id).label('number_of_readings'),
-        )
+            results = []
+            for (
+                device_uuid,
+                number_of_readings,
+                max_value,
+                mean,
+                median,
+                quartiles,
+            ) in summaries:
+                obj = {
+                    'device_uuid': device_uuid,
+                    'number_of_readings': number_of_readings,
+                    'max_reading_value': max_value,
+                    'median_reading_value': median,
+                    'mean_reading_value': mean,
+                    'quartile_1_value': str(quartiles[0]),
+                    'quartile_3_value': str(quartiles[1]),
+                }
+                results.append(obj)
 
-        if type:
-            readings = readings.filter(Reading.type.like(f'%{type}%'))
+            return results
 
-        if start:
-            readings = readings.filter(Reading.date_created >= int(start))
+        # Every device lives in a single shard, so the shards' summaries
+        # are merged by concatenating them
+        results = list(chain.from_iterable(fan_out(summarize_shard)))
 
-        if end:
-            readings = readings.filter(Reading.date_created <= int(end))
+        # Most active devices first
+        results.sort(key=itemgetter('number_of_readings'), reverse=True)
 
-        readings = readings.group_by(Reading.device_uuid).all()
-        results = []
+        # Return the JSON
+        return (
+            jsonify(results),
+            200,
+        )
 
-        for reading in readings:
-            # Get readings per UUID
-            readings_per_uuid = Reading.query.filter(
-                Reading.device_uuid == reading.device_uuid
-            ).all()
+    @app.route('/devices/readings/metrics', methods=['GET', 'POST'])
+    def request_readings_metrics():
+        """
+        This endpoint allows clients to GET the metrics of many devices at
+        once, keyed by device_uuid, in a handful of queries instead of a
+        request per device and metric. Parameters are sent in the query
+        string, or POSTed as a JSON object with devices and metrics given as
+        arrays when the list of devices is too long for a URL.
 
-            values = [reading.value for reading in readings_per_uuid]
-            median = get_median(values)
-            quartiles = get_quartiles(values)
+        Mandatory Query Parameters:
+        * devices -> A comma separated list of device_uuids
+        * type -> The type of sensor value a client is looking for
 
-            obj = {
-                'device_uuid': reading.device_uuid,
-                'number_of_readings': reading.number_of_readings,
-                'max_reading_value': reading.max_reading_value,
-                'median_reading_value': median,
-                'mean_reading_value': reading.mean_reading_value,
-                'quartile_1_value': str(quartiles[0]),
-                'quartile_3_value': str(quartiles[1]),
-            }
-            results.append(obj)
+        Optional Query Parameters
+        * metrics -> A comma separated list of max, mean, median and
+            quartiles, all of them by default
+        * start -> The epoch start time for a sensor being created
+        * end -> The epoch end time for a sensor being created
+        * type_match -> Set to substring to match types containing the type
+            parameter instead of matching it exactly
+        """
+
+        if request.method == 'POST':
+            params = request.get_json(force=True, silent=True)
+            if not isinstance(params, dict):
+                return 'A JSON object of parameters is required', 400
+
+            devices = params.get('devices') or []
+            metrics = params.get('metrics') or list(BATCH_METRICS)
+            if not isinstance(devices, list) or not isinstance(metrics, list):
+                return 'devices and metrics must be arrays', 400
+
+            # Computing the metrics writes nothing, so they are read
+            # through the read-only connections as a GET would be
+            g.read_only = True
+        else:
+            params = request.args
+            devices = params.get('devices', '').split(',')
+            metrics = params.get('metrics', ','.join(BATCH_METRICS))
+            metrics = metrics.split(',')
+
+        type = params.get('type')
+        devices = [device_uuid for device_uuid in devices if device_uuid]
+        if not type or not devices:
+            return 'devices and type parameters are required', 400
+
+        if not all(isinstance(item, str) for item in devices + metrics):
+            return 'devices and metrics must be strings', 400
+
+        if not set(metrics) <= set(BATCH_METRICS):
+            return 'metrics must be max, mean, median or quartiles', 400
+
+        if len(devices) > app.config['BATCH_METRICS_MAX_DEVICES']:
+            return 'Too many devices in a single request', 413
+
+        start = params.get('start')
+        end = params.get('end')
+        substring = params.get('type_match') == 'substring'
+        devices = list(dict.fromkeys(devices))
+        by_shard = {}
+        for device_uuid in devices:
+            by_shard.setdefault(shard_bind(device_uuid), []).append(
+                device_uuid
+            )
+
+        def measure_shard():
+            return batch_metrics(
+                by_shard.get(g.get('shard'), []),
+                type,
+                metrics,
+                start,
+                end,
+                substring,
+            )
+
+        # Every device lives in a single shard, so the shards' metrics are
+        # merged by updating a single map
+        results = {}
+        for shard_results in fan_out(measure_shard):
+            results.update(shard_results)
 
-        # Return the JSON
         return (
             jsonify(results),
             200,
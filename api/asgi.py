@@ -0,0 +1,344 @@
+import asyncio
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from api import create_app, db
+from api.formats import load_reading, load_readings
+from api.ingest import build_reading, build_readings, insert_readings
+from api.shards import group_by_shard
+
+# /devices/<uuid>/readings, /devices/<uuid>/readings/batch and
+# /devices/readings/batch
+_ROUTE = re.compile(
+    r'^/devices/(?:(?P<device_uuid>[^/]+)/)?readings(?P<batch>/batch)?$'
+)
+
+_STOP = object()
+
+
+class IngestService:
+    """
+    asyncio ingest entry point for the reading POST routes, served by any
+    ASGI server next to the Flask app that keeps serving reads.
+
+    Requests only validate their readings and queue them, so a waiting
+    connection costs a coroutine instead of a worker thread. A single
+    writer task takes everything queued, up to INGEST_FLUSH_MAX_ROWS rows,
+    and commits it with insert_readings on a dedicated thread, while the
+    next group accumulates. Requests are answered once their group is
+    committed. When INGEST_QUEUE_MAX_SIZE rows are already waiting they
+    are turned away with a 503, and bodies larger than INGEST_BODY_MAX_SIZE
+    with a 413. A group whose commit fails is retried one request at a
+    time, so only the requests holding a bad row fail.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._queue = None
+        self._writer = None
+        self._executor = ThreadPoolExecutor(1, 'ingest-writer')
+        self._stopping = False
+        self._pending = 0
+        self._counters = {
+            'rows_queued': 0,
+            'rows_rejected': 0,
+            'rows_flushed': 0,
+            'rows_failed': 0,
+            'flushes': 0,
+            'flush_errors': 0,
+            'flush_latency_total': 0.0,
+            'flush_latency_max': 0.0,
+            'flush_latency_last': 0.0,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+
+        if scope['type'] != 'http':
+            return
+
+        status, content_type, body = await self._handle(scope, receive)
+        await send(
+            {
+                'type': 'http.response.start',
+                'status': status,
+                'headers': [
+                    (b'content-type', content_type),
+                    (b'content-length', str(len(body)).encode()),
+                ],
+            }
+        )
+        await send({'type': 'http.response.body', 'body': body})
+
+    def start(self):
+        if self._writer is None:
+            self._queue = asyncio.Queue()
+            self._writer = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """
+        Stop accepting readings and commit everything still queued.
+        """
+
+        if self._writer is None or self._stopping:
+            return
+
+        self._stopping = True
+        self._queue.put_nowait(_STOP)
+        await self._writer
+        self._executor.shutdown()
+
+    def submit(self, rows):
+        """
+        Queue validated rows for the writer. Returns a future resolved once
+        they are committed, or None when the queue is full or the service
+        is stopping.
+        """
+
+        self.start()
+        max_size = self.app.config['INGEST_QUEUE_MAX_SIZE']
+        if self._stopping or self._pending + len(rows) > max_size:
+            self._counters['rows_rejected'] += len(rows)
+            return None
+
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((rows, future))
+        self._pending += len(rows)
+        self._counters['rows_queued'] += len(rows)
+        return future
+
+    def stats(self):
+        stats = dict(self._counters)
+        stats['queue_depth'] = self._pending
+        return stats
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _handle(self, scope, receive):
+        path = scope['path']
+        method = scope['method']
+
+        if path == '/ingest/stats' and method == 'GET':
+            return _json(self.stats(), 200)
+
+        match = _ROUTE.match(path)
+        device_uuid = match and match.group('device_uuid')
+        batch = match and match.group('batch')
+        if not match or (device_uuid is None and not batch):
+            return _text('Not Found', 404)
+
+        if method != 'POST':
+            return _text('Method Not Allowed', 405)
+
+        body = await _read_body(
+            receive, self.app.config['INGEST_BODY_MAX_SIZE']
+        )
+        if body is None:
+            return _text('Request body is too large', 413)
+
+        mimetype = _mimetype(scope)
+        type_codes = self.app.config['BINARY_TYPE_CODES']
+
+        if not batch:
+            try:
+                data = load_reading(body, mimetype, type_codes)
+            except ValueError:
+                data = None
+
+            reading = build_reading(device_uuid, data)
+            if reading is None:
+                return _text('Validation fields error', 400)
+
+            rows, errors = [reading], []
+        else:
+            try:
+                data = load_readings(
+                    body, mimetype, type_codes, device_uuid is None
+                )
+            except ValueError:
+                data = None
+
+            if not isinstance(data, list):
+                return _text('An array of readings is required', 400)
+
+            if len(data) > self.app.config['INGEST_BATCH_MAX_SIZE']:
+                return _text('Too many readings in a single batch', 413)
+
+            rows, errors = build_readings(data, device_uuid)
+
+        if rows:
+            future = self.submit(rows)
+            if future is None:
+                return _text('Ingest queue is full', 503)
+
+            try:
+                await future
+            except Exception:
+                return _text('Failed to store readings', 500)
+
+        if not batch:
+            return _text('success', 201)
+
+        result = {'inserted': len(rows), 'errors': errors}
+        return _json(result, 201 if rows or not errors else 400)
+
+    async def _run(self):
+        max_rows = self.app.config['INGEST_FLUSH_MAX_ROWS']
+        stopped = False
+
+        while not stopped:
+            item = await self._queue.get()
+            group = []
+            count = 0
+            while True:
+                if item is _STOP:
+                    stopped = True
+                    break
+
+                group.append(item)
+                count += len(item[0])
+                if count >= max_rows or self._queue.empty():
+                    break
+
+                item = self._queue.get_nowait()
+
+            if group:
+                await self._flush(group)
+
+    async def _flush(self, group):
+        requests = [rows for rows, _ in group]
+        count = sum(len(rows) for rows in requests)
+        loop = asyncio.get_event_loop()
+        started = time.monotonic()
+        try:
+            errors = await loop.run_in_executor(
+                self._executor, self._insert, requests
+            )
+        except Exception as error:
+            self.app.logger.exception('Failed to flush %d readings', count)
+            errors = [error] * len(requests)
+        finally:
+            self._pending -= count
+
+        failed = sum(
+            len(rows) for rows, error in zip(requests, errors) if error
+        )
+        latency = time.monotonic() - started
+        self._counters['flushes'] += 1
+        self._counters['rows_flushed'] += count - failed
+        self._counters['rows_failed'] += failed
+        self._counters['flush_errors'] += 1 if failed else 0
+        self._counters['flush_latency_total'] += latency
+        self._counters['flush_latency_last'] = latency
+        self._counters['flush_latency_max'] = max(
+            self._counters['flush_latency_max'], latency
+        )
+        for (_, future), error in zip(group, errors):
+            if future.done():
+                continue
+
+            if error is None:
+                future.set_result(count)
+            else:
+                future.set_exception(error)
+
+    def _insert(self, requests):
+        """
+        Insert the rows of a group of requests, with a group commit per
+        shard, and return the error of each request, None once committed.
+        """
+
+        errors = [None] * len(requests)
+        with self.app.app_context():
+            shards = {}
+            for index, rows in enumerate(requests):
+                for bind, shard_rows in group_by_shard(rows).items():
+                    shards.setdefault(bind, []).append((index, shard_rows))
+
+            # Each shard commits on its own, so only the requests of a
+            # failed commit are retried
+            for parts in shards.values():
+                for index, error in self._insert_parts(parts):
+                    errors[index] = error
+
+        return errors
+
+    def _insert_parts(self, parts):
+        """
+        Insert the (index, rows) parts of requests in a single group commit,
+        retrying them one request at a time when it fails. Returns the
+        (index, error) of the requests that could not be inserted.
+        """
+
+        try:
+            insert_readings([row for _, rows in parts for row in rows])
+            return []
+
+        except Exception as error:
+            db.session.rollback()
+            if len(parts) == 1:
+                self.app.logger.exception(
+                    'Failed to store %d readings', len(parts[0][1])
+                )
+                return [(parts[0][0], error)]
+
+        self.app.logger.warning(
+            'Failed to flush %d requests, retrying them one at a time',
+            len(parts),
+        )
+        return [
+            failure for part in parts for failure in self._insert_parts([part])
+        ]
+
+
+async def _read_body(receive, max_size):
+    # The body of the request, or None once it grows past max_size bytes
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] != 'http.request':
+            break
+
+        chunks.append(message.get('body', b''))
+        size += len(chunks[-1])
+        if size > max_size:
+            return None
+
+        if not message.get('more_body'):
+            break
+
+    return b''.join(chunks)
+
+
+def _mimetype(scope):
+    for name, value in scope.get('headers', ()):
+        if name == b'content-type':
+            return value.decode('latin-1').split(';')[0].strip().lower()
+
+    return None
+
+
+def _text(body, status):
+    return status, b'text/html; charset=utf-8', body.encode()
+
+
+def _json(data, status):
+    return status, b'application/json', json.dumps(data).encode()
+
+
+def create_ingest_app(config_name=None):
+    return IngestService(create_app(config_name))
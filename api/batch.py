@@ -0,0 +1,91 @@
+from api.helpers import get_histogram_summary
+from api.histograms import histogram_counts, uses_histograms
+from api.models import Reading
+from api.queries import summarize_devices, summary_query
+from api.rollups import rollup_aggregates_by_device
+
+# Metrics the batch route computes, and the fields each one returns
+BATCH_METRICS = {
+    'max': ('max',),
+    'mean': ('mean',),
+    'median': ('median',),
+    'quartiles': ('quartile_1', 'quartile_3'),
+}
+
+# Devices per IN list, below SQLite's limit of bound parameters
+BATCH_CHUNK_SIZE = 500
+
+
+def batch_metrics(
+    device_uuids, sensor_type, metrics, start=None, end=None, substring=False
+):
+    """
+    Compute the metrics of the readings of a type over the inclusive
+    [start, end] range of many devices at once, returning a map of each
+    device_uuid to its number_of_readings and the fields of the metrics.
+    Devices without readings have a count of 0 and null fields.
+
+    The statements run per chunk of devices rather than per device. The
+    max and mean alone are read from the rollups, and the median and
+    quartiles from the histograms of restricted types or from a single
+    pass over the values ordered by device.
+    """
+
+    results = {}
+    for offset in range(0, len(device_uuids), BATCH_CHUNK_SIZE):
+        chunk = device_uuids[offset : offset + BATCH_CHUNK_SIZE]
+        summaries = _summarize_chunk(
+            chunk, sensor_type, metrics, start, end, substring
+        )
+        for device_uuid in chunk:
+            summary = summaries.get(device_uuid, (0, None, None, None, None))
+            results[device_uuid] = _fields(summary, metrics)
+
+    return results
+
+
+def _summarize_chunk(
+    device_uuids, sensor_type, metrics, start, end, substring
+):
+    # Map each device with readings to (count, max, mean, median,
+    # quartiles), leaving the fields of unrequested metrics as None
+    if not substring and not {'median', 'quartiles'} & set(metrics):
+        aggregates = rollup_aggregates_by_device(
+            device_uuids, sensor_type, start, end
+        )
+        return {
+            device_uuid: (count, maximum, total / count, None, None)
+            for device_uuid, (count, total, _, maximum) in aggregates.items()
+        }
+
+    if uses_histograms(sensor_type, substring):
+        counts = histogram_counts(
+            sensor_type, start, end, device_uuids=device_uuids
+        )
+        return {
+            device_uuid: get_histogram_summary(values)
+            for device_uuid, values in counts.items()
+        }
+
+    query = summary_query(sensor_type, start, end, substring).filter(
+        Reading.device_uuid.in_(device_uuids)
+    )
+    return {summary[0]: summary[1:] for summary in summarize_devices(query)}
+
+
+def _fields(summary, metrics):
+    count, maximum, mean, median, quartiles = summary
+    values = {
+        'max': maximum,
+        'mean': mean,
+        'median': median,
+        'quartile_1': quartiles[0] if quartiles else None,
+        'quartile_3': quartiles[1] if quartiles else None,
+    }
+
+    fields = {'number_of_readings': count}
+    for metric in metrics:
+        for field in BATCH_METRICS[metric]:
+            fields[field] = values[field]
+
+    return fields
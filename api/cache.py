@@ -0,0 +1,233 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from api.conditional import request_mark
+from flask import current_app, g, request
+
+# Devices hash onto this many version counters, which bounds their memory
+# whatever the size of the fleet. Devices sharing a counter only skip
+# caching values computed while another of them is being ingested.
+VERSION_STRIPES = 4096
+
+
+class MetricCache:
+    """
+    In-process LRU cache of metric responses by route, device and query
+    string, bounded to max_size entries.
+
+    Each entry remembers the device, type and date range it covers, and is
+    dropped as soon as a reading of that device and type is ingested inside
+    the range. Entries also carry the version of the reading marks of
+    their device and type they expect, which readings ingested outside the
+    range advance, and are only served while the marks still have that
+    version. Readings changed by anything else, such as other processes,
+    dropped partitions or rebalanced shards, change the marks so cached
+    values are never stale. Windows still open at the time they were
+    computed also expire after ttl seconds. Closed windows are only
+    recomputed when a late reading lands inside them, their marks change
+    behind the cache's back or they are evicted.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._devices = {}
+        self._versions = [0] * VERSION_STRIPES
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0,
+        }
+
+    def get(self, key, mark):
+        """
+        Return the cached value of key, or None when it is missing, expired
+        or expects another version of the reading marks than mark.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] < time.monotonic():
+                self._remove(key)
+                self._counters['expirations'] += 1
+                entry = None
+
+            if entry is not None and entry[3] != mark:
+                self._remove(key)
+                self._counters['invalidations'] += 1
+                entry = None
+
+            if entry is None:
+                self._counters['misses'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return entry[0]
+
+    def version(self, device_uuid):
+        """
+        Return the version of a device's cached entries, to be passed back
+        to put. Ingest bumps it, so a value computed while a reading was
+        being ingested is not cached.
+        """
+
+        with self._lock:
+            return self._versions[hash(device_uuid) % VERSION_STRIPES]
+
+    def put(self, key, value, window, version, mark):
+        device_uuid, sensor_type, substring, start, end = window
+        now = time.time()
+        if end is None or end >= now:
+            expires = time.monotonic() + self.ttl
+        else:
+            expires = float('inf')
+
+        with self._lock:
+            if self._versions[hash(device_uuid) % VERSION_STRIPES] != version:
+                return
+
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = [value, window, expires, mark]
+            self._devices.setdefault(device_uuid, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self._counters['evictions'] += 1
+
+    def invalidate(self, rows):
+        """
+        Drop the entries whose window holds any of the rows, and advance
+        the marks the other entries of their types expect, since each
+        inserted row bumps the version of its device and type.
+        """
+
+        with self._lock:
+            for row in rows:
+                device_uuid = row['device_uuid']
+                self._versions[hash(device_uuid) % VERSION_STRIPES] += 1
+                for key in list(self._devices.get(device_uuid, ())):
+                    entry = self._entries[key]
+                    if not _matches(entry[1], row):
+                        continue
+
+                    if _in_range(entry[1], row):
+                        self._remove(key)
+                        self._counters['invalidations'] += 1
+                    else:
+                        entry[3] += 1
+
+    def invalidate_range(self, start, end):
+        """
+        Drop the entries of every device whose window overlaps the
+        inclusive [start, end] range.
+        """
+
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                window_start, window_end = entry[1][3:]
+                if (window_start is None or window_start <= end) and (
+                    window_end is None or window_end >= start
+                ):
+                    self._remove(key)
+                    self._counters['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['size'] = len(self._entries)
+
+        return stats
+
+    def _remove(self, key):
+        window = self._entries.pop(key)[1]
+        keys = self._devices[window[0]]
+        keys.discard(key)
+        if not keys:
+            del self._devices[window[0]]
+
+
+def _matches(window, row):
+    device_uuid, sensor_type, substring, start, end = window
+    if not sensor_type:
+        return True
+
+    if substring:
+        return sensor_type in row['type']
+
+    return row['type'] == sensor_type
+
+
+def _in_range(window, row):
+    device_uuid, sensor_type, substring, start, end = window
+    if start is not None and row['date_created'] < start:
+        return False
+
+    return end is None or row['date_created'] <= end
+
+
+def invalidate_readings(rows):
+    cache = current_app.extensions.get('metric_cache')
+    if cache is not None:
+        cache.invalidate(rows)
+
+
+def invalidate_range(start, end):
+    cache = current_app.extensions.get('metric_cache')
+    if cache is not None:
+        cache.invalidate_range(start, end)
+
+
+def cached_metric(view):
+    """
+    Serve a metric route of a device from the metric cache, caching its
+    successful responses.
+    """
+
+    @wraps(view)
+    def cached_view(device_uuid):
+        cache = current_app.extensions.get('metric_cache')
+        if cache is None:
+            return view(device_uuid)
+
+        try:
+            start = request.args.get('start')
+            end = request.args.get('end')
+            window = (
+                device_uuid,
+                request.args.get('type'),
+                request.args.get('type_match') == 'substring',
+                int(start) if start else None,
+                int(end) if end else None,
+            )
+        except ValueError:
+            return view(device_uuid)
+
+        key = (
+            g.get('shard'),
+            request.endpoint,
+            device_uuid,
+            tuple(sorted(request.args.items(multi=True))),
+        )
+        mark = request_mark(device_uuid)[0]
+        body = cache.get(key, mark)
+        if body is not None:
+            return current_app.response_class(
+                body, mimetype='application/json'
+            )
+
+        version = cache.version(device_uuid)
+        response = current_app.make_response(view(device_uuid))
+        if response.status_code == 200:
+            cache.put(key, response.get_data(), window, version, mark)
+
+        return response
+
+    return cached_view
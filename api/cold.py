@@ -0,0 +1,431 @@
+import json
+import mmap
+import os
+import struct
+import uuid
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+
+import numpy as np
+from api import db
+from api.models import Reading, ReadingSegment
+from flask import current_app
+
+# Trailer of a segment file: date_created of its first reading, minimum and
+# maximum value, number of readings, code of the value type and magic
+FOOTER = struct.Struct('<qqqQB3x4s')
+MAGIC = b'RSEG'
+
+# Readings are stored as columns of ids, offsets of date_created from the
+# first reading, and values in the narrowest of the value types that holds
+# them, indexed by their code in the footer
+ID_TYPE = np.dtype('<i8')
+OFFSET_TYPE = np.dtype('<u4')
+VALUE_TYPES = (np.dtype('<i1'), np.dtype('<i4'), np.dtype('<i8'))
+
+# Fields of the slices of segments handed to SQLite by cold_readings
+SLICE_FIELDS = ('path', 'device_uuid', 'type', 'first', 'position', 'stop')
+
+# Segment files kept mapped in memory at once
+SEGMENT_CACHE_SIZE = 256
+
+
+class Segment:
+    """
+    Readings of a segment file as arrays over its bytes, without copying
+    them: ids, offsets of date_created from first, and values, sorted by
+    (date_created, id).
+    """
+
+    def __init__(self, buffer):
+        (
+            self.first,
+            self.minimum,
+            self.maximum,
+            self.count,
+            code,
+            magic,
+        ) = FOOTER.unpack_from(buffer, len(buffer) - FOOTER.size)
+        if magic != MAGIC:
+            raise ValueError('Not a segment file')
+
+        offset = 0
+        self.ids = np.frombuffer(buffer, ID_TYPE, self.count, offset)
+        offset += ID_TYPE.itemsize * self.count
+        self.offsets = np.frombuffer(buffer, OFFSET_TYPE, self.count, offset)
+        offset += OFFSET_TYPE.itemsize * self.count
+        self.values = np.frombuffer(
+            buffer, VALUE_TYPES[code], self.count, offset
+        )
+
+    def select(self, start=None, end=None):
+        """
+        Return the slice of the readings created in the inclusive [start,
+        end] range.
+        """
+
+        low, high = 0, self.count
+        if start is not None and start > self.first:
+            low = np.searchsorted(self.offsets, start - self.first)
+
+        if end is not None:
+            if end < self.first:
+                return slice(0, 0)
+
+            high = np.searchsorted(
+                self.offsets, end - self.first, side='right'
+            )
+
+        return slice(int(low), int(high))
+
+    def after(self, selected, date_created, id):
+        """
+        Return the part of the slice selected after the (date_created, id)
+        position.
+        """
+
+        equal = self.select(date_created, date_created)
+        low = equal.start + int(
+            np.searchsorted(self.ids[equal], id, side='right')
+        )
+        low = max(selected.start, low)
+        return slice(low, max(low, selected.stop))
+
+    def dates(self, selected):
+        return self.offsets[selected].astype(np.int64) + self.first
+
+
+@lru_cache(maxsize=SEGMENT_CACHE_SIZE)
+def open_segment(path):
+    """
+    Map a segment file into memory. Segment files are immutable, so mapped
+    segments are kept for later reads.
+    """
+
+    with open(path, 'rb') as file:
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    return Segment(buffer)
+
+
+def write_segment(path, ids, dates, values):
+    """
+    Write readings sorted by (date_created, id) to a new segment file, and
+    return the (first, minimum, maximum) of its footer. Values must be 64
+    bit integers, which are never truncated.
+    """
+
+    dates = np.asarray(dates, np.int64)
+    values = np.asarray(values)
+    if values.dtype.kind != 'i':
+        raise ValueError('Segment values must be 64 bit integers')
+
+    first = int(dates[0])
+    minimum = int(values.min())
+    maximum = int(values.max())
+    code = next(
+        code
+        for code, value_type in enumerate(VALUE_TYPES)
+        if np.iinfo(value_type).min <= minimum
+        and maximum <= np.iinfo(value_type).max
+    )
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(np.asarray(ids, ID_TYPE).tobytes())
+        file.write((dates - first).astype(OFFSET_TYPE).tobytes())
+        file.write(values.astype(VALUE_TYPES[code]).tobytes())
+        file.write(
+            FOOTER.pack(first, minimum, maximum, len(values), code, MAGIC)
+        )
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(temporary, path)
+    return first, minimum, maximum
+
+
+def segment_path(path):
+    """
+    Return the location of a segment file from its path relative to
+    COLD_SEGMENT_DIRECTORY, itself relative to the app's root.
+    """
+
+    directory = current_app.config['COLD_SEGMENT_DIRECTORY']
+    return os.path.join(current_app.root_path, directory, path)
+
+
+def write_segments(start, rows):
+    """
+    Write the readings of a partition to a segment file per device and
+    type, and return the rows of their reading_segments.
+
+    rows are (id, device_uuid, type, value, date_created) tuples ordered by
+    device_uuid, type, date_created and id.
+    """
+
+    segments = []
+    for (device_uuid, sensor_type), readings in groupby(
+        rows, itemgetter(1, 2)
+    ):
+        ids, _, _, values, dates = zip(*readings)
+        path = f'{start}/{uuid.uuid4().hex}.seg'
+        first, minimum, maximum = write_segment(
+            segment_path(path), ids, dates, values
+        )
+        segments.append(
+            {
+                'device_uuid': device_uuid,
+                'type': sensor_type,
+                'start': start,
+                'first': first,
+                'last': max(dates),
+                'count': len(values),
+                'minimum': minimum,
+                'maximum': maximum,
+                'max_id': max(ids),
+                'path': path,
+            }
+        )
+
+    return segments
+
+
+def _segment_column(name):
+    # SQL function returning a column of a segment file at a position
+    def read(path, position):
+        return getattr(open_segment(path), name).item(position)
+
+    return read
+
+
+# Functions registered on every SQLite connection, reading the columns of
+# the segment file at path
+SEGMENT_FUNCTIONS = {
+    'cold_id': _segment_column('ids'),
+    'cold_offset': _segment_column('offsets'),
+    'cold_value': _segment_column('values'),
+}
+
+
+def _first(keys, count, descending=False):
+    # Indices of the count first elements in the lexicographic order of
+    # keys, the primary key last
+    order = np.lexsort(keys)
+    if descending:
+        order = order[::-1]
+
+    return order[:count]
+
+
+def _keep(parts, positions, keys, count, descending=False):
+    """
+    Keep the count readings of positions, a list of position arrays per
+    part, that come first in the order of keys across every part, as the
+    contiguous runs of their part.
+    """
+
+    owners = np.repeat(
+        np.arange(len(parts)), [len(part) for part in positions]
+    )
+    chosen = _first(keys, count, descending)
+    owners, positions = owners[chosen], np.concatenate(positions)[chosen]
+
+    kept = []
+    for index, (stored, path, segment, _) in enumerate(parts):
+        own = np.sort(positions[owners == index])
+        breaks = np.flatnonzero(np.diff(own) != 1) + 1
+        kept.extend(
+            (stored, path, segment, slice(int(run[0]), int(run[-1]) + 1))
+            for run in np.split(own, breaks)
+            if len(run)
+        )
+
+    return kept
+
+
+def _page_parts(parts, limit):
+    # Only the first limit readings by (date_created, id) of each part can
+    # be on the page, and only limit of those across parts
+    positions = [
+        np.arange(selected.start, min(selected.stop, selected.start + limit))
+        for _, _, _, selected in parts
+    ]
+    keys = (
+        np.concatenate(
+            [part[2].ids[position] for part, position in zip(parts, positions)]
+        ),
+        np.concatenate(
+            [
+                part[2].dates(position)
+                for part, position in zip(parts, positions)
+            ]
+        ),
+    )
+    return _keep(parts, positions, keys, limit)
+
+
+def _extreme_parts(parts, k, descending):
+    # The k readings of highest, or lowest, (value, date_created) of each
+    # part, then of every part
+    positions = []
+    for _, _, segment, selected in parts:
+        keys = (segment.dates(selected), segment.values[selected])
+        positions.append(selected.start + _first(keys, k, descending))
+
+    keys = (
+        np.concatenate(
+            [
+                part[2].dates(position)
+                for part, position in zip(parts, positions)
+            ]
+        ),
+        np.concatenate(
+            [
+                part[2].values[position].astype(np.int64)
+                for part, position in zip(parts, positions)
+            ]
+        ),
+    )
+    return _keep(parts, positions, keys, k, descending)
+
+
+def cold_readings(
+    start=None,
+    end=None,
+    device_uuids=None,
+    sensor_type=None,
+    ranges=None,
+    page=None,
+    extreme=None,
+):
+    """
+    Return the readings of the cold segments created in the inclusive
+    [start, end] range, or only in its inclusive (start, end) ranges, of
+    device_uuids and sensor_type when given, as a select with the columns
+    of the readings table, or None when there are none.
+
+    The segments are sliced to the range from their mapped arrays, and only
+    the slices are handed to SQLite, as a single JSON array of their
+    SLICE_FIELDS parsed once. A recursive CTE walks their positions and the
+    SEGMENT_FUNCTIONS read each reading from the mapped arrays as SQLite
+    steps through them, so the readings are never copied into Python, the
+    cost is linear in the readings read, and the read-only connections can
+    union them with the hot readings.
+
+    A page of (after, limit) keeps the first limit readings by
+    (date_created, id) after the position after, when given, and an extreme
+    of (k, descending) the k readings of lowest, or highest, (value,
+    date_created), so that paged and top k queries only hand SQLite as many
+    cold readings as they return. They must match the query exactly.
+    """
+
+    if not current_app.config['COLD_AFTER_SECONDS']:
+        return None
+
+    query = db.session.query(
+        ReadingSegment.path,
+        ReadingSegment.device_uuid,
+        ReadingSegment.type,
+        ReadingSegment.first,
+        ReadingSegment.last,
+        ReadingSegment.count,
+    )
+    if device_uuids is not None:
+        query = query.filter(ReadingSegment.device_uuid.in_(device_uuids))
+
+    if sensor_type is not None:
+        query = query.filter(ReadingSegment.type == sensor_type)
+
+    ranges = ranges or [(start, end)]
+    overlaps = []
+    for range_start, range_end in ranges:
+        overlap = []
+        if range_start is not None:
+            overlap.append(ReadingSegment.last >= range_start)
+
+        if range_end is not None:
+            overlap.append(ReadingSegment.first <= range_end)
+
+        overlaps.append(db.and_(db.true(), *overlap))
+
+    # Segments of a device and type cover disjoint ranges, so reading them
+    # by first date keeps their readings in (date_created, id) order like
+    # the partitions they were compacted from
+    parts = []
+    query = query.filter(db.or_(*overlaps)).order_by(
+        ReadingSegment.first, ReadingSegment.id
+    )
+    directory = segment_path('')
+    for stored in query:
+        path = os.path.join(directory, stored.path)
+        segment = None
+        for range_start, range_end in ranges:
+            # Segments inside the range are read whole without mapping them
+            # here, only those cut by the range or a page or extreme are
+            if (
+                page is None
+                and extreme is None
+                and (range_start is None or range_start <= stored.first)
+                and (range_end is None or stored.last <= range_end)
+            ):
+                selected = slice(0, stored.count)
+            else:
+                segment = segment or open_segment(path)
+                selected = segment.select(range_start, range_end)
+                if page is not None and page[0] is not None:
+                    selected = segment.after(selected, *page[0])
+
+            if selected.start < selected.stop:
+                parts.append((stored, path, segment, selected))
+
+    if parts and page is not None:
+        parts = _page_parts(parts, page[1])
+    elif parts and extreme is not None:
+        parts = _extreme_parts(parts, *extreme)
+
+    if not parts:
+        return None
+
+    # The slices are parsed once by json_each, and the CTE takes its rows in
+    # (slice, position) order, reading the slices one after another
+    slices = json.dumps(
+        [
+            [
+                path,
+                stored.device_uuid,
+                stored.type,
+                stored.first,
+                selected.start,
+                selected.stop,
+            ]
+            for stored, path, segment, selected in parts
+        ]
+    )
+    fields = ', '.join(
+        f"json_extract(value, '$[{index}]') AS {name}"
+        for index, name in enumerate(SLICE_FIELDS)
+    )
+    positions = db.text(
+        f'WITH RECURSIVE cold_positions(slice, {", ".join(SLICE_FIELDS)}) '
+        f'AS (SELECT key AS slice, {fields} FROM json_each(:cold_slices) '
+        'UNION ALL SELECT slice, path, device_uuid, type, first, '
+        'position + 1, stop FROM cold_positions WHERE position + 1 < stop '
+        'ORDER BY slice, position) '
+        # The columns are in the order of the readings table's
+        'SELECT cold_id(path, position) AS id, device_uuid, type, '
+        'cold_value(path, position) AS value, '
+        'first + cold_offset(path, position) AS date_created '
+        'FROM cold_positions'
+    )
+    positions = positions.bindparams(
+        db.bindparam('cold_slices', slices, unique=True)
+    ).columns(
+        *(
+            db.column(column.name, column.type)
+            for column in Reading.__table__.c
+        )
+    )
+    return db.select(positions.alias('cold_readings').c)
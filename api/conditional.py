@@ -0,0 +1,106 @@
+import calendar
+import hashlib
+from functools import wraps
+
+from api import db
+from api.models import ReadingMark
+from flask import current_app, g, request
+
+
+def readings_mark(device_uuid, sensor_type=None, substring=False):
+    """
+    Return the (version, modified) marker of a device's readings of a type,
+    or of every type when sensor_type is None. The version is the sum of
+    the versions of the matching types, which only grows, and modified the
+    epoch time of their last change or None when there are no readings.
+    """
+
+    query = db.session.query(
+        db.func.coalesce(db.func.sum(ReadingMark.version), 0),
+        db.func.max(ReadingMark.modified),
+    ).filter(ReadingMark.device_uuid == device_uuid)
+
+    if sensor_type:
+        if substring:
+            query = query.filter(ReadingMark.type.like(f'%{sensor_type}%'))
+        else:
+            query = query.filter(ReadingMark.type == sensor_type)
+
+    return query.one()
+
+
+def request_mark(device_uuid):
+    """
+    Return the readings_mark of the type the current request reads, as
+    read by conditional_get when the route is wrapped in it.
+    """
+
+    mark = g.get('readings_mark')
+    if mark is None:
+        mark = readings_mark(
+            device_uuid,
+            request.args.get('type'),
+            request.args.get('type_match') == 'substring',
+        )
+
+    return mark
+
+
+def _etag(version):
+    # The same version of different routes, queries or shards must not
+    # share an entity tag
+    representation = repr(
+        (
+            g.get('shard'),
+            request.endpoint,
+            sorted(request.args.items(multi=True)),
+        )
+    )
+    digest = hashlib.blake2b(representation.encode(), digest_size=8)
+    return f'{version}-{digest.hexdigest()}'
+
+
+def _not_modified(etag, modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+
+    since = request.if_modified_since
+    if since is None or modified is None:
+        return False
+
+    return modified <= calendar.timegm(since.utctimetuple())
+
+
+def conditional_get(view):
+    """
+    Tag the GET responses of a device route with an ETag and Last-Modified
+    from the marks of its readings, and answer a 304 Not Modified without
+    calling the view when they did not change.
+    """
+
+    @wraps(view)
+    def conditional_view(device_uuid):
+        if request.method != 'GET':
+            return view(device_uuid)
+
+        # The marker is read before the view runs, so a reading ingested
+        # in between only makes the tag of the response conservative
+        version, modified = g.readings_mark = request_mark(device_uuid)
+        etag = _etag(version)
+
+        try:
+            if _not_modified(etag, modified):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(view(device_uuid))
+        finally:
+            g.pop('readings_mark', None)
+
+        if response.status_code in (200, 304):
+            response.set_etag(etag)
+            if modified is not None:
+                response.last_modified = modified
+
+        return response
+
+    return conditional_view
@@ -2,6 +2,78 @@ class Config:
     DEBUG = False
     SQLALCHEMY_DATABASE_URI = 'sqlite:///database.db'
 
+    # SQLite storage profile: pragmas run on every new connection, a single
+    # pooled writer connection, and the size of the pool of read-only
+    # connections GET requests use (0 reads through the writer engine)
+    SQLITE_PRAGMAS = {}
+    SQLITE_SINGLE_WRITER = False
+    SQLITE_READ_POOL_SIZE = 0
+
+    # Readings are hash sharded by device_uuid across SHARD_COUNT SQLite
+    # files named after SHARD_DATABASE_URI. 0 keeps every device in the
+    # SQLALCHEMY_DATABASE_URI database. Run flask rebalance-shards after
+    # changing it.
+    SHARD_COUNT = 0
+    SHARD_DATABASE_URI = 'sqlite:///database_{shard}.db'
+
+    # Readings are stored in one table per PARTITION_SECONDS of
+    # date_created, a multiple of a day, and flask drop-expired-partitions
+    # drops the partitions older than RETENTION_SECONDS. 0 disables either.
+    PARTITION_SECONDS = 0
+    RETENTION_SECONDS = 0
+
+    # flask compact-cold-partitions moves the partitions older than
+    # COLD_AFTER_SECONDS to immutable columnar segment files under
+    # COLD_SEGMENT_DIRECTORY, read back through mmap and unioned with the
+    # hot readings. 0 disables the cold tier.
+    COLD_AFTER_SECONDS = 0
+    COLD_SEGMENT_DIRECTORY = 'segments'
+
+    # Statements slower than SLOW_QUERY_SECONDS are logged with their
+    # parameters and query plan. 0 disables the log.
+    SLOW_QUERY_SECONDS = 0.25
+
+    # Ingest
+    INGEST_BATCH_MAX_SIZE = 10000
+    # Largest request body, in bytes, read by the asyncio ingest service
+    INGEST_BODY_MAX_SIZE = 16 * 1024 * 1024
+
+    # Sensor types of the type codes of binary readings
+    BINARY_TYPE_CODES = {1: 'temperature', 2: 'humidity'}
+
+    # Write-behind ingest buffer: single reading POSTs are queued and
+    # flushed in group commits of at most INGEST_FLUSH_MAX_ROWS rows, or
+    # after INGEST_FLUSH_MAX_LATENCY seconds, whichever comes first.
+    INGEST_BUFFER_ENABLED = False
+    INGEST_FLUSH_MAX_ROWS = 500
+    INGEST_FLUSH_MAX_LATENCY = 0.05
+    INGEST_QUEUE_MAX_SIZE = 100000
+
+    # LRU cache of the max, mean, median, quartiles and series responses.
+    # Entries are invalidated by the readings ingested in this process and
+    # checked against the reading marks on every hit, and those of windows
+    # ending in the future also expire after METRIC_CACHE_TTL seconds. A
+    # METRIC_CACHE_SIZE of 0 disables the cache.
+    METRIC_CACHE_SIZE = 10000
+    METRIC_CACHE_TTL = 30
+
+    # Points a downsampled series may be asked for
+    SERIES_MAX_POINTS = 10000
+
+    # Devices a single batch metrics request may ask for
+    BATCH_METRICS_MAX_DEVICES = 1000
+
+    # Rows fetched from the database cursor per round trip when streaming
+    STREAM_CHUNK_SIZE = 1000
+
+    # Keyset pagination of device readings
+    PAGE_DEFAULT_LIMIT = 1000
+    PAGE_MAX_LIMIT = 10000
+
+    # Number of readings returned by the top and bottom routes
+    TOP_K_DEFAULT = 10
+    TOP_K_MAX = 1000
+
 
 class DevelopmentConfig(Config):
     ENV = 'development'
@@ -13,12 +85,27 @@ class TestingConfig(Config):
     DEBUG = True
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///test_database.db'
+    SHARD_DATABASE_URI = 'sqlite:///test_database_{shard}.db'
+    COLD_SEGMENT_DIRECTORY = 'test_segments'
 
 
 class ProductionConfig(Config):
     ENV = 'production'
     DEBUG = False
     TESTING = False
+    INGEST_BUFFER_ENABLED = True
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        # Negative sizes are in KiB: 64 MiB of page cache per connection
+        'cache_size': -65536,
+        'mmap_size': 268435456,
+        'busy_timeout': 5000,
+        'temp_store': 'MEMORY',
+    }
+    SQLITE_SINGLE_WRITER = True
+    SQLITE_READ_POOL_SIZE = 8
+    PARTITION_SECONDS = 604800
 
 
 app_config = {
@@ -0,0 +1,134 @@
+import json
+import struct
+
+import msgpack
+
+# Fixed width readings: a stream of records, each with the code of the
+# sensor type, its value and date_created (0 for now), little endian.
+BINARY_MIMETYPE = 'application/x-sensor-readings'
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+RECORD = struct.Struct('<HiI')
+
+# Multi-device bodies are a sequence of sections, each with the length of
+# the device_uuid, the number of records, the device_uuid and its records
+SECTION = struct.Struct('<BI')
+
+
+def _unpack_records(view, type_codes, device_uuid=None):
+    records = struct.iter_unpack(RECORD.format, view)
+    type_of = type_codes.get
+    items = [
+        (
+            {'type': type_of(code), 'value': value, 'date_created': created}
+            if created
+            else {'type': type_of(code), 'value': value}
+        )
+        for code, value, created in records
+    ]
+
+    if device_uuid is not None:
+        for item in items:
+            item['device_uuid'] = device_uuid
+
+    return items
+
+
+def decode_records(data, type_codes):
+    """
+    Decode a stream of binary records into reading payloads.
+
+    The records are unpacked straight from the request buffer. Unknown type
+    codes decode to a payload without a type, which fails validation like a
+    JSON reading without one.
+    """
+
+    view = memoryview(data)
+    if len(view) % RECORD.size:
+        raise ValueError('Truncated binary readings')
+
+    return _unpack_records(view, type_codes)
+
+
+def decode_sections(data, type_codes):
+    """
+    Decode the device sections of a multi-device binary body into reading
+    payloads that carry their device_uuid.
+    """
+
+    view = memoryview(data)
+    items = []
+    offset = 0
+    while offset < len(view):
+        if offset + SECTION.size > len(view):
+            raise ValueError('Truncated binary readings')
+
+        length, count = SECTION.unpack_from(view, offset)
+        offset += SECTION.size
+        stop = offset + length + count * RECORD.size
+        if stop > len(view):
+            raise ValueError('Truncated binary readings')
+
+        device_uuid = str(view[offset : offset + length], 'utf-8')
+        offset += length
+        items.extend(
+            _unpack_records(view[offset:stop], type_codes, device_uuid)
+        )
+        offset = stop
+
+    return items
+
+
+def load_readings(data, mimetype, type_codes, multi_device=False):
+    """
+    Parse a batch body in any of the ingest formats into a list of reading
+    payloads, as json.loads does for JSON bodies.
+
+    Raises ValueError when the body is malformed.
+    """
+
+    if mimetype == BINARY_MIMETYPE:
+        if multi_device:
+            return decode_sections(data, type_codes)
+
+        return decode_records(data, type_codes)
+
+    if mimetype == MSGPACK_MIMETYPE:
+        return msgpack.unpackb(data, raw=False)
+
+    return json.loads(data)
+
+
+def load_reading(data, mimetype, type_codes):
+    """
+    Parse the body of a single reading POST. A binary body must hold
+    exactly one record.
+    """
+
+    if mimetype == BINARY_MIMETYPE:
+        items = decode_records(data, type_codes)
+        if len(items) != 1:
+            raise ValueError('A single binary reading is required')
+
+        return items[0]
+
+    return load_readings(data, mimetype, type_codes)
+
+
+def encode_records(readings, type_names):
+    """
+    Encode reading payloads as binary records, the inverse of
+    decode_records. type_names maps sensor types to their codes.
+    """
+
+    buffer = bytearray(RECORD.size * len(readings))
+    for index, reading in enumerate(readings):
+        RECORD.pack_into(
+            buffer,
+            index * RECORD.size,
+            type_names[reading['type']],
+            reading['value'],
+            reading.get('date_created', 0),
+        )
+
+    return bytes(buffer)
@@ -1,3 +1,6 @@
+import base64
+import json
+from itertools import chain, islice
 from statistics import median, StatisticsError
 
 
@@ -26,3 +29,251 @@ def get_quartiles(values):
 
     except TypeError:
         return (None, None)
+
+
+def get_median_positions(offset, length):
+    """
+    Return the positions, within a sorted sequence, of the values whose
+    median is the median of the slice starting at offset.
+    """
+
+    if length <= 0:
+        return ()
+
+    mid = offset + length // 2
+    if length % 2 == 0:
+        return (mid - 1, mid)
+
+    return (mid,)
+
+
+def get_quartile_positions(count):
+    """
+    Return the positions used by get_quartiles for the 1st and 3rd quartile
+    of a sorted sequence of count values.
+    """
+
+    mid = count // 2
+    upper_offset = mid if count % 2 == 0 else mid + 1
+
+    return (
+        get_median_positions(0, mid),
+        get_median_positions(upper_offset, count - upper_offset),
+    )
+
+
+def get_summary_positions(count):
+    """
+    Return the positions of the values the median, 1st quartile and 3rd
+    quartile of a sorted sequence of count values are computed from.
+    """
+
+    return (get_median_positions(0, count),) + get_quartile_positions(count)
+
+
+def get_positional_summary(picked, count):
+    """
+    Compute the median and quartiles of count sorted values from the values
+    picked at get_summary_positions, matching get_median and get_quartiles.
+    """
+
+    median_positions, quartile_1_positions, quartile_3_positions = (
+        get_summary_positions(count)
+    )
+    median = get_median([picked[p] for p in median_positions])
+    quartile_1 = get_median([picked[p] for p in quartile_1_positions])
+    quartile_3 = get_median([picked[p] for p in quartile_3_positions])
+
+    try:
+        return median, (int(quartile_1), int(quartile_3))
+
+    except TypeError:
+        return median, (None, None)
+
+
+def get_histogram_summary(counts):
+    """
+    Summarize values given as (value, count) pairs sorted by value, without
+    expanding them, in time proportional to the number of distinct values.
+
+    Returns a tuple of (count, max, mean, median, quartiles) matching
+    get_median and get_quartiles over the expanded values.
+    """
+
+    counts = [(value, count) for value, count in counts if count]
+    total_count = sum(count for _, count in counts)
+    positions = chain.from_iterable(get_summary_positions(total_count))
+    wanted = sorted(set(positions))
+
+    picked = {}
+    total = 0
+    max_value = None
+    position = 0
+    for value, count in counts:
+        position += count
+        while wanted and wanted[0] < position:
+            picked[wanted.pop(0)] = value
+
+        total += value * count
+        max_value = value
+
+    median, quartiles = get_positional_summary(picked, total_count)
+    mean = total / total_count if total_count else None
+    return total_count, max_value, mean, median, quartiles
+
+
+def split_time_range(start, end, width):
+    """
+    Split the inclusive [start, end] epoch range into the whole buckets of
+    width seconds it covers and the ragged edges around them.
+
+    Returns (interior, edges) where interior is a (first, stop) pair of
+    bucket starts, with first <= bucket < stop, or None when no bucket is
+    fully covered, and edges is a list of inclusive (start, end) ranges to
+    read from raw rows. A None start or end leaves that side unbounded.
+    """
+
+    first = None if start is None else -(-start // width) * width
+    stop = None if end is None else (end + 1) // width * width
+
+    if first is not None and stop is not None and first >= stop:
+        return None, [(start, end)]
+
+    edges = []
+    if first is not None and start < first:
+        edges.append((start, first - 1))
+
+    if stop is not None and stop <= end:
+        edges.append((stop, end))
+
+    return (first, stop), edges
+
+
+def plan_time_range(start, end, widths):
+    """
+    Cover the inclusive [start, end] epoch range with the largest whole
+    buckets available, trying each width in turn on what the larger widths
+    left uncovered. Each width must divide the one before it.
+
+    Returns (segments, edges) where segments is a list of (width, first,
+    stop) bucket ranges as in split_time_range and edges is the list of
+    inclusive (start, end) ranges left for raw rows.
+    """
+
+    if not widths:
+        return [], [(start, end)]
+
+    interior, edges = split_time_range(start, end, widths[0])
+    segments = [] if interior is None else [(widths[0],) + interior]
+    raw_edges = []
+
+    for edge_start, edge_end in edges:
+        edge_segments, edge_raw = plan_time_range(
+            edge_start, edge_end, widths[1:]
+        )
+        segments.extend(edge_segments)
+        raw_edges.extend(edge_raw)
+
+    return segments, raw_edges
+
+
+def downsample_lttb(points, count, threshold):
+    """
+    Downsample count (x, y) points sorted by x to threshold points with the
+    Largest-Triangle-Three-Buckets algorithm, keeping the first and last
+    points and, from each of threshold - 2 buckets in between, the point
+    forming the largest triangle with the point kept before it and the
+    average of the next bucket.
+
+    points may be an iterator, of which only two buckets are held at a
+    time. Every point is kept when threshold is not below count, or is
+    below 3.
+    """
+
+    points = iter(points)
+    if threshold >= count or threshold < 3:
+        return list(islice(points, count))
+
+    buckets = threshold - 2
+
+    def bucket_start(index):
+        return index * (count - 2) // buckets + 1
+
+    previous = next(points)
+    sampled = [previous]
+    current = list(islice(points, bucket_start(1) - 1))
+    for index in range(buckets):
+        if index + 1 < buckets:
+            size = bucket_start(index + 2) - bucket_start(index + 1)
+        else:
+            size = 1
+
+        following = list(islice(points, size))
+        if not current or not following:
+            break
+
+        average_x = sum(x for x, _ in following) / len(following)
+        average_y = sum(y for _, y in following) / len(following)
+        previous = max(
+            current,
+            key=lambda point: abs(
+                (previous[0] - average_x) * (point[1] - previous[1])
+                - (previous[0] - point[0]) * (average_y - previous[1])
+            ),
+        )
+        sampled.append(previous)
+        current = following
+
+    sampled.extend(current[-1:])
+    return sampled
+
+
+def iter_ndjson(rows, chunk_size=1000):
+    """
+    Encode reading rows as newline delimited JSON, yielding chunk_size rows
+    at a time so the response is streamed with constant memory.
+    """
+
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+
+        yield ''.join(
+            json.dumps(
+                {
+                    'device_uuid': row.device_uuid,
+                    'type': row.type,
+                    'value': row.value,
+                    'date_created': row.date_created,
+                }
+            )
+            + '\n'
+            for row in chunk
+        )
+
+
+def encode_cursor(date_created, reading_id):
+    """
+    Encode the position of the last reading of a page as an opaque cursor.
+    """
+
+    position = f'{date_created}:{reading_id}'.encode()
+    return base64.urlsafe_b64encode(position).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor from encode_cursor into a (date_created, id) tuple, or
+    None when it is malformed.
+    """
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        position = base64.urlsafe_b64decode(padded).decode()
+        date_created, reading_id = position.split(':')
+        return int(date_created), int(reading_id)
+
+    except ValueError:
+        return None
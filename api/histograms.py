@@ -0,0 +1,97 @@
+from api import db
+from api.helpers import split_time_range
+from api.models import HISTOGRAM_BUCKET_SECONDS, Reading, ReadingHistogram
+from api.partitions import route_readings
+from api.validators import RESTRICTED_TYPES
+
+
+def uses_histograms(sensor_type, substring=False):
+    """
+    Histograms are only kept for the restricted types, matched exactly.
+    """
+
+    return not substring and sensor_type in RESTRICTED_TYPES
+
+
+def histogram_counts(
+    sensor_type, start=None, end=None, device_uuid=None, device_uuids=None
+):
+    """
+    Return the exact value counts of a restricted type over the inclusive
+    [start, end] range, per device, of every device or only of device_uuid
+    or device_uuids.
+
+    Whole hours inside the range are read from the histograms and only the
+    ragged edges are counted from raw readings. The result maps each
+    device_uuid to a list of (value, count) pairs sorted by value.
+    """
+
+    start = int(start) if start else None
+    end = int(end) if end else None
+    interior, edges = split_time_range(start, end, HISTOGRAM_BUCKET_SECONDS)
+    counts = {}
+
+    if interior is not None:
+        first, stop = interior
+        query = db.session.query(
+            ReadingHistogram.device_uuid,
+            ReadingHistogram.value,
+            db.func.sum(ReadingHistogram.count),
+        ).filter(ReadingHistogram.type == sensor_type)
+
+        if device_uuid is not None:
+            query = query.filter(ReadingHistogram.device_uuid == device_uuid)
+
+        if device_uuids is not None:
+            query = query.filter(
+                ReadingHistogram.device_uuid.in_(device_uuids)
+            )
+
+        if first is not None:
+            query = query.filter(ReadingHistogram.bucket >= first)
+
+        if stop is not None:
+            query = query.filter(ReadingHistogram.bucket < stop)
+
+        query = query.group_by(
+            ReadingHistogram.device_uuid, ReadingHistogram.value
+        )
+        _merge_counts(counts, query)
+
+    if edges:
+        query = db.session.query(
+            Reading.device_uuid,
+            Reading.value,
+            db.func.count(Reading.id),
+        )
+        devices = [device_uuid] if device_uuid is not None else device_uuids
+        query = route_readings(
+            query, start, end, devices, sensor_type, edges
+        ).filter(
+            Reading.type == sensor_type,
+            db.or_(
+                *(
+                    Reading.date_created.between(edge_start, edge_end)
+                    for edge_start, edge_end in edges
+                )
+            ),
+        )
+
+        if device_uuid is not None:
+            query = query.filter(Reading.device_uuid == device_uuid)
+
+        if device_uuids is not None:
+            query = query.filter(Reading.device_uuid.in_(device_uuids))
+
+        query = query.group_by(Reading.device_uuid, Reading.value)
+        _merge_counts(counts, query)
+
+    return {
+        device: sorted(values.items()) for device, values in counts.items()
+    }
+
+
+def _merge_counts(counts, rows):
+    for device, value, count in rows:
+        values = counts.setdefault(device, {})
+        values[value] = values.get(value, 0) + count
@@ -0,0 +1,281 @@
+import atexit
+import queue
+import threading
+import time
+
+from api import db
+from api.cache import invalidate_readings
+from api.partitions import insert_rows
+from api.shards import group_by_shard, use_shard
+from api.sketches import update_sketches
+from api.validators import (
+    validate_date,
+    validate_name,
+    validate_sensor_value,
+)
+
+
+def build_reading(device_uuid, payload):
+    """
+    Validate a single reading payload and return the row to insert.
+
+    Returns None when a mandatory field is missing, device_uuid or type is
+    not a string, date_created is not an integer, or the value is out of
+    range for the sensor type.
+    """
+
+    if not isinstance(payload, dict):
+        return None
+
+    sensor_type = payload.get('type')
+    value = payload.get('value')
+    date_created = payload.get('date_created', int(time.time()))
+
+    # Field validation
+    if not all(
+        (
+            device_uuid,
+            sensor_type,
+            value,
+            date_created,
+            validate_name(device_uuid),
+            validate_name(sensor_type),
+            validate_date(date_created),
+            validate_sensor_value(sensor_type, value),
+        )
+    ):
+        return None
+
+    return {
+        'device_uuid': device_uuid,
+        'type': sensor_type,
+        'value': value,
+        'date_created': date_created,
+    }
+
+
+def build_readings(items, device_uuid=None):
+    """
+    Validate a batch of reading payloads.
+
+    When device_uuid is None every item must carry its own device_uuid.
+    Returns a tuple of (rows, errors) where errors reference the position
+    of the rejected item in the batch.
+    """
+
+    rows = []
+    errors = []
+
+    for index, item in enumerate(items):
+        item_uuid = device_uuid
+        if item_uuid is None and isinstance(item, dict):
+            item_uuid = item.get('device_uuid')
+
+        row = build_reading(item_uuid, item)
+        if row is None:
+            errors.append({'index': index, 'error': 'Validation fields error'})
+        else:
+            rows.append(row)
+
+    return rows, errors
+
+
+def insert_readings(rows):
+    """
+    Insert validated rows with a single executemany per shard, each in one
+    transaction together with the quantile sketches they update, then
+    invalidate the cached metrics they change.
+    """
+
+    if not rows:
+        return 0
+
+    for bind, shard_rows in group_by_shard(rows).items():
+        with use_shard(bind):
+            insert_rows(shard_rows)
+            update_sketches(shard_rows)
+            db.session.commit()
+
+    invalidate_readings(rows)
+    return len(rows)
+
+
+_STOP = object()
+
+
+class WriteBehindBuffer:
+    """
+    In-process ingest queue flushed by a background writer thread.
+
+    Readings are acknowledged once they are queued and written by the
+    writer in group commits bounded by INGEST_FLUSH_MAX_ROWS rows and
+    INGEST_FLUSH_MAX_LATENCY seconds. Queued readings live in memory until
+    they are flushed, so the queue is drained when the process exits
+    cleanly but not if it is killed.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._queue = queue.Queue(app.config['INGEST_QUEUE_MAX_SIZE'])
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+        self._counters = {
+            'rows_queued': 0,
+            'rows_rejected': 0,
+            'rows_flushed': 0,
+            'rows_failed': 0,
+            'flushes': 0,
+            'flush_errors': 0,
+            'flush_latency_total': 0.0,
+            'flush_latency_max': 0.0,
+            'flush_latency_last': 0.0,
+        }
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            self._thread = threading.Thread(
+                target=self._run, name='ingest-writer', daemon=True
+            )
+            self._thread.start()
+
+        atexit.register(self.stop)
+
+    def submit(self, row):
+        """
+        Queue a validated row. Returns False when the queue is full or the
+        writer is shutting down, so the caller can apply backpressure.
+        """
+
+        if self._thread is None:
+            self.start()
+
+        if self._stopping:
+            accepted = False
+        else:
+            try:
+                self._queue.put_nowait(row)
+                accepted = True
+            except queue.Full:
+                accepted = False
+
+        with self._lock:
+            key = 'rows_queued' if accepted else 'rows_rejected'
+            self._counters[key] += 1
+
+        return accepted
+
+    def stop(self, timeout=None):
+        """
+        Stop accepting rows and flush everything still queued.
+        """
+
+        with self._lock:
+            thread = self._thread
+            if thread is None or self._stopping:
+                return
+
+            self._stopping = True
+
+        self._queue.put(_STOP)
+        thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+
+        stats['queue_depth'] = self._queue.qsize()
+        return stats
+
+    def _run(self):
+        max_rows = self.app.config['INGEST_FLUSH_MAX_ROWS']
+        max_latency = self.app.config['INGEST_FLUSH_MAX_LATENCY']
+        stopped = False
+
+        while not stopped:
+            row = self._queue.get()
+            if row is _STOP:
+                break
+
+            rows = [row]
+            deadline = time.monotonic() + max_latency
+            while len(rows) < max_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                try:
+                    row = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+
+                if row is _STOP:
+                    stopped = True
+                    break
+
+                rows.append(row)
+
+            self._flush(rows)
+
+        # Drain whatever was queued before the stop marker
+        rows = []
+        while True:
+            try:
+                row = self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if row is not _STOP:
+                rows.append(row)
+
+        for index in range(0, len(rows), max_rows):
+            self._flush(rows[index : index + max_rows])
+
+    def _flush(self, rows):
+        started = time.monotonic()
+        failed = 0
+        with self.app.app_context():
+            # Each shard commits on its own, so only the rows of a failed
+            # commit are retried
+            for shard_rows in group_by_shard(rows).values():
+                failed += self._insert(shard_rows)
+
+        latency = time.monotonic() - started
+        with self._lock:
+            self._counters['flushes'] += 1
+            self._counters['rows_flushed'] += len(rows) - failed
+            self._counters['rows_failed'] += failed
+            self._counters['flush_errors'] += 1 if failed else 0
+            self._counters['flush_latency_total'] += latency
+            self._counters['flush_latency_last'] = latency
+            self._counters['flush_latency_max'] = max(
+                self._counters['flush_latency_max'], latency
+            )
+
+    def _insert(self, rows):
+        """
+        Insert rows in a single group commit, retrying them one at a time
+        when it fails so that a bad row does not lose the others, and
+        return the number of rows that could not be inserted.
+        """
+
+        try:
+            insert_readings(rows)
+            return 0
+
+        except Exception:
+            db.session.rollback()
+            if len(rows) == 1:
+                self.app.logger.exception(
+                    'Failed to flush buffered reading %r', rows[0]
+                )
+                return 1
+
+        self.app.logger.warning(
+            'Failed to flush %d buffered readings, retrying them one by one',
+            len(rows),
+        )
+        return sum(self._insert([row]) for row in rows)
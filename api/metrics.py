@@ -0,0 +1,593 @@
+import logging
+import sqlite3
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+
+from flask import current_app, g, request
+from sqlalchemy import event
+
+# Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+ROW_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 1000)
+
+# SQLite virtual machine instructions between two progress callbacks
+PROGRESS_STEPS = 1000
+
+
+class Metric:
+    def __init__(self, name, kind, help, labels, buckets=None):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+
+
+REQUESTS = Metric(
+    'http_requests_total',
+    'counter',
+    'Requests handled.',
+    ('method', 'route', 'status'),
+)
+REQUEST_DURATION = Metric(
+    'http_request_duration_seconds',
+    'histogram',
+    'Time from the start of a request until its response is sent.',
+    ('method', 'route'),
+    LATENCY_BUCKETS,
+)
+REQUEST_SIZE = Metric(
+    'http_request_size_bytes',
+    'histogram',
+    'Size of request bodies.',
+    ('method', 'route'),
+    SIZE_BUCKETS,
+)
+RESPONSE_SIZE = Metric(
+    'http_response_size_bytes',
+    'histogram',
+    'Size of response bodies.',
+    ('method', 'route'),
+    SIZE_BUCKETS,
+)
+DB_DURATION = Metric(
+    'db_duration_seconds',
+    'histogram',
+    'Time a request spent executing statements and fetching rows.',
+    ('method', 'route'),
+    LATENCY_BUCKETS,
+)
+DB_ROWS = Metric(
+    'db_rows_returned',
+    'histogram',
+    'Rows a request fetched from the database.',
+    ('method', 'route'),
+    ROW_BUCKETS,
+)
+DB_QUERIES = Metric(
+    'db_queries',
+    'histogram',
+    'Statements a request executed.',
+    ('method', 'route'),
+    QUERY_BUCKETS,
+)
+DB_STEPS = Metric(
+    'db_vm_steps_total',
+    'counter',
+    f'SQLite virtual machine instructions run, in units of '
+    f'{PROGRESS_STEPS}. A proxy for the rows a query scanned.',
+    ('method', 'route'),
+)
+
+_local = threading.local()
+
+slow_query_logger = logging.getLogger('api.slow_queries')
+
+# Statements the slow query log explains
+EXPLAINED = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+class Tally:
+    """
+    Database work of a single request, added to by the cursors its thread
+    uses.
+    """
+
+    __slots__ = ('queries', 'seconds', 'rows', 'steps')
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.steps = 0
+
+    def merge(self, other):
+        self.queries += other.queries
+        self.seconds += other.seconds
+        self.rows += other.rows
+        self.steps += other.steps
+
+
+def current_tally():
+    return getattr(_local, 'tally', None)
+
+
+@contextmanager
+def use_tally(tally):
+    """
+    Count the database work of the current thread into tally, e.g. in the
+    worker threads of a request.
+    """
+
+    previous = current_tally()
+    _local.tally = tally
+    try:
+        yield tally
+    finally:
+        _local.tally = previous
+
+
+def count_queries():
+    """
+    Return a context manager counting the database work of the current
+    thread, including the requests it handles, into a new Tally.
+    """
+
+    return use_tally(Tally())
+
+
+class MeteredCursor(sqlite3.Cursor):
+    """
+    Cursor timing its statements and counting the rows it fetches into the
+    tally of the current thread.
+    """
+
+    def _timed(self, method, *args):
+        tally = getattr(_local, 'tally', None)
+        if tally is None:
+            return method(self, *args)
+
+        started = perf_counter()
+        result = method(self, *args)
+        tally.seconds += perf_counter() - started
+        return result
+
+    def execute(self, *args):
+        return self._timed(sqlite3.Cursor.execute, *args)
+
+    def executemany(self, *args):
+        return self._timed(sqlite3.Cursor.executemany, *args)
+
+    def fetchone(self):
+        row = self._timed(sqlite3.Cursor.fetchone)
+        tally = getattr(_local, 'tally', None)
+        if row is not None and tally is not None:
+            tally.rows += 1
+
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._timed(sqlite3.Cursor.fetchmany, *args)
+        tally = getattr(_local, 'tally', None)
+        if tally is not None:
+            tally.rows += len(rows)
+
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(sqlite3.Cursor.fetchall)
+        tally = getattr(_local, 'tally', None)
+        if tally is not None:
+            tally.rows += len(rows)
+
+        return rows
+
+
+def _count_steps():
+    tally = getattr(_local, 'tally', None)
+    if tally is not None:
+        tally.steps += 1
+
+    return 0
+
+
+class MeteredConnection(sqlite3.Connection):
+    """
+    SQLite connection whose cursors are metered, passed to sqlite3.connect
+    as its factory.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.set_progress_handler(_count_steps, PROGRESS_STEPS)
+
+    def cursor(self, factory=MeteredCursor):
+        return super().cursor(factory)
+
+
+def _explain(cursor, statement, parameters):
+    # A plain cursor, so the plan stays out of the request's tally
+    explain = sqlite3.Cursor(cursor.connection)
+    try:
+        rows = explain.execute(f'EXPLAIN QUERY PLAN {statement}', parameters)
+        return [row[-1] for row in rows]
+    except sqlite3.Error:
+        return []
+    finally:
+        explain.close()
+
+
+def listen_queries(engine, app):
+    """
+    Count the statements of engine into the tally of the current thread
+    and log those slower than SLOW_QUERY_SECONDS with their parameters and
+    query plan.
+    """
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, *args):
+        conn.info['query_started'] = perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany
+    ):
+        elapsed = perf_counter() - conn.info['query_started']
+        tally = getattr(_local, 'tally', None)
+        if tally is not None:
+            tally.queries += 1
+
+        threshold = app.config['SLOW_QUERY_SECONDS']
+        if not threshold or elapsed < threshold:
+            return
+
+        if executemany:
+            parameters = parameters[0] if parameters else ()
+
+        plan = []
+        if statement.split(None, 1)[0].upper() in EXPLAINED:
+            plan = _explain(cursor, statement, parameters)
+
+        slow_query_logger.warning(
+            'Slow query (%.1f ms): %s\nParameters: %r\nPlan:\n%s',
+            elapsed * 1000,
+            statement,
+            parameters,
+            '\n'.join(plan) or '(none)',
+        )
+
+
+class Registry:
+    """
+    Counters and histograms kept per thread, so recording a request takes
+    no lock. Scrapes merge the threads' values, folding those of finished
+    threads into a single retired set.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._threads = []
+        self._retired = {}
+
+    def _values(self):
+        values = getattr(self._local, 'values', None)
+        if values is None:
+            values = self._local.values = {}
+            with self._lock:
+                self._threads.append((threading.current_thread(), values))
+
+        return values
+
+    def inc(self, metric, labels, amount=1):
+        values = self._values()
+        key = (metric, labels)
+        if key in values:
+            values[key][0] += amount
+        else:
+            values[key] = [amount]
+
+    def observe(self, metric, labels, value):
+        values = self._values()
+        key = (metric, labels)
+        state = values.get(key)
+        if state is None:
+            # One count per bucket, the +Inf bucket, then the sum
+            state = values[key] = [0] * (len(metric.buckets) + 2)
+
+        state[bisect_left(metric.buckets, value)] += 1
+        state[-1] += value
+
+    def collect(self):
+        """
+        Return the merged values of every thread by (metric, labels).
+        """
+
+        merged = {}
+        with self._lock:
+            alive = []
+            for thread, values in self._threads:
+                if thread.is_alive():
+                    alive.append((thread, values))
+                else:
+                    _merge(self._retired, values)
+
+            self._threads = alive
+            _merge(merged, self._retired)
+            for _, values in alive:
+                _merge(merged, values)
+
+        return merged
+
+
+def _merge(target, values):
+    for key, state in list(values.items()):
+        current = target.get(key)
+        if current is None:
+            target[key] = list(state)
+        else:
+            for index, value in enumerate(state):
+                current[index] += value
+
+
+def _escape(value):
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('"', '\\"')
+        .replace('\n', '\\n')
+    )
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def render(collected, gauges=()):
+    """
+    Render collected values and (name, kind, help, value) samples in the
+    Prometheus text format.
+    """
+
+    by_metric = {}
+    for (metric, labels), state in collected.items():
+        by_metric.setdefault(metric, []).append((labels, state))
+
+    lines = []
+    for metric, samples in by_metric.items():
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for labels, state in sorted(samples, key=lambda sample: sample[0]):
+            if metric.kind != 'histogram':
+                lines.append(
+                    f'{metric.name}{_labels(metric.labels, labels)} '
+                    f'{state[0]}'
+                )
+                continue
+
+            cumulative = 0
+            bounds = metric.buckets + ('+Inf',)
+            for bound, count in zip(bounds, state):
+                cumulative += count
+                le = _labels(metric.labels, labels, f'le="{bound}"')
+                lines.append(f'{metric.name}_bucket{le} {cumulative}')
+
+            label_text = _labels(metric.labels, labels)
+            lines.append(f'{metric.name}_sum{label_text} {state[-1]}')
+            lines.append(f'{metric.name}_count{label_text} {cumulative}')
+
+    for name, kind, help, value in gauges:
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.append(f'{name} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def _count_bytes(chunks, counted):
+    for chunk in chunks:
+        counted[0] += len(chunk)
+        yield chunk
+
+
+def start_request_metrics():
+    """
+    before_request hook starting the tally of the request.
+    """
+
+    g.metrics_started = perf_counter()
+    g.metrics_outer_tally = current_tally()
+    g.metrics_tally = Tally()
+    _local.tally = g.metrics_tally
+
+
+def finish_response_metrics(response):
+    """
+    after_request hook noting the status and the size of the response.
+    Streamed bodies are counted as they are sent.
+
+    In debug mode the statements run so far and their time are sent in the
+    X-Query-Count and X-Query-Time-Ms headers.
+    """
+
+    g.metrics_status = response.status_code
+    tally = g.get('metrics_tally')
+    if current_app.debug and tally is not None:
+        response.headers['X-Query-Count'] = str(tally.queries)
+        response.headers['X-Query-Time-Ms'] = f'{tally.seconds * 1000:.3f}'
+
+    if response.is_streamed:
+        counted = g.metrics_response_size = [0]
+        response.response = _count_bytes(response.response, counted)
+    else:
+        g.metrics_response_size = [response.calculate_content_length() or 0]
+
+    return response
+
+
+def record_request_metrics(exc=None):
+    """
+    teardown_request hook recording the request, which runs once streamed
+    responses are sent.
+    """
+
+    tally = g.pop('metrics_tally', None)
+    outer = _local.tally = g.pop('metrics_outer_tally', None)
+    if tally is None:
+        return
+
+    if outer is not None:
+        outer.merge(tally)
+
+    rule = request.url_rule
+    route = rule.rule if rule is not None else '<unmatched>'
+    labels = (request.method, route)
+    status = g.get('metrics_status', 500)
+    registry = current_app.extensions['metrics']
+
+    registry.inc(REQUESTS, labels + (str(status),))
+    registry.observe(
+        REQUEST_DURATION, labels, perf_counter() - g.metrics_started
+    )
+    registry.observe(REQUEST_SIZE, labels, request.content_length or 0)
+    registry.observe(
+        RESPONSE_SIZE, labels, g.get('metrics_response_size', [0])[0]
+    )
+    registry.observe(DB_QUERIES, labels, tally.queries)
+    registry.observe(DB_DURATION, labels, tally.seconds)
+    registry.observe(DB_ROWS, labels, tally.rows)
+    if tally.steps:
+        registry.inc(DB_STEPS, labels, tally.steps)
+
+
+def ingest_gauges(stats):
+    """
+    Return the write-behind buffer stats as (name, kind, help, value)
+    samples.
+    """
+
+    return [
+        (
+            'ingest_queue_depth',
+            'gauge',
+            'Readings waiting in the write-behind buffer.',
+            stats['queue_depth'],
+        ),
+        (
+            'ingest_rows_queued_total',
+            'counter',
+            'Readings queued in the write-behind buffer.',
+            stats['rows_queued'],
+        ),
+        (
+            'ingest_rows_rejected_total',
+            'counter',
+            'Readings turned away by a full write-behind buffer.',
+            stats['rows_rejected'],
+        ),
+        (
+            'ingest_rows_flushed_total',
+            'counter',
+            'Buffered readings committed.',
+            stats['rows_flushed'],
+        ),
+        (
+            'ingest_rows_failed_total',
+            'counter',
+            'Buffered readings lost to failed flushes.',
+            stats['rows_failed'],
+        ),
+        (
+            'ingest_flushes_total',
+            'counter',
+            'Group commits of the write-behind buffer.',
+            stats['flushes'],
+        ),
+        (
+            'ingest_flush_errors_total',
+            'counter',
+            'Failed group commits of the write-behind buffer.',
+            stats['flush_errors'],
+        ),
+        (
+            'ingest_flush_seconds_total',
+            'counter',
+            'Time spent in group commits.',
+            stats['flush_latency_total'],
+        ),
+        (
+            'ingest_flush_seconds_max',
+            'gauge',
+            'Longest group commit.',
+            stats['flush_latency_max'],
+        ),
+    ]
+
+
+def cache_gauges(stats):
+    """
+    Return the metric cache stats as (name, kind, help, value) samples.
+    """
+
+    return [
+        (
+            'metric_cache_entries',
+            'gauge',
+            'Responses held by the metric cache.',
+            stats['size'],
+        ),
+        (
+            'metric_cache_hits_total',
+            'counter',
+            'Metric requests served from the cache.',
+            stats['hits'],
+        ),
+        (
+            'metric_cache_misses_total',
+            'counter',
+            'Metric requests computed from the database.',
+            stats['misses'],
+        ),
+        (
+            'metric_cache_evictions_total',
+            'counter',
+            'Least recently used responses evicted from a full cache.',
+            stats['evictions'],
+        ),
+        (
+            'metric_cache_expirations_total',
+            'counter',
+            'Responses of open windows expired after METRIC_CACHE_TTL.',
+            stats['expirations'],
+        ),
+        (
+            'metric_cache_invalidations_total',
+            'counter',
+            'Responses dropped by readings ingested inside their window.',
+            stats['invalidations'],
+        ),
+    ]
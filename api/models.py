@@ -1,13 +1,388 @@
 import time
 
 from api import db
+from api.validators import RESTRICTED_TYPES, RESTRICTED_VALUES
 
 
 class Reading(db.Model):
     __tablename__ = 'readings'
+    __table_args__ = (
+        db.Index(
+            'ix_readings_device_type_date',
+            'device_uuid',
+            'type',
+            'date_created',
+        ),
+        db.Index('ix_readings_device_date', 'device_uuid', 'date_created'),
+        db.Index(
+            'ix_readings_device_type_value',
+            'device_uuid',
+            'type',
+            'value',
+            'date_created',
+        ),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     device_uuid = db.Column(db.String(80), nullable=False)
     type = db.Column(db.String(80), nullable=False)
     value = db.Column(db.Integer, default=0)
     date_created = db.Column(db.Integer, default=int(time.time()))
+
+
+# Width in seconds of the time buckets histograms are kept for
+HISTOGRAM_BUCKET_SECONDS = 3600
+
+
+class ReadingHistogram(db.Model):
+    """
+    Count of readings per value for each device, restricted type and hour.
+
+    Restricted types only take the integer values 0..100, so these counts
+    answer exact medians and quartiles without sorting raw readings. The
+    table is kept up to date by triggers on the readings table and is
+    backfilled from existing readings when it is created.
+    """
+
+    __tablename__ = 'reading_histograms'
+
+    device_uuid = db.Column(db.String(80), primary_key=True)
+    type = db.Column(db.String(80), primary_key=True)
+    bucket = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+def _histogram_params():
+    types = ', '.join(f"'{sensor_type}'" for sensor_type in RESTRICTED_TYPES)
+    return {
+        'types': types,
+        'low': RESTRICTED_VALUES[0],
+        'high': RESTRICTED_VALUES[-1],
+        'width': HISTOGRAM_BUCKET_SECONDS,
+    }
+
+
+def histogram_triggers(table):
+    """
+    Statements creating the triggers that keep the histograms up to date
+    with the readings inserted into and deleted from table.
+    """
+
+    statements = (
+        """
+        CREATE TRIGGER IF NOT EXISTS {table}_histogram_insert
+        AFTER INSERT ON {table}
+        WHEN NEW.type IN ({types})
+            AND NEW.value BETWEEN {low} AND {high}
+        BEGIN
+            INSERT INTO reading_histograms
+                (device_uuid, type, bucket, value, count)
+            VALUES (
+                NEW.device_uuid,
+                NEW.type,
+                (NEW.date_created / {width}) * {width},
+                NEW.value,
+                1
+            )
+            ON CONFLICT (device_uuid, type, bucket, value)
+            DO UPDATE SET count = count + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS {table}_histogram_delete
+        AFTER DELETE ON {table}
+        WHEN OLD.type IN ({types})
+            AND OLD.value BETWEEN {low} AND {high}
+        BEGIN
+            UPDATE reading_histograms SET count = count - 1
+            WHERE device_uuid = OLD.device_uuid
+                AND type = OLD.type
+                AND bucket = (OLD.date_created / {width}) * {width}
+                AND value = OLD.value;
+            DELETE FROM reading_histograms
+            WHERE device_uuid = OLD.device_uuid
+                AND type = OLD.type
+                AND bucket = (OLD.date_created / {width}) * {width}
+                AND value = OLD.value
+                AND count <= 0;
+        END
+        """,
+    )
+
+    params = dict(_histogram_params(), table=table)
+    return [statement.format(**params) for statement in statements]
+
+
+def _histogram_ddl():
+    backfill = """
+        INSERT INTO reading_histograms
+            (device_uuid, type, bucket, value, count)
+        SELECT
+            device_uuid,
+            type,
+            (date_created / {width}) * {width},
+            value,
+            COUNT(*)
+        FROM readings
+        WHERE type IN ({types}) AND value BETWEEN {low} AND {high}
+        GROUP BY 1, 2, 3, 4
+        """.format(**_histogram_params())
+
+    statements = histogram_triggers('readings') + [backfill]
+    return [db.DDL(statement) for statement in statements]
+
+
+# The triggers reference the readings table, so create it first
+ReadingHistogram.__table__.add_is_dependent_on(Reading.__table__)
+for _ddl in _histogram_ddl():
+    db.event.listen(ReadingHistogram.__table__, 'after_create', _ddl)
+
+
+# Width in seconds of the time buckets quantile sketches are kept for
+SKETCH_BUCKET_SECONDS = 3600
+
+
+class ReadingSketch(db.Model):
+    """
+    Serialized quantile sketch of the readings of each device, unrestricted
+    type and hour, maintained on ingest by api.sketches.update_sketches.
+
+    Sketches cannot forget values, so readings deleted individually are
+    still counted until the hour's sketch is dropped.
+    """
+
+    __tablename__ = 'reading_sketches'
+
+    device_uuid = db.Column(db.String(80), primary_key=True)
+    type = db.Column(db.String(80), primary_key=True)
+    bucket = db.Column(db.Integer, primary_key=True)
+    sketch = db.Column(db.LargeBinary, nullable=False)
+
+
+# Widths in seconds of the day, hour and minute rollups, largest first.
+# Each width divides the previous one so rollups nest inside each other.
+ROLLUP_WIDTHS = (86400, 3600, 60)
+
+
+class ReadingRollup(db.Model):
+    """
+    Count, sum, minimum and maximum of the readings of each device and type
+    per day, hour and minute bucket.
+
+    Like the histograms, rollups are kept up to date by triggers on the
+    readings table and backfilled from existing readings when the table is
+    created.
+    """
+
+    __tablename__ = 'reading_rollups'
+
+    device_uuid = db.Column(db.String(80), primary_key=True)
+    type = db.Column(db.String(80), primary_key=True)
+    width = db.Column(db.Integer, primary_key=True)
+    bucket = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    minimum = db.Column(db.Integer)
+    maximum = db.Column(db.Integer)
+
+
+def rollup_triggers(table):
+    """
+    Statements creating the triggers that keep the rollups up to date with
+    the readings inserted into and deleted from table.
+    """
+
+    inserts = []
+    deletes = []
+
+    for width in ROLLUP_WIDTHS:
+        inserts.append(f"""
+            INSERT INTO reading_rollups
+                (device_uuid, type, width, bucket, count, total, minimum,
+                maximum)
+            VALUES (
+                NEW.device_uuid,
+                NEW.type,
+                {width},
+                (NEW.date_created / {width}) * {width},
+                1,
+                NEW.value,
+                NEW.value,
+                NEW.value
+            )
+            ON CONFLICT (device_uuid, type, width, bucket)
+            DO UPDATE SET
+                count = count + 1,
+                total = total + excluded.total,
+                minimum = MIN(minimum, excluded.minimum),
+                maximum = MAX(maximum, excluded.maximum);
+            """)
+
+        # The deleted reading may have been the bucket's minimum or maximum,
+        # so those are recomputed from the readings left in the bucket
+        bucket_readings = f"""
+            FROM {table}
+            WHERE device_uuid = OLD.device_uuid
+                AND type = OLD.type
+                AND date_created >= reading_rollups.bucket
+                AND date_created < reading_rollups.bucket + {width}
+        """
+        deletes.append(f"""
+            UPDATE reading_rollups SET
+                count = count - 1,
+                total = total - OLD.value,
+                minimum = (SELECT MIN(value) {bucket_readings}),
+                maximum = (SELECT MAX(value) {bucket_readings})
+            WHERE device_uuid = OLD.device_uuid
+                AND type = OLD.type
+                AND width = {width}
+                AND bucket = (OLD.date_created / {width}) * {width};
+            DELETE FROM reading_rollups
+            WHERE device_uuid = OLD.device_uuid
+                AND type = OLD.type
+                AND width = {width}
+                AND bucket = (OLD.date_created / {width}) * {width}
+                AND count <= 0;
+            """)
+
+    return [
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_rollup_insert
+        AFTER INSERT ON {table}
+        WHEN NEW.value IS NOT NULL
+        BEGIN
+            {''.join(inserts)}
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_rollup_delete
+        AFTER DELETE ON {table}
+        WHEN OLD.value IS NOT NULL
+        BEGIN
+            {''.join(deletes)}
+        END
+        """,
+    ]
+
+
+def _rollup_ddl():
+    backfills = []
+    for width in ROLLUP_WIDTHS:
+        backfills.append(f"""
+            INSERT INTO reading_rollups
+                (device_uuid, type, width, bucket, count, total, minimum,
+                maximum)
+            SELECT
+                device_uuid,
+                type,
+                {width},
+                (date_created / {width}) * {width},
+                COUNT(*),
+                SUM(value),
+                MIN(value),
+                MAX(value)
+            FROM readings
+            WHERE value IS NOT NULL
+            GROUP BY 1, 2, 4
+            """)
+
+    statements = rollup_triggers('readings') + backfills
+    return [db.DDL(statement) for statement in statements]
+
+
+ReadingRollup.__table__.add_is_dependent_on(Reading.__table__)
+for _ddl in _rollup_ddl():
+    db.event.listen(ReadingRollup.__table__, 'after_create', _ddl)
+
+
+class ReadingMark(db.Model):
+    """
+    Change marker of the readings of each device and type: a version bumped
+    by every reading inserted or deleted, and the time of the last change.
+
+    Versions only grow, so they identify the state of a device's readings
+    for conditional GETs. Like the rollups, marks are kept up to date by
+    triggers on the readings table and backfilled when the table is
+    created.
+    """
+
+    __tablename__ = 'reading_marks'
+
+    device_uuid = db.Column(db.String(80), primary_key=True)
+    type = db.Column(db.String(80), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    modified = db.Column(db.Integer, nullable=False)
+
+
+# Current epoch time in SQL, without the % DDL would take as a parameter
+_NOW = "CAST((julianday('now') - 2440587.5) * 86400 AS INTEGER)"
+
+
+def mark_triggers(table):
+    """
+    Statements creating the triggers that bump the marks of the readings
+    inserted into and deleted from table.
+    """
+
+    return [f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_mark_{event}
+        AFTER {event.upper()} ON {table}
+        BEGIN
+            INSERT INTO reading_marks (device_uuid, type, version, modified)
+            VALUES ({row}.device_uuid, {row}.type, 1, {_NOW})
+            ON CONFLICT (device_uuid, type)
+            DO UPDATE SET version = version + 1, modified = excluded.modified;
+        END
+        """ for event, row in (('insert', 'NEW'), ('delete', 'OLD'))]
+
+
+def _mark_ddl():
+    backfill = f"""
+        INSERT INTO reading_marks (device_uuid, type, version, modified)
+        SELECT device_uuid, type, COUNT(*), {_NOW}
+        FROM readings
+        GROUP BY 1, 2
+        """
+
+    statements = mark_triggers('readings') + [backfill]
+    return [db.DDL(statement) for statement in statements]
+
+
+ReadingMark.__table__.add_is_dependent_on(Reading.__table__)
+for _ddl in _mark_ddl():
+    db.event.listen(ReadingMark.__table__, 'after_create', _ddl)
+
+
+class ReadingSegment(db.Model):
+    """
+    Cold segment file holding the readings of a device and type compacted
+    out of a partition, with the range, count, minimum and maximum of its
+    readings and the highest reading id it holds.
+
+    Segment files are immutable and named uniquely, so the rows of a
+    device can be copied between shards without copying its files.
+    """
+
+    __tablename__ = 'reading_segments'
+    __table_args__ = (
+        db.Index(
+            'ix_reading_segments_device_type_last',
+            'device_uuid',
+            'type',
+            'last',
+        ),
+        db.Index('ix_reading_segments_start', 'start'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    device_uuid = db.Column(db.String(80), nullable=False)
+    type = db.Column(db.String(80), nullable=False)
+    start = db.Column(db.Integer, nullable=False)
+    first = db.Column(db.Integer, nullable=False)
+    last = db.Column(db.Integer, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+    minimum = db.Column(db.Integer, nullable=False)
+    maximum = db.Column(db.Integer, nullable=False)
+    max_id = db.Column(db.Integer, nullable=False)
+    path = db.Column(db.String(255), nullable=False)
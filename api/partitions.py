@@ -0,0 +1,379 @@
+import os
+import time
+from contextlib import suppress
+
+from api import db
+from api.cache import invalidate_range
+from api.cold import cold_readings, segment_path, write_segments
+from api.models import (
+    ROLLUP_WIDTHS,
+    Reading,
+    ReadingHistogram,
+    ReadingMark,
+    ReadingRollup,
+    ReadingSegment,
+    ReadingSketch,
+    histogram_triggers,
+    mark_triggers,
+    rollup_triggers,
+)
+from flask import current_app
+
+PARTITION_TABLE = 'readings_p{}'
+
+# Partition tables are reflected from the readings table on demand and kept
+# apart from the models' metadata, so create_all does not manage them
+_metadata = db.MetaData()
+
+
+def partition_width():
+    """
+    Return PARTITION_SECONDS, 0 when readings are not partitioned.
+
+    Partitions must hold whole day rollups, so that dropping one removes
+    exactly the derived rows of the readings it held.
+    """
+
+    width = current_app.config['PARTITION_SECONDS']
+    if width % max(ROLLUP_WIDTHS):
+        raise ValueError('PARTITION_SECONDS must be a multiple of a day')
+
+    return width
+
+
+def partition_table(start):
+    """
+    Table holding the readings created in [start, start +
+    PARTITION_SECONDS), with the columns and indexes of the readings table.
+    Partitions are named after their integer start, which partition_starts
+    parses back.
+    """
+
+    if isinstance(start, bool) or not isinstance(start, int):
+        raise TypeError('Partition starts must be integers')
+
+    name = PARTITION_TABLE.format(start)
+    readings = Reading.__table__
+    return db.Table(
+        name,
+        _metadata,
+        *(column.copy() for column in readings.columns),
+        *(
+            db.Index(
+                index.name.replace('readings', name, 1),
+                *(column.name for column in index.columns),
+            )
+            for index in readings.indexes
+        ),
+        sqlite_autoincrement=True,
+        keep_existing=True,
+    )
+
+
+def partition_starts():
+    """
+    Return the sorted start times of the partitions of the session's
+    database.
+    """
+
+    names = db.session.execute(
+        "SELECT name FROM sqlite_master "
+        "WHERE type = 'table' AND name GLOB 'readings_p[0-9]*'"
+    )
+    prefix = len(PARTITION_TABLE.format(''))
+    return sorted(int(name[prefix:]) for (name,) in names)
+
+
+def create_partition(start):
+    """
+    Create a partition with the triggers maintaining the histograms,
+    rollups and marks, as part of the caller's transaction.
+
+    Partition ids start at start << 31, so readings of different
+    partitions never share an id and keep their (date_created, id) order.
+    A partition recreated for late readings of a period already compacted
+    starts after the ids of its cold segments.
+    """
+
+    table = partition_table(start)
+    connection = db.session.connection()
+    if table.exists(connection):
+        return table
+
+    table.create(connection)
+
+    triggers = (
+        histogram_triggers(table.name)
+        + rollup_triggers(table.name)
+        + mark_triggers(table.name)
+    )
+    for statement in triggers:
+        db.session.execute(statement)
+
+    compacted = (
+        db.session.query(db.func.max(ReadingSegment.max_id))
+        .filter(ReadingSegment.start == start)
+        .scalar()
+    )
+    db.session.execute(
+        'INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)',
+        {'name': table.name, 'seq': max(start << 31, compacted or 0)},
+    )
+
+    return table
+
+
+def reading_tables():
+    """
+    Return the readings table followed by every partition of the session's
+    database, oldest first.
+    """
+
+    return [Reading.__table__] + [
+        partition_table(start) for start in partition_starts()
+    ]
+
+
+def insert_rows(rows):
+    """
+    Insert readings into the partitions of their date_created, creating
+    the missing ones, or into the readings table when not partitioned.
+    """
+
+    width = partition_width()
+    if not width:
+        db.session.execute(Reading.__table__.insert(), rows)
+        return
+
+    grouped = {}
+    for row in rows:
+        start = row['date_created'] // width * width
+        grouped.setdefault(start, []).append(row)
+
+    existing = set(partition_starts())
+    for start, partition_rows in sorted(grouped.items()):
+        if start in existing:
+            table = partition_table(start)
+        else:
+            table = create_partition(start)
+
+        db.session.execute(table.insert(), partition_rows)
+
+
+def readings_source(
+    start=None,
+    end=None,
+    device_uuids=None,
+    sensor_type=None,
+    ranges=None,
+    page=None,
+    extreme=None,
+):
+    """
+    Return the readings table, the partitions overlapping the inclusive
+    [start, end] range and the cold readings of the range as a single
+    UNION ALL selectable, or None when the readings table alone holds the
+    range.
+
+    SQLite pushes the query's filters down into each arm, so every
+    partition is searched through its own indexes. Only the cold readings
+    of device_uuids, sensor_type and ranges are read when they are given,
+    and only those that can be on the page or among the extreme readings
+    of the query, as explained by cold_readings.
+    """
+
+    width = partition_width()
+    if not width:
+        return None
+
+    start = int(start) if start else None
+    end = int(end) if end else None
+    tables = [
+        partition_table(first)
+        for first in partition_starts()
+        if (start is None or first + width > start)
+        and (end is None or first <= end)
+    ]
+    cold = cold_readings(
+        start, end, device_uuids, sensor_type, ranges, page, extreme
+    )
+    if not tables and cold is None:
+        return None
+
+    # The readings table comes first so that the union's columns correspond
+    # to the Reading model's and queries against it can be adapted, and the
+    # cold readings before the partitions that followed them
+    selects = [db.select([Reading.__table__])]
+    if cold is not None:
+        selects.append(cold)
+
+    selects.extend(db.select([table]) for table in tables)
+
+    return db.union_all(*selects).alias('partitioned_readings')
+
+
+def route_readings(
+    query,
+    start=None,
+    end=None,
+    device_uuids=None,
+    sensor_type=None,
+    ranges=None,
+    page=None,
+    extreme=None,
+):
+    """
+    Point a query against the Reading model at the partitions and cold
+    segments overlapping the inclusive [start, end] range. Must be called
+    before filtering.
+
+    device_uuids, an exactly matched sensor_type and the inclusive
+    (start, end) ranges of [start, end] the query reads narrow the cold
+    segments read, the query must still filter on them. So do the page and
+    extreme of cold_readings, which must match the query's filters,
+    ordering and limit exactly.
+    """
+
+    source = readings_source(
+        start, end, device_uuids, sensor_type, ranges, page, extreme
+    )
+    if source is None:
+        return query
+
+    return query.select_entity_from(source)
+
+
+def drop_partition(start):
+    """
+    Drop a partition with the histograms, sketches and rollups of its
+    range, its cold segments, and any reading of that range still held by
+    the readings table. The marks of its devices and types are bumped,
+    and the cached metrics of its range are dropped.
+    """
+
+    stop = start + partition_width()
+    readings = Reading.__table__
+    db.session.execute(
+        readings.delete().where(
+            readings.c.date_created.between(start, stop - 1)
+        )
+    )
+
+    for model in (ReadingHistogram, ReadingSketch, ReadingRollup):
+        model.query.filter(model.bucket >= start, model.bucket < stop).delete(
+            synchronize_session=False
+        )
+
+    # Dropping the table and segments fires no delete triggers, so the
+    # marks of their devices and types are bumped here
+    table = partition_table(start)
+    exists = table.exists(db.session.connection())
+    segments = ReadingSegment.__table__
+    dropped = db.select([segments.c.device_uuid, segments.c.type]).where(
+        segments.c.start == start
+    )
+    if exists:
+        dropped = dropped.union(db.select([table.c.device_uuid, table.c.type]))
+
+    marks = ReadingMark.__table__
+    db.session.execute(
+        marks.update()
+        .where(db.tuple_(marks.c.device_uuid, marks.c.type).in_(dropped))
+        .values(version=marks.c.version + 1, modified=int(time.time()))
+    )
+
+    paths = [
+        path
+        for (path,) in db.session.query(ReadingSegment.path).filter(
+            ReadingSegment.start == start
+        )
+    ]
+    db.session.execute(segments.delete().where(segments.c.start == start))
+
+    if exists:
+        table.drop(db.session.connection())
+
+    db.session.commit()
+    invalidate_range(start, stop - 1)
+
+    # Segment files are only removed once nothing refers to them, and may
+    # already be gone when a drop is retried
+    for path in paths:
+        with suppress(FileNotFoundError):
+            os.remove(segment_path(path))
+
+
+def drop_expired_partitions(now=None):
+    """
+    Drop every partition whose readings are all older than
+    RETENTION_SECONDS, and return the number of partitions dropped.
+    """
+
+    retention = current_app.config['RETENTION_SECONDS']
+    width = partition_width()
+    if not retention or not width:
+        return 0
+
+    cutoff = (now if now is not None else time.time()) - retention
+    compacted = db.session.query(ReadingSegment.start).distinct()
+    starts = set(partition_starts()) | {start for (start,) in compacted}
+    expired = [start for start in sorted(starts) if start + width <= cutoff]
+    for start in expired:
+        drop_partition(start)
+
+    return len(expired)
+
+
+def compact_partition(start):
+    """
+    Move the readings of a partition to cold segment files, one per device
+    and type, and drop its table.
+
+    The histograms, sketches, rollups and marks of the readings are kept,
+    since the readings are still served from their segments. Segments only
+    hold integer values, so a partition holding any other value is left
+    in place and False is returned.
+    """
+
+    table = partition_table(start)
+    other = db.session.execute(
+        db.select([table.c.id])
+        .where(db.func.typeof(table.c.value) != 'integer')
+        .limit(1)
+    ).scalar()
+    if other is not None:
+        current_app.logger.warning(
+            'Partition %s holds non-integer values and is not compacted',
+            start,
+        )
+        return False
+
+    rows = db.session.execute(
+        db.select([table]).order_by(
+            table.c.device_uuid, table.c.type, table.c.date_created, table.c.id
+        )
+    )
+    segments = write_segments(start, rows)
+    if segments:
+        db.session.execute(ReadingSegment.__table__.insert(), segments)
+
+    table.drop(db.session.connection())
+    db.session.commit()
+    return True
+
+
+def compact_cold_partitions(now=None):
+    """
+    Compact every partition whose readings are all older than
+    COLD_AFTER_SECONDS that only holds integer values, and return the
+    number of partitions compacted.
+    """
+
+    cold_after = current_app.config['COLD_AFTER_SECONDS']
+    width = partition_width()
+    if not cold_after or not width:
+        return 0
+
+    cutoff = (now if now is not None else time.time()) - cold_after
+    cold = [start for start in partition_starts() if start + width <= cutoff]
+    return sum(compact_partition(start) for start in cold)
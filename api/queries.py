@@ -0,0 +1,274 @@
+from itertools import chain, islice
+
+import numpy as np
+from api import db
+from api.helpers import get_positional_summary, get_summary_positions
+from api.models import Reading
+from api.partitions import route_readings
+from api.statistics import summable
+
+# Rows of a summary_query fetched into arrays at a time
+SUMMARY_CHUNK_SIZE = 10000
+
+
+def filter_readings(
+    query, sensor_type=None, start=None, end=None, substring=False
+):
+    """
+    Apply the optional type and date range filters shared by every route.
+
+    The type is matched exactly so that per-device queries become range
+    scans on the (device_uuid, type, date_created) index. Substring
+    matching is kept for clients that opt in, at the cost of that index.
+    """
+
+    if sensor_type:
+        if substring:
+            query = query.filter(Reading.type.like(f'%{sensor_type}%'))
+        else:
+            query = query.filter(Reading.type == sensor_type)
+
+    if start:
+        query = query.filter(Reading.date_created >= int(start))
+
+    if end:
+        query = query.filter(Reading.date_created <= int(end))
+
+    return query
+
+
+def readings_query(
+    device_uuid,
+    sensor_type=None,
+    start=None,
+    end=None,
+    substring=False,
+    page=None,
+    extreme=None,
+):
+    """
+    Return a device's readings of the type and date range. A page or
+    extreme, as taken by cold_readings, must match the query's ordering and
+    limit, and narrows the cold readings to those the query can return.
+    """
+
+    # Cold readings of every type are read for substring matches, which
+    # the page or extreme readings could be taken from
+    if substring and sensor_type:
+        page = extreme = None
+
+    query = route_readings(
+        Reading.query,
+        start,
+        end,
+        [device_uuid],
+        None if substring else sensor_type,
+        page=page,
+        extreme=extreme,
+    )
+    query = query.filter(Reading.device_uuid == device_uuid)
+    return filter_readings(query, sensor_type, start, end, substring)
+
+
+def page_readings(query, after=None, limit=None):
+    """
+    Order readings by (date_created, id) and keep those after the given
+    position, so every page is an index range scan whatever its depth.
+    """
+
+    query = query.order_by(Reading.date_created, Reading.id)
+    if after is not None:
+        position = db.tuple_(Reading.date_created, Reading.id)
+        query = query.filter(position > db.tuple_(*after))
+
+    return query.limit(limit)
+
+
+def extreme_readings_query(
+    device_uuid,
+    sensor_type,
+    start=None,
+    end=None,
+    substring=False,
+    descending=True,
+    k=None,
+):
+    """
+    Order a device's readings by value, highest first unless descending is
+    False, walking the (device_uuid, type, value, date_created) index so
+    that the first rows are found without sorting the window. Only the
+    first k readings are returned when k is given.
+    """
+
+    query = readings_query(
+        device_uuid,
+        sensor_type,
+        start,
+        end,
+        substring,
+        extreme=None if k is None else (k, descending),
+    )
+    if descending:
+        query = query.order_by(
+            Reading.value.desc(), Reading.date_created.desc()
+        )
+    else:
+        query = query.order_by(Reading.value, Reading.date_created)
+
+    return query.limit(k)
+
+
+def sorted_values_query(query):
+    return (
+        query.with_entities(Reading.value)
+        .filter(Reading.value.isnot(None))
+        .order_by(Reading.value)
+    )
+
+
+def values_at_positions(query, positions):
+    """
+    Return the values at the given positions of the query's readings sorted
+    by value, as a dict keyed by position.
+
+    Each run of consecutive positions is fetched with ORDER BY value LIMIT
+    OFFSET, which the (device_uuid, type, value, date_created) index serves
+    without sorting, so only the selected values are returned to Python.
+    """
+
+    values = sorted_values_query(query)
+    picked = {}
+    runs = []
+    for position in sorted(set(positions)):
+        if runs and runs[-1][1] == position:
+            runs[-1][1] += 1
+        else:
+            runs.append([position, position + 1])
+
+    for first, stop in runs:
+        rows = values.offset(first).limit(stop - first)
+        for position, (value,) in enumerate(rows, first):
+            picked[position] = value
+
+    return picked
+
+
+def aggregate_query(
+    func, device_uuid, sensor_type=None, start=None, end=None, substring=False
+):
+    query = route_readings(
+        db.session.query(func(Reading.value)),
+        start,
+        end,
+        [device_uuid],
+        None if substring else sensor_type,
+    )
+    query = query.filter(Reading.device_uuid == device_uuid)
+    return filter_readings(query, sensor_type, start, end, substring)
+
+
+def summary_query(sensor_type=None, start=None, end=None, substring=False):
+    """
+    Stream every matching value ordered by device and value, with the
+    device's number of readings attached to each row, so the summary can be
+    computed in a single pass without holding a device's readings.
+    """
+
+    number_of_readings = db.func.count(Reading.id).over(
+        partition_by=Reading.device_uuid
+    )
+    query = db.session.query(
+        Reading.device_uuid.label('device_uuid'),
+        Reading.value.label('value'),
+        number_of_readings.label('number_of_readings'),
+    )
+    query = route_readings(query, start, end)
+    query = filter_readings(query, sensor_type, start, end, substring)
+    return query.order_by(Reading.device_uuid, Reading.value)
+
+
+def summarize_devices(query, chunk_size=SUMMARY_CHUNK_SIZE):
+    """
+    Consume a summary_query chunk_size rows at a time, yielding tuples of
+    (device_uuid, number_of_readings, max, mean, median, quartiles).
+
+    The values of each chunk are loaded into an array and reduced per run
+    of a device with segment reductions. A device only carries its running
+    total and the handful of values at its median and quartile positions
+    from one chunk to the next, so memory is bounded by the chunk whatever
+    the number of readings of a device.
+    """
+
+    rows = iter(query.yield_per(chunk_size))
+    current = None
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        values = summable([row.value for row in chunk])
+
+        # Split the chunk into runs of a device, the first of which may
+        # continue the device of the previous chunk
+        runs = []
+        position = 0
+        while position < len(chunk):
+            if current is None:
+                first = chunk[position]
+                current = _DeviceSummary(
+                    first.device_uuid, first.number_of_readings
+                )
+
+            stop = min(position + current.count - current.seen, len(chunk))
+            runs.append((current, current.seen, position, stop))
+            current.seen += stop - position
+            if current.seen == current.count:
+                current = None
+
+            position = stop
+
+        starts = [start for _, _, start, _ in runs]
+        totals = np.add.reduceat(values, starts).tolist()
+        for (summary, offset, start, stop), total in zip(runs, totals):
+            summary.add(values[start:stop], offset, total)
+            if summary is not current:
+                yield summary.result()
+
+
+class _DeviceSummary:
+    # Running summary of the sorted values of a device, keeping only the
+    # values get_positional_summary needs
+
+    def __init__(self, device_uuid, count):
+        self.device_uuid = device_uuid
+        self.count = count
+        self.seen = 0
+        self.total = 0
+        self.maximum = None
+        self.wanted = sorted(
+            set(chain.from_iterable(get_summary_positions(count)))
+        )
+        self.picked = {}
+
+    def add(self, values, offset, total):
+        # values are the next values of the device, from position offset
+        positions = [
+            position
+            for position in self.wanted
+            if offset <= position < offset + len(values)
+        ]
+        picked = values[[position - offset for position in positions]]
+        self.picked.update(zip(positions, picked.tolist()))
+        self.total += total
+        self.maximum = values[-1:].tolist()[0]
+
+    def result(self):
+        median, quartiles = get_positional_summary(self.picked, self.count)
+        return (
+            self.device_uuid,
+            self.count,
+            self.maximum,
+            self.total / self.count,
+            median,
+            quartiles,
+        )
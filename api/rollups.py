@@ -0,0 +1,118 @@
+from api import db
+from api.helpers import plan_time_range
+from api.models import ROLLUP_WIDTHS, Reading, ReadingRollup
+from api.partitions import route_readings
+
+
+def rollup_aggregates(device_uuid, sensor_type, start=None, end=None):
+    """
+    Return the (count, total, minimum, maximum) of a device's readings of a
+    type over the inclusive [start, end] range.
+
+    The aligned interior of the range is read from the day, hour and minute
+    rollups, and only the ragged edges below a minute are read from raw
+    readings, so a range of months costs a few hundred rows.
+    """
+
+    aggregates = rollup_aggregates_by_device(
+        [device_uuid], sensor_type, start, end
+    )
+    return aggregates.get(device_uuid, (0, 0, None, None))
+
+
+def rollup_aggregates_by_device(
+    device_uuids, sensor_type, start=None, end=None
+):
+    """
+    Return the (count, total, minimum, maximum) of the readings of a type
+    over the inclusive [start, end] range of each of device_uuids, as
+    rollup_aggregates does, with a query per part of the range for all the
+    devices. Devices without readings are left out.
+    """
+
+    start = int(start) if start else None
+    end = int(end) if end else None
+    segments, edges = plan_time_range(start, end, ROLLUP_WIDTHS)
+    parts = []
+
+    if segments:
+        conditions = []
+        for width, first, stop in segments:
+            condition = [ReadingRollup.width == width]
+            if first is not None:
+                condition.append(ReadingRollup.bucket >= first)
+
+            if stop is not None:
+                condition.append(ReadingRollup.bucket < stop)
+
+            conditions.append(db.and_(*condition))
+
+        parts.append(
+            db.session.query(
+                ReadingRollup.device_uuid,
+                db.func.sum(ReadingRollup.count),
+                db.func.sum(ReadingRollup.total),
+                db.func.min(ReadingRollup.minimum),
+                db.func.max(ReadingRollup.maximum),
+            )
+            .filter(
+                ReadingRollup.device_uuid.in_(device_uuids),
+                ReadingRollup.type == sensor_type,
+                db.or_(*conditions),
+            )
+            .group_by(ReadingRollup.device_uuid)
+        )
+
+    if edges:
+        query = db.session.query(
+            Reading.device_uuid,
+            db.func.count(Reading.value),
+            db.func.sum(Reading.value),
+            db.func.min(Reading.value),
+            db.func.max(Reading.value),
+        )
+        parts.append(
+            route_readings(query, start, end, device_uuids, sensor_type, edges)
+            .filter(
+                Reading.device_uuid.in_(device_uuids),
+                Reading.type == sensor_type,
+                db.or_(
+                    *(
+                        Reading.date_created.between(edge_start, edge_end)
+                        for edge_start, edge_end in edges
+                    )
+                ),
+            )
+            .group_by(Reading.device_uuid)
+        )
+
+    aggregates = {}
+    for part in parts:
+        merge_aggregates(aggregates, part)
+
+    return aggregates
+
+
+def merge_aggregates(aggregates, rows):
+    """
+    Merge rows of (key, count, total, minimum, maximum) into aggregates, a
+    map of each key to its (count, total, minimum, maximum). Rows without
+    readings are skipped.
+    """
+
+    for key, count, total, minimum, maximum in rows:
+        if not count:
+            continue
+
+        previous = aggregates.get(key, (0, 0, None, None))
+        aggregates[key] = (
+            previous[0] + count,
+            previous[1] + (total or 0),
+            _extreme(min, previous[2], minimum),
+            _extreme(max, previous[3], maximum),
+        )
+
+
+def _extreme(func, *values):
+    values = [value for value in values if value is not None]
+    return func(values) if values else None
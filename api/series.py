@@ -0,0 +1,112 @@
+from api import db
+from api.helpers import downsample_lttb, split_time_range
+from api.models import ROLLUP_WIDTHS, Reading, ReadingRollup
+from api.partitions import route_readings
+from api.queries import aggregate_query, filter_readings, readings_query
+from api.rollups import merge_aggregates
+
+# Aggregates of the bucketed series, from the (count, total, minimum,
+# maximum) of each bucket
+SERIES_AGGREGATES = {
+    'count': lambda count, total, minimum, maximum: count,
+    'sum': lambda count, total, minimum, maximum: total,
+    'mean': lambda count, total, minimum, maximum: total / count,
+    'min': lambda count, total, minimum, maximum: minimum,
+    'max': lambda count, total, minimum, maximum: maximum,
+}
+
+
+def bucket_series(
+    device_uuid, sensor_type, interval, start=None, end=None, substring=False
+):
+    """
+    Return the (bucket, count, total, minimum, maximum) of a device's
+    readings of a type per bucket of interval seconds aligned on the
+    epoch, over the inclusive [start, end] range, sorted by bucket. Buckets
+    without readings are left out.
+
+    When interval is a multiple of a rollup width the buckets whole inside
+    the range are grouped from those rollups, and only the ragged edges
+    from raw readings.
+    """
+
+    start = int(start) if start else None
+    end = int(end) if end else None
+    widths = [width for width in ROLLUP_WIDTHS if interval % width == 0]
+    if substring or not widths:
+        interior, edges = None, [(start, end)]
+    else:
+        interior, edges = split_time_range(start, end, widths[0])
+
+    buckets = {}
+
+    if interior is not None:
+        first, stop = interior
+        bucket = ReadingRollup.bucket / interval * interval
+        query = db.session.query(
+            bucket,
+            db.func.sum(ReadingRollup.count),
+            db.func.sum(ReadingRollup.total),
+            db.func.min(ReadingRollup.minimum),
+            db.func.max(ReadingRollup.maximum),
+        ).filter(
+            ReadingRollup.device_uuid == device_uuid,
+            ReadingRollup.type == sensor_type,
+            ReadingRollup.width == widths[0],
+        )
+
+        if first is not None:
+            query = query.filter(ReadingRollup.bucket >= first)
+
+        if stop is not None:
+            query = query.filter(ReadingRollup.bucket < stop)
+
+        merge_aggregates(buckets, query.group_by(bucket))
+
+    for edge_start, edge_end in edges:
+        bucket = Reading.date_created / interval * interval
+        query = db.session.query(
+            bucket,
+            db.func.count(Reading.value),
+            db.func.sum(Reading.value),
+            db.func.min(Reading.value),
+            db.func.max(Reading.value),
+        )
+        query = route_readings(
+            query,
+            edge_start,
+            edge_end,
+            [device_uuid],
+            None if substring else sensor_type,
+        ).filter(Reading.device_uuid == device_uuid)
+        query = filter_readings(
+            query, sensor_type, edge_start, edge_end, substring
+        )
+        merge_aggregates(buckets, query.group_by(bucket))
+
+    return [(bucket,) + buckets[bucket] for bucket in sorted(buckets)]
+
+
+def lttb_series(
+    device_uuid, sensor_type, points, start=None, end=None, substring=False
+):
+    """
+    Return at most points (date_created, value) pairs of a device's readings
+    of a type over the inclusive [start, end] range, picked by
+    Largest-Triangle-Three-Buckets downsampling so the shape of the series
+    is kept. The readings are streamed in date order rather than loaded.
+    """
+
+    count = aggregate_query(
+        db.func.count, device_uuid, sensor_type, start, end, substring
+    ).scalar()
+    readings = (
+        readings_query(device_uuid, sensor_type, start, end, substring)
+        .with_entities(Reading.date_created, Reading.value)
+        .order_by(Reading.date_created, Reading.id)
+    )
+    return downsample_lttb(
+        (tuple(reading) for reading in readings.yield_per(1000)),
+        count,
+        points,
+    )
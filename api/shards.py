@@ -0,0 +1,249 @@
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from api import db
+from api.metrics import Tally, current_tally, use_tally
+from api.models import (
+    Reading,
+    ReadingHistogram,
+    ReadingRollup,
+    ReadingSegment,
+    ReadingSketch,
+)
+from api.partitions import insert_rows, reading_tables, route_readings
+from api.storage import shard_binds
+from flask import current_app, g, has_request_context, request
+
+# Readings copied per statement when a device moves between shards
+MOVE_CHUNK_SIZE = 10000
+
+# Tables of a device copied whole when it moves between shards
+DEVICE_TABLES = (
+    ReadingHistogram.__table__,
+    ReadingRollup.__table__,
+    ReadingSketch.__table__,
+    ReadingSegment.__table__,
+)
+
+
+def jump_hash(key, buckets):
+    """
+    Jump consistent hash of a 64 bit key into one of buckets buckets.
+
+    Growing from n to n + 1 buckets only moves the keys that land in the
+    new bucket, about 1 / (n + 1) of them, and shrinking only moves the
+    keys of the removed bucket.
+    """
+
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+
+    return bucket
+
+
+def shard_index(device_uuid, shard_count):
+    digest = hashlib.blake2b(device_uuid.encode(), digest_size=8).digest()
+    return jump_hash(int.from_bytes(digest, 'little'), shard_count)
+
+
+def shard_bind(device_uuid, app=None):
+    """
+    Return the bind key of the shard holding a device, None when the
+    readings are not sharded.
+    """
+
+    app = app or current_app
+    binds = shard_binds(app)
+    if binds == [None]:
+        return None
+
+    return binds[shard_index(device_uuid, len(binds))]
+
+
+@contextmanager
+def use_shard(bind):
+    """
+    Route the statements of the current app context to a shard.
+    """
+
+    previous = g.get('shard')
+    g.shard = bind
+    try:
+        yield
+    finally:
+        g.shard = previous
+
+
+def bind_request_shard():
+    """
+    Route the statements of a per-device request to the device's shard.
+    """
+
+    device_uuid = (request.view_args or {}).get('device_uuid')
+    if device_uuid is not None:
+        g.shard = shard_bind(device_uuid)
+
+
+def group_by_shard(rows):
+    grouped = {}
+    for row in rows:
+        bind = shard_bind(row['device_uuid'])
+        grouped.setdefault(bind, []).append(row)
+
+    return grouped
+
+
+def fan_out(func):
+    """
+    Call func once per shard, in parallel threads each with its own app
+    context routed to the shard, and return the results in shard order.
+    """
+
+    app = current_app._get_current_object()
+    binds = shard_binds(app)
+    if binds == [None]:
+        return [func()]
+
+    read_only = g.get(
+        'read_only', has_request_context() and request.method == 'GET'
+    )
+
+    def run(bind):
+        with app.app_context(), use_tally(Tally()) as tally:
+            g.shard = bind
+            g.read_only = read_only
+            return func(), tally
+
+    with ThreadPoolExecutor(len(binds), 'shard-fan-out') as executor:
+        results = list(executor.map(run, binds))
+
+    # Count the database work of the shards into the calling request
+    tally = current_tally()
+    if tally is not None:
+        for _, shard_tally in results:
+            tally.merge(shard_tally)
+
+    return [result for result, _ in results]
+
+
+def move_device(device_uuid, source, target):
+    """
+    Copy the readings, histograms, rollups, sketches and cold segments of a
+    device from the source shard to the target shard, then delete them
+    from the source.
+
+    The histograms and rollups the triggers of the readings tables build on
+    the target miss the cold readings, so they are replaced by those of the
+    source. Segment files are shared by the shards, so only their rows are
+    copied. Readings already copied to the target by an interrupted move
+    are replaced, so a move can be retried.
+    """
+
+    with use_shard(target):
+        _delete_device(device_uuid)
+        db.session.commit()
+
+    with use_shard(source):
+        tables = reading_tables()
+
+    for table in tables:
+        columns = [column for column in table.columns if column.name != 'id']
+        last_id = 0
+        while True:
+            with use_shard(source):
+                rows = db.session.execute(
+                    db.select([table.c.id] + columns)
+                    .where(table.c.device_uuid == device_uuid)
+                    .where(table.c.id > last_id)
+                    .order_by(table.c.id)
+                    .limit(MOVE_CHUNK_SIZE)
+                ).fetchall()
+
+            if not rows:
+                break
+
+            last_id = rows[-1].id
+            with use_shard(target):
+                insert_rows(
+                    [
+                        {column.name: row[column.name] for column in columns}
+                        for row in rows
+                    ]
+                )
+                db.session.commit()
+
+    for table in DEVICE_TABLES:
+        with use_shard(source):
+            stored = db.session.execute(
+                table.select().where(table.c.device_uuid == device_uuid)
+            ).fetchall()
+
+        with use_shard(target):
+            db.session.execute(
+                table.delete().where(table.c.device_uuid == device_uuid)
+            )
+            # Segment ids are only unique within a shard
+            if stored:
+                db.session.execute(
+                    table.insert(),
+                    [
+                        {
+                            name: row[name]
+                            for name in row.keys()
+                            if name != 'id'
+                        }
+                        for row in stored
+                    ],
+                )
+
+            db.session.commit()
+
+    with use_shard(source):
+        _delete_device(device_uuid)
+        db.session.commit()
+
+
+def _delete_device(device_uuid):
+    for table in reading_tables():
+        db.session.execute(
+            table.delete().where(table.c.device_uuid == device_uuid)
+        )
+
+    for table in DEVICE_TABLES:
+        db.session.execute(
+            table.delete().where(table.c.device_uuid == device_uuid)
+        )
+
+
+def rebalance_shards(previous_count):
+    """
+    Move every device whose shard changed since SHARD_COUNT was
+    previous_count, and return the number of devices moved.
+
+    Devices are read from their new shard as soon as SHARD_COUNT changes,
+    so ingest should be stopped until the rebalance completes.
+    """
+
+    db.create_all()
+
+    moved = 0
+    for source in shard_binds(current_app, previous_count):
+        with use_shard(source):
+            query = route_readings(db.session.query(Reading.device_uuid))
+            compacted = db.session.query(ReadingSegment.device_uuid)
+            devices = [
+                device_uuid
+                for (device_uuid,) in query.union(compacted).distinct()
+            ]
+
+        for device_uuid in devices:
+            target = shard_bind(device_uuid)
+            if target != source:
+                move_device(device_uuid, source, target)
+                moved += 1
+
+    return moved
@@ -0,0 +1,294 @@
+import math
+import random
+import struct
+
+from api import db
+from api.helpers import (
+    get_positional_summary,
+    get_summary_positions,
+    split_time_range,
+)
+from api.models import SKETCH_BUCKET_SECONDS, Reading, ReadingSketch
+from api.partitions import route_readings
+from api.validators import RESTRICTED_TYPES
+
+# Largest compactor size. With k=200 the rank of a value estimated by a
+# sketch is within about 1.65% of the number of readings from its true
+# rank with 99% confidence, however many sketches were merged into it.
+SKETCH_K = 200
+
+# Devices whose stored sketches are loaded per query on ingest, within
+# SQLite's limit of bound parameters
+SKETCH_LOAD_CHUNK_SIZE = 500
+
+_HEADER = struct.Struct('<HQB')
+_LEVEL = struct.Struct('<I')
+_ITEM = struct.Struct('<q')
+
+
+class QuantileSketch:
+    """
+    KLL quantile sketch over integer readings.
+
+    Items at level i stand for 2**i readings. When a level grows past its
+    capacity it is sorted and every other item is promoted to the level
+    above, which keeps the sketch O(k) in size. Sketches of different hours
+    merge by concatenating their levels and compacting again, so a range is
+    answered by merging the sketches of the hours it covers. Estimates are
+    always values that were actually ingested.
+    """
+
+    def __init__(self, k=SKETCH_K, count=0, levels=None):
+        self.k = k
+        self.count = count
+        self.levels = levels or [[]]
+        self._random = random.Random(count)
+
+    @classmethod
+    def from_bytes(cls, data):
+        k, count, depth = _HEADER.unpack_from(data)
+        offset = _HEADER.size
+        sizes = []
+        for _ in range(depth):
+            sizes.append(_LEVEL.unpack_from(data, offset)[0])
+            offset += _LEVEL.size
+
+        levels = []
+        for size in sizes:
+            items = struct.unpack_from(f'<{size}q', data, offset)
+            levels.append(list(items))
+            offset += size * _ITEM.size
+
+        return cls(k, count, levels)
+
+    def to_bytes(self):
+        sizes = [len(level) for level in self.levels]
+        items = [item for level in self.levels for item in level]
+        return b''.join(
+            (
+                _HEADER.pack(self.k, self.count, len(self.levels)),
+                struct.pack(f'<{len(sizes)}I', *sizes),
+                struct.pack(f'<{len(items)}q', *items),
+            )
+        )
+
+    def update(self, value):
+        self.levels[0].append(value)
+        self.count += 1
+        self._compress()
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+
+        for level, items in enumerate(other.levels):
+            self.levels[level].extend(items)
+
+        self.count += other.count
+        self._compress()
+
+    def get_values_at(self, positions):
+        """
+        Estimate the values at the given ranks of the sorted readings.
+        """
+
+        weighted = sorted(
+            (item, 1 << level)
+            for level, items in enumerate(self.levels)
+            for item in items
+        )
+        if not weighted:
+            return {}
+
+        # Compaction preserves weight, so ranks add up to self.count
+        wanted = sorted(positions)
+        picked = {}
+        rank = 0
+        for item, weight in weighted:
+            rank += weight
+            while wanted and wanted[0] < rank:
+                picked[wanted.pop(0)] = item
+
+        for position in wanted:
+            picked[position] = weighted[-1][0]
+
+        return picked
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(int(math.ceil(self.k * (2 / 3) ** depth)), 2)
+
+    def _compress(self):
+        while sum(map(len, self.levels)) > sum(
+            self._capacity(level) for level in range(len(self.levels))
+        ):
+            for level, items in enumerate(self.levels):
+                if len(items) >= self._capacity(level):
+                    break
+
+            if level + 1 == len(self.levels):
+                self.levels.append([])
+
+            items.sort()
+            kept = [items.pop()] if len(items) % 2 else []
+            offset = self._random.getrandbits(1)
+            self.levels[level + 1].extend(items[offset::2])
+            self.levels[level] = kept
+
+
+def uses_sketches(sensor_type, substring=False):
+    """
+    Sketches are kept for the types histograms cannot cover, matched
+    exactly.
+    """
+
+    return (
+        bool(sensor_type)
+        and not substring
+        and sensor_type not in RESTRICTED_TYPES
+    )
+
+
+def update_sketches(rows):
+    """
+    Fold newly inserted rows into the hourly sketches of their device and
+    type, as part of the caller's transaction.
+    """
+
+    grouped = {}
+    for row in rows:
+        if not uses_sketches(row['type']):
+            continue
+
+        bucket = row['date_created'] // SKETCH_BUCKET_SECONDS
+        bucket *= SKETCH_BUCKET_SECONDS
+        key = (row['device_uuid'], row['type'], bucket)
+        grouped.setdefault(key, []).append(row['value'])
+
+    if not grouped:
+        return
+
+    sketches = ReadingSketch.__table__
+    stored = {}
+    devices = sorted({key[0] for key in grouped})
+    buckets = [key[2] for key in grouped]
+
+    # Load the stored sketches of every key in a query per chunk of
+    # devices, rather than one per key
+    for index in range(0, len(devices), SKETCH_LOAD_CHUNK_SIZE):
+        chunk = devices[index : index + SKETCH_LOAD_CHUNK_SIZE]
+        rows = db.session.execute(
+            sketches.select().where(
+                db.and_(
+                    sketches.c.device_uuid.in_(chunk),
+                    sketches.c.bucket.between(min(buckets), max(buckets)),
+                )
+            )
+        )
+        for row in rows:
+            key = (row.device_uuid, row.type, row.bucket)
+            if key in grouped:
+                stored[key] = row.sketch
+
+    inserts = []
+    updates = []
+    for key, values in grouped.items():
+        if key in stored:
+            sketch = QuantileSketch.from_bytes(stored[key])
+        else:
+            sketch = QuantileSketch()
+
+        for value in values:
+            sketch.update(value)
+
+        row = {
+            'key_device_uuid': key[0],
+            'key_type': key[1],
+            'key_bucket': key[2],
+            'sketch': sketch.to_bytes(),
+        }
+        (updates if key in stored else inserts).append(row)
+
+    if inserts:
+        db.session.execute(
+            sketches.insert().values(
+                device_uuid=db.bindparam('key_device_uuid'),
+                type=db.bindparam('key_type'),
+                bucket=db.bindparam('key_bucket'),
+            ),
+            inserts,
+        )
+
+    if updates:
+        db.session.execute(
+            sketches.update().where(
+                db.and_(
+                    sketches.c.device_uuid == db.bindparam('key_device_uuid'),
+                    sketches.c.type == db.bindparam('key_type'),
+                    sketches.c.bucket == db.bindparam('key_bucket'),
+                )
+            ),
+            updates,
+        )
+
+
+def merged_sketch(device_uuid, sensor_type, start=None, end=None):
+    """
+    Merge the hourly sketches covering the inclusive [start, end] range,
+    folding in the raw readings of the ragged edges.
+    """
+
+    start = int(start) if start else None
+    end = int(end) if end else None
+    interior, edges = split_time_range(start, end, SKETCH_BUCKET_SECONDS)
+    sketch = QuantileSketch()
+
+    if interior is not None:
+        first, stop = interior
+        query = ReadingSketch.query.filter(
+            ReadingSketch.device_uuid == device_uuid,
+            ReadingSketch.type == sensor_type,
+        )
+
+        if first is not None:
+            query = query.filter(ReadingSketch.bucket >= first)
+
+        if stop is not None:
+            query = query.filter(ReadingSketch.bucket < stop)
+
+        for stored in query:
+            sketch.merge(QuantileSketch.from_bytes(stored.sketch))
+
+    if edges:
+        values = db.session.query(Reading.value)
+        values = route_readings(
+            values, start, end, [device_uuid], sensor_type, edges
+        ).filter(
+            Reading.device_uuid == device_uuid,
+            Reading.type == sensor_type,
+            db.or_(
+                *(
+                    Reading.date_created.between(edge_start, edge_end)
+                    for edge_start, edge_end in edges
+                )
+            ),
+        )
+
+        for (value,) in values:
+            sketch.update(value)
+
+    return sketch
+
+
+def get_sketch_summary(sketch):
+    """
+    Estimate the median and quartiles summarized by a sketch, with the
+    same definitions as get_median and get_quartiles.
+    """
+
+    positions = set()
+    for group in get_summary_positions(sketch.count):
+        positions.update(group)
+
+    picked = sketch.get_values_at(positions)
+    return get_positional_summary(picked, sketch.count)
@@ -0,0 +1,17 @@
+import numpy as np
+
+
+def summable(values):
+    """
+    Return an array of values that can be summed exactly: integers are
+    kept as int64 while no sum of them can overflow, and are held as Python
+    ints otherwise. Other values keep their type.
+    """
+
+    values = np.asarray(values)
+    if values.dtype.kind == 'i' and len(values):
+        limit = np.iinfo(np.int64).max // len(values)
+        if values.min() < -limit or values.max() > limit:
+            return values.astype(object)
+
+    return values
@@ -0,0 +1,232 @@
+import weakref
+
+from api.metrics import MeteredConnection, listen_queries
+from flask import g, has_app_context, has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.pool import QueuePool
+
+
+def _on_connect(pragmas):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+        cursor.close()
+
+    return set_pragmas
+
+
+def _create_functions(dbapi_connection, connection_record):
+    # Imported on connect since api.cold needs the app's database
+    from api.cold import SEGMENT_FUNCTIONS
+
+    for name, function in SEGMENT_FUNCTIONS.items():
+        dbapi_connection.create_function(name, 2, function, deterministic=True)
+
+
+# Bind keys of the shard databases in SQLALCHEMY_BINDS
+SHARD_BIND = 'shard_{}'
+
+
+def shard_binds(app, shard_count=None):
+    """
+    Return the bind key of each of the shard_count shards, SHARD_COUNT by
+    default, registering their SHARD_DATABASE_URI in SQLALCHEMY_BINDS.
+    An unsharded layout is the single default bind, None.
+    """
+
+    if shard_count is None:
+        shard_count = app.config['SHARD_COUNT']
+
+    if not shard_count:
+        return [None]
+
+    binds = dict(app.config['SQLALCHEMY_BINDS'] or {})
+    keys = []
+    for shard in range(shard_count):
+        key = SHARD_BIND.format(shard)
+        uri = app.config['SHARD_DATABASE_URI'].format(shard=shard)
+        binds.setdefault(key, uri)
+        keys.append(key)
+
+    if len(binds) != len(app.config['SQLALCHEMY_BINDS'] or {}):
+        app.config['SQLALCHEMY_BINDS'] = binds
+
+    return keys
+
+
+def _is_shard(bind):
+    return bind is not None and bind.startswith(SHARD_BIND.format(''))
+
+
+def _reads_only():
+    if 'read_only' in g:
+        return g.read_only
+
+    return has_request_context() and request.method == 'GET'
+
+
+def _is_sqlite_file(url):
+    return url.drivername == 'sqlite' and url.database not in (
+        None,
+        '',
+        ':memory:',
+    )
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session that sends statements to the shard bound to g.shard, and the
+    reads of GET requests to the read-only pool of that database when one
+    is configured. Flushes, and every statement outside a GET request, go
+    through the writer engine.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        shard = g.get('shard') if has_app_context() else None
+        if shard is not None:
+            engine = self.db.get_engine(self.app, shard)
+        else:
+            engine = super().get_bind(mapper, clause)
+
+        if not self._flushing and has_app_context() and _reads_only():
+            reader = self.db.get_reader(self.app, engine)
+            if reader is not None:
+                return reader
+
+        return engine
+
+
+class Database(SQLAlchemy):
+    """
+    SQLAlchemy integration with the SQLite storage profile of the config.
+
+    Every new SQLite connection runs the SQLITE_PRAGMAS of the config,
+    registers the functions reading cold segments and meters its cursors
+    for the request metrics, and every engine counts
+    and logs the slow statements of requests.
+    With SQLITE_SINGLE_WRITER the writer engine holds a single connection,
+    so concurrent writers queue in the pool instead of failing with
+    database is locked. A SQLITE_READ_POOL_SIZE above 0 adds a separate
+    pool of query_only connections for GET requests, which with WAL read a
+    consistent snapshot while the writer commits.
+
+    Shard binds hold the same tables as the default database, so create_all
+    and drop_all cover every shard of SHARD_COUNT.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._configured_engines = weakref.WeakSet()
+
+    def get_tables_for_bind(self, bind=None):
+        if _is_shard(bind):
+            bind = None
+
+        return super().get_tables_for_bind(bind)
+
+    def get_binds(self, app=None):
+        # Shards are picked per statement by RoutingSession, the session
+        # maps tables to the default database
+        app = self.get_app(app)
+        binds = [None] + [
+            bind
+            for bind in app.config['SQLALCHEMY_BINDS'] or ()
+            if not _is_shard(bind)
+        ]
+
+        tables = {}
+        for bind in binds:
+            engine = self.get_engine(app, bind)
+            for table in self.get_tables_for_bind(bind):
+                tables[table] = engine
+
+        return tables
+
+    def create_all(self, bind='__all__', app=None):
+        shard_binds(self.get_app(app))
+        super().create_all(bind, app)
+
+    def drop_all(self, bind='__all__', app=None):
+        shard_binds(self.get_app(app))
+        super().drop_all(bind, app)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super().apply_driver_hacks(app, sa_url, options)
+
+        if sa_url.drivername == 'sqlite':
+            options.setdefault('connect_args', {})
+            options['connect_args']['factory'] = MeteredConnection
+
+        if _is_sqlite_file(sa_url) and app.config['SQLITE_SINGLE_WRITER']:
+            options['poolclass'] = QueuePool
+            options['pool_size'] = 1
+            options['max_overflow'] = 0
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+
+    def get_engine(self, app=None, bind=None):
+        engine = super().get_engine(app, bind)
+        if engine not in self._configured_engines:
+            app = self.get_app(app)
+            if engine.dialect.name == 'sqlite':
+                pragmas = app.config['SQLITE_PRAGMAS']
+                event.listen(engine, 'connect', _on_connect(pragmas))
+                event.listen(engine, 'connect', _create_functions)
+
+            listen_queries(engine, app)
+
+            self._configured_engines.add(engine)
+
+        return engine
+
+    def get_reader(self, app, engine=None):
+        """
+        Return the engine of the read-only pool for the database of engine,
+        the app's default by default, or None when it is disabled or the
+        database is not a SQLite file.
+        """
+
+        pool_size = app.config['SQLITE_READ_POOL_SIZE']
+        if not pool_size:
+            return None
+
+        url = (engine or self.get_engine(app)).url
+        if not _is_sqlite_file(url):
+            return None
+
+        readers = app.extensions.setdefault('sqlite_readers', {})
+        reader = readers.get(str(url))
+        if reader is None:
+            # WAL mode is a property of the file, set by the writer
+            pragmas = {
+                name: value
+                for name, value in app.config['SQLITE_PRAGMAS'].items()
+                if name != 'journal_mode'
+            }
+            pragmas['query_only'] = 'ON'
+
+            reader = create_engine(
+                url,
+                poolclass=QueuePool,
+                pool_size=pool_size,
+                max_overflow=0,
+                connect_args={
+                    'check_same_thread': False,
+                    'factory': MeteredConnection,
+                },
+            )
+            event.listen(reader, 'connect', _on_connect(pragmas))
+            event.listen(reader, 'connect', _create_functions)
+            listen_queries(reader, app)
+            reader = readers.setdefault(str(url), reader)
+
+        return reader
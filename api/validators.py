@@ -1,6 +1,29 @@
+RESTRICTED_TYPES = ('temperature', 'humidity')
+RESTRICTED_VALUES = range(0, 101)
+
+# Values are stored as 64 bit integers, which the quantile sketches and cold
+# segments pack them as
+INTEGER_VALUES = range(-(2**63), 2**63)
+
+
 def validate_sensor_value(sensor_type, value):
-    restricted_types = ['temperature', 'humidity']
-    if sensor_type in restricted_types:
-        return True if value in range(0, 101) else False
+    if isinstance(value, bool) or not isinstance(value, int):
+        return False
+
+    if sensor_type in RESTRICTED_TYPES:
+        return True if value in RESTRICTED_VALUES else False
+
+    return value in INTEGER_VALUES
+
+
+def validate_name(name):
+    # device_uuid and type are non-empty strings
+    return isinstance(name, str) and name != ''
+
+
+def validate_date(date_created):
+    # Epoch seconds, stored as 64 bit integers like values
+    if isinstance(date_created, bool) or not isinstance(date_created, int):
+        return False
 
-    return True
+    return date_created in INTEGER_VALUES
@@ -0,0 +1,13 @@
+from api import db
+from api.asgi import create_ingest_app
+
+ingest = create_ingest_app()
+with ingest.app.app_context():
+    # create all tables
+    db.create_all()
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(ingest)
@@ -0,0 +1,89 @@
+"""
+Compare the cost per device of the max, mean, median and quartiles of many
+devices from the single device routes, a request per device and metric,
+with a single request to the batch metrics route.
+
+Usage: python benchmarks/batch_metrics.py [--devices 500] [--readings 200]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api import create_app, db  # noqa: E402
+from api.ingest import insert_readings  # noqa: E402
+
+METRICS = ('max', 'mean', 'median', 'quartiles')
+
+
+def seed(devices, readings):
+    generator = random.Random(0)
+    for device in range(devices):
+        insert_readings(
+            [
+                {
+                    'device_uuid': f'device_{device}',
+                    'type': sensor_type,
+                    'value': generator.randint(1, 100),
+                    'date_created': 1000 + index * 60,
+                }
+                for sensor_type in ('temperature', 'pressure')
+                for index in range(readings)
+            ]
+        )
+
+
+def single_routes(client, devices, query):
+    for device in range(devices):
+        for metric in METRICS:
+            client.get(f'/devices/device_{device}/readings/{metric}?{query}')
+
+
+def batch_route(client, devices, query):
+    uuids = ','.join(f'device_{device}' for device in range(devices))
+    client.get(f'/devices/readings/metrics?devices={uuids}&{query}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--devices', type=int, default=500)
+    parser.add_argument('--readings', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app('production')
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(
+            directory, 'benchmark.db'
+        )
+        # Every request must reach the database
+        app.extensions.pop('metric_cache', None)
+        client = app.test_client()
+
+        with app.app_context():
+            db.create_all()
+            print(f'Seeding {args.devices} devices...', file=sys.stderr)
+            seed(args.devices, args.readings)
+
+        end = 1000 + args.readings * 60
+        print(f'{"case":<28}{"total (s)":>12}{"per device (ms)":>18}')
+        for sensor_type in ('temperature', 'pressure'):
+            query = f'type={sensor_type}&start=1000&end={end}'
+            for name, function in (
+                ('single routes', single_routes),
+                ('batch route', batch_route),
+            ):
+                started = time.perf_counter()
+                function(client, args.devices, query)
+                elapsed = time.perf_counter() - started
+                per_device = elapsed / args.devices * 1000
+                name = f'{sensor_type}, {name}'
+                print(f'{name:<28}{elapsed:>12.3f}{per_device:>18.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Measure how the fleet summary scales with the number of cold segments it
+reads, against the same readings left hot in their partitions. Each device
+is compacted to a segment per day, so the cost per reading of the cold
+summary should stay flat as devices are added.
+
+Usage: python benchmarks/cold_scaling.py [--devices 500,1000,2000,4000]
+    [--readings 20]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api import create_app, db  # noqa: E402
+from api.ingest import insert_readings  # noqa: E402
+from api.partitions import compact_cold_partitions  # noqa: E402
+
+DAY = 86400
+FIRST_DAY = DAY * 20000
+
+
+def seed(devices, readings):
+    # readings per device spread over two days, to compact, and a third day
+    # left hot
+    generator = random.Random(0)
+    insert_readings(
+        [
+            {
+                'device_uuid': f'device_{device}',
+                'type': 'pressure',
+                'value': generator.randint(1, 100000),
+                'date_created': FIRST_DAY + index * 3 * DAY // readings,
+            }
+            for device in range(devices)
+            for index in range(readings)
+        ]
+    )
+
+
+def summary(client):
+    started = time.perf_counter()
+    request = client.get(f'/devices/readings?end={FIRST_DAY + 2 * DAY - 1}')
+    assert request.status_code == 200, request.status_code
+    return time.perf_counter() - started
+
+
+def measure(devices, readings, cold):
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app('testing')
+        app.config.update(
+            SQLALCHEMY_DATABASE_URI='sqlite:///'
+            + os.path.join(directory, 'cold.db'),
+            COLD_SEGMENT_DIRECTORY=os.path.join(directory, 'segments'),
+            PARTITION_SECONDS=DAY,
+            COLD_AFTER_SECONDS=DAY,
+            SLOW_QUERY_SECONDS=0,
+        )
+        app.extensions.pop('metric_cache')
+        client = app.test_client()
+
+        with app.app_context():
+            db.create_all()
+            seed(devices, readings)
+            if cold:
+                compact_cold_partitions(now=FIRST_DAY + 3 * DAY + 1)
+
+            # Best of three, the first warming the mapped segments
+            return min(summary(client) for _ in range(3))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--devices',
+        type=lambda value: [int(count) for count in value.split(',')],
+        default='500,1000,2000,4000',
+    )
+    parser.add_argument('--readings', type=int, default=20)
+    args = parser.parse_args()
+
+    print(
+        f'{"devices":>8}{"hot (s)":>10}{"cold (s)":>10}'
+        f'{"hot us/reading":>16}{"cold us/reading":>17}'
+    )
+    for devices in args.devices:
+        # Two thirds of the readings are in the summarized days
+        count = devices * args.readings * 2 // 3
+        hot = measure(devices, args.readings, cold=False)
+        cold = measure(devices, args.readings, cold=True)
+        print(
+            f'{devices:>8}{hot:>10.3f}{cold:>10.3f}'
+            f'{hot / count * 1e6:>16.2f}{cold / count * 1e6:>17.2f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
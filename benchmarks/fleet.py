@@ -0,0 +1,385 @@
+"""
+Seed a synthetic fleet of devices and drive ingest and every GET route
+with concurrent clients, reporting the throughput and p50/p95/p99 latency
+of every route and the peak RSS of the run to a JSON results file.
+
+Usage: python benchmarks/fleet.py [--devices 1000]
+    [--readings-per-device 100] [--types temperature=2,humidity=1,pressure=1]
+    [--spread 604800] [--clients 8] [--requests 200]
+    [--output fleet.json] [--baseline previous.json]
+
+Runs with the same --seed build the same fleet and send the same requests,
+so results files of two versions can be compared with --baseline.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api import create_app, db  # noqa: E402
+from api.ingest import insert_readings  # noqa: E402
+from api.validators import RESTRICTED_TYPES  # noqa: E402
+
+SEED_CHUNK_SIZE = 50000
+BATCH_SIZE = 100
+
+
+def parse_types(value):
+    weights = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        weights[name] = float(weight or 1)
+
+    return weights
+
+
+class Fleet:
+    def __init__(self, args):
+        self.devices = [f'device_{index:07d}' for index in range(args.devices)]
+        self.types = list(args.types)
+        self.weights = list(args.types.values())
+        self.end = int(time.time())
+        self.start = self.end - args.spread
+        self.readings_per_device = args.readings_per_device
+        self.seed = args.seed
+
+    def value(self, generator, sensor_type):
+        if sensor_type in RESTRICTED_TYPES:
+            return generator.randint(1, 100)
+
+        return generator.randint(1, 100000)
+
+    def reading(self, generator, device_uuid=None):
+        sensor_type = generator.choices(self.types, self.weights)[0]
+        reading = {
+            'type': sensor_type,
+            'value': self.value(generator, sensor_type),
+            'date_created': generator.randint(self.start, self.end),
+        }
+        if device_uuid is not None:
+            reading['device_uuid'] = device_uuid
+
+        return reading
+
+    def rows(self):
+        generator = random.Random(self.seed)
+        for device_uuid in self.devices:
+            for _ in range(self.readings_per_device):
+                yield self.reading(generator, device_uuid)
+
+
+def seed(app, fleet):
+    started = time.perf_counter()
+    count = 0
+    with app.app_context():
+        chunk = []
+        for row in fleet.rows():
+            chunk.append(row)
+            if len(chunk) == SEED_CHUNK_SIZE:
+                count += insert_readings(chunk)
+                chunk = []
+
+        count += insert_readings(chunk)
+
+    elapsed = time.perf_counter() - started
+    return {
+        'readings': count,
+        'seconds': round(elapsed, 3),
+        'readings_per_second': round(count / elapsed, 1),
+    }
+
+
+def routes(fleet):
+    """
+    Return (name, method, request factory) for every route. A factory takes
+    a random generator and returns the keyword arguments of the request.
+    """
+
+    def device(generator):
+        return generator.choice(fleet.devices)
+
+    def window(generator):
+        # A random window over a quarter of the time spread
+        length = (fleet.end - fleet.start) // 4
+        start = generator.randint(fleet.start, fleet.end - length)
+        return start, start + length
+
+    def metric(route, sensor_type=None, **params):
+        def factory(generator):
+            start, end = window(generator)
+            query = {
+                'type': sensor_type or generator.choice(fleet.types),
+                'start': start,
+                'end': end,
+            }
+            query.update(params)
+            return {
+                'path': f'/devices/{device(generator)}/readings{route}',
+                'query_string': query,
+            }
+
+        return factory
+
+    def post_reading(generator):
+        reading = fleet.reading(generator)
+        reading['date_created'] = fleet.end
+        return {
+            'path': f'/devices/{device(generator)}/readings',
+            'data': json.dumps(reading),
+        }
+
+    def post_batch(generator):
+        readings = [
+            fleet.reading(generator, device(generator))
+            for _ in range(BATCH_SIZE)
+        ]
+        return {
+            'path': '/devices/readings/batch',
+            'data': json.dumps(readings),
+        }
+
+    def summary(generator):
+        start, end = window(generator)
+        return {
+            'path': '/devices/readings',
+            'query_string': {'start': start, 'end': end},
+        }
+
+    approx = [t for t in fleet.types if t not in RESTRICTED_TYPES]
+    return (
+        [
+            ('POST readings', 'post', post_reading),
+            ('POST readings/batch', 'post', post_batch),
+            ('GET readings', 'get', metric('')),
+            ('GET readings?limit', 'get', metric('', limit=100)),
+            ('GET readings?stream', 'get', metric('', stream=1)),
+            ('GET max', 'get', metric('/max')),
+            ('GET top', 'get', metric('/top', k=10)),
+            ('GET bottom', 'get', metric('/bottom', k=10)),
+            ('GET median', 'get', metric('/median')),
+            ('GET mean', 'get', metric('/mean')),
+            ('GET quartiles', 'get', metric('/quartiles')),
+        ]
+        + (
+            [
+                (
+                    'GET median?approx',
+                    'get',
+                    metric('/median', approx[0], approx='true'),
+                )
+            ]
+            if approx
+            else []
+        )
+        + [
+            ('GET summary', 'get', summary),
+        ]
+    )
+
+
+def percentile(ordered, fraction):
+    # Nearest rank percentile of a sorted list
+    index = max(int(round(fraction * len(ordered))) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def peak_rss_mib():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+
+    return peak / 1024
+
+
+def wait_for_buffer(app):
+    # Wait until the write-behind buffer has flushed every queued reading
+    buffer = app.extensions['ingest_buffer']
+    while True:
+        stats = buffer.stats()
+        if (
+            stats['rows_flushed'] + stats['rows_failed']
+            >= stats['rows_queued']
+        ):
+            return
+
+        time.sleep(0.001)
+
+
+def drive(app, name, method, factory, args, seed):
+    """
+    Send the requests of a route and return its statistics. Readings
+    accepted with a 202 by the write-behind buffer are only queued, so
+    their latencies are those of the enqueue, while the throughput
+    includes flushing them, and the route is reported as acknowledged on
+    queueing rather than on commit.
+    """
+
+    generator = random.Random(f'{seed}:{name}')
+    requests = [factory(generator) for _ in range(args.requests)]
+    local = threading.local()
+
+    def send(kwargs):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+
+        started = time.perf_counter()
+        response = getattr(client, method)(**kwargs)
+        # Consume streamed bodies so the whole response is timed
+        response.get_data()
+        return time.perf_counter() - started, response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.clients) as executor:
+        results = list(executor.map(send, requests))
+
+    queued = any(status == 202 for _, status in results)
+    if queued:
+        wait_for_buffer(app)
+
+    elapsed = time.perf_counter() - started
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(1 for _, status in results if status >= 400)
+
+    return {
+        'requests': len(results),
+        'errors': errors,
+        'acknowledged': 'queued' if queued else 'committed',
+        'throughput': round(len(results) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True,
+            check=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    print(f'\n{"route":<24}{"throughput":>12}{"p50":>12}{"p99":>12}')
+    for name, route in results['routes'].items():
+        previous = baseline.get('routes', {}).get(name)
+        if previous is None:
+            continue
+
+        changes = [
+            route[key] / previous[key] - 1 if previous[key] else 0
+            for key in ('throughput', 'p50_ms', 'p99_ms')
+        ]
+        print(f'{name:<24}' + ''.join(f'{c:>+12.0%}' for c in changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--readings-per-device', type=int, default=100)
+    parser.add_argument(
+        '--types',
+        type=parse_types,
+        default='temperature=2,humidity=1,pressure=1',
+        help='Sensor types and their relative weights',
+    )
+    parser.add_argument(
+        '--spread',
+        type=int,
+        default=7 * 86400,
+        help='Seconds the readings are spread over, ending now',
+    )
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument(
+        '--requests', type=int, default=200, help='Requests per route'
+    )
+    parser.add_argument('--config', default='production')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='fleet.json')
+    parser.add_argument('--baseline', help='Results file to compare with')
+    args = parser.parse_args()
+
+    fleet = Fleet(args)
+    results = {
+        'revision': git_revision(),
+        'parameters': {
+            key: value
+            for key, value in vars(args).items()
+            if key != 'baseline'
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'routes': {},
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(args.config)
+        app.config.update(
+            SQLALCHEMY_DATABASE_URI='sqlite:///'
+            + os.path.join(directory, 'fleet.db'),
+            SHARD_DATABASE_URI='sqlite:///'
+            + os.path.join(directory, 'fleet_{shard}.db'),
+        )
+        with app.app_context():
+            db.create_all()
+
+        total = args.devices * args.readings_per_device
+        print(f'Seeding {total} readings...', file=sys.stderr)
+        results['seed'] = seed(app, fleet)
+
+        print(
+            f'{"route":<24}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}'
+            f'{"p99 ms":>10}{"errors":>8}'
+        )
+        for name, method, factory in routes(fleet):
+            route = drive(app, name, method, factory, args, args.seed)
+            results['routes'][name] = route
+            print(
+                f'{name:<24}{route["throughput"]:>10.1f}'
+                f'{route["p50_ms"]:>10.2f}{route["p95_ms"]:>10.2f}'
+                f'{route["p99_ms"]:>10.2f}{route["errors"]:>8}'
+                + (
+                    '  (latency of the enqueue)'
+                    if route['acknowledged'] == 'queued'
+                    else ''
+                )
+            )
+
+        app.extensions['ingest_buffer'].stop()
+
+    results['peak_rss_mib'] = round(peak_rss_mib(), 1)
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+
+    print(f'\nResults written to {args.output}', file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Compare the body size and parsing throughput of the JSON, msgpack and
+binary ingest formats, on their own and followed by the validation every
+batch goes through.
+
+Usage: python benchmarks/ingest_formats.py [--readings 100000]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import msgpack
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api.config import Config  # noqa: E402
+from api.formats import (  # noqa: E402
+    BINARY_MIMETYPE,
+    MSGPACK_MIMETYPE,
+    encode_records,
+    load_readings,
+)
+from api.ingest import build_readings  # noqa: E402
+
+DEVICE_UUID = 'benchmark_device'
+TYPE_CODES = Config.BINARY_TYPE_CODES
+TYPE_NAMES = {name: code for code, name in TYPE_CODES.items()}
+
+
+def generate(count):
+    generator = random.Random(0)
+    return [
+        {
+            'type': generator.choice(('temperature', 'humidity')),
+            'value': generator.randint(1, 100),
+            'date_created': 1600000000 + index,
+        }
+        for index in range(count)
+    ]
+
+
+def best_of(function, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--readings', type=int, default=100000)
+    args = parser.parse_args()
+
+    readings = generate(args.readings)
+    bodies = (
+        ('json', 'application/json', json.dumps(readings).encode()),
+        (
+            'msgpack',
+            MSGPACK_MIMETYPE,
+            msgpack.packb(readings, use_bin_type=True),
+        ),
+        ('binary', BINARY_MIMETYPE, encode_records(readings, TYPE_NAMES)),
+    )
+
+    print(
+        f'{"format":<10}{"bytes/reading":>15}{"parse (ms)":>12}'
+        f'{"readings/s":>14}{"+ validate (ms)":>17}'
+    )
+    for name, mimetype, body in bodies:
+
+        def parse():
+            return load_readings(body, mimetype, TYPE_CODES)
+
+        def parse_and_validate():
+            return build_readings(parse(), DEVICE_UUID)
+
+        assert len(parse_and_validate()[0]) == args.readings
+        parsing = best_of(parse)
+        validating = best_of(parse_and_validate)
+        print(
+            f'{name:<10}{len(body) / args.readings:>15.1f}'
+            f'{parsing * 1000:>12.1f}{args.readings / parsing:>14,.0f}'
+            f'{validating * 1000:>17.1f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Compare the latency and peak Python memory of the median and quartile
+routes with the previous approach of loading every reading of the window
+into Python and sorting it there.
+
+Usage: python benchmarks/median_selection.py [--readings 1000000]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api import create_app, db  # noqa: E402
+from api.helpers import get_median, get_quartiles  # noqa: E402
+from api.models import Reading  # noqa: E402
+
+DEVICE_UUID = 'benchmark_device'
+SENSOR_TYPE = 'pressure'
+
+
+def seed(count, chunk_size=50000):
+    generator = random.Random(0)
+    for offset in range(0, count, chunk_size):
+        rows = [
+            {
+                'device_uuid': DEVICE_UUID,
+                'type': SENSOR_TYPE,
+                'value': generator.randint(0, 100000),
+                'date_created': index,
+            }
+            for index in range(offset, min(offset + chunk_size, count))
+        ]
+        db.session.execute(Reading.__table__.insert(), rows)
+
+    db.session.commit()
+
+
+def load_all_median():
+    readings = Reading.query.filter(
+        Reading.device_uuid == DEVICE_UUID, Reading.type == SENSOR_TYPE
+    ).all()
+    median = get_median([reading.value for reading in readings])
+    return [reading for reading in readings if reading.value == median]
+
+
+def load_all_quartiles():
+    readings = Reading.query.filter(
+        Reading.device_uuid == DEVICE_UUID, Reading.type == SENSOR_TYPE
+    ).all()
+    return get_quartiles([reading.value for reading in readings])
+
+
+def measure(function):
+    # Latency and memory are measured on separate runs, since tracing
+    # allocations slows the code under test down
+    db.session.remove()
+    started = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - started
+
+    db.session.remove()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--readings', type=int, default=1000000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app('testing')
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(
+            directory, 'benchmark.db'
+        )
+        client = app.test_client()
+        url = f'/devices/{DEVICE_UUID}/readings/%s?type={SENSOR_TYPE}'
+
+        with app.app_context():
+            db.create_all()
+            print(f'Seeding {args.readings} readings...', file=sys.stderr)
+            seed(args.readings)
+
+            cases = (
+                ('median, load all rows', load_all_median),
+                ('median, SQL selection', lambda: client.get(url % 'median')),
+                ('quartiles, load all rows', load_all_quartiles),
+                (
+                    'quartiles, SQL selection',
+                    lambda: client.get(
+                        url % 'quartiles' + f'&start=0&end={args.readings}'
+                    ),
+                ),
+            )
+
+            print(f'{"case":<28}{"latency (s)":>14}{"peak (MiB)":>14}')
+            for name, function in cases:
+                elapsed, peak = measure(function)
+                print(f'{name:<28}{elapsed:>14.3f}{peak / 2 ** 20:>14.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+from contextlib import contextmanager
+
+from api.metrics import count_queries
+
+
+class QueryCountAssertions:
+    """
+    Mixin of unittest.TestCase asserting how many statements the requests
+    of a block run, to keep N+1 query patterns out of the routes.
+    """
+
+    @contextmanager
+    def assertMaxQueries(self, maximum):
+        with count_queries() as tally:
+            yield tally
+
+        self.assertLessEqual(
+            tally.queries,
+            maximum,
+            f'{tally.queries} queries were run, at most {maximum} expected',
+        )
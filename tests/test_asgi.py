@@ -0,0 +1,289 @@
+import asyncio
+import json
+import unittest
+
+from api import create_app, db
+from api.asgi import IngestService
+from api.formats import BINARY_MIMETYPE, encode_records
+from api.models import Reading
+
+
+class IngestServiceTestCase(unittest.TestCase):
+    def setUp(self):
+        # Define test variables and initialize app
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.service = IngestService(self.app)
+        self.device_uuid = 'test_device'
+
+        # Setup the SQLite DB
+        db.drop_all()
+        db.create_all()
+
+    async def request(self, method, path, data=None, content_type=None):
+        if content_type is None:
+            body = json.dumps(data).encode()
+            headers = []
+        else:
+            body = data
+            headers = [(b'content-type', content_type.encode())]
+
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'headers': headers,
+        }
+        await self.service(scope, receive, send)
+        return sent[0]['status'], sent[1]['body']
+
+    def run_requests(self, *requests):
+        async def run():
+            responses = await asyncio.gather(*requests)
+            await self.service.stop()
+            return responses
+
+        return asyncio.run(run())
+
+    def test_reading_is_committed_before_the_response(self):
+        # When we POST a reading and a batch
+        responses = self.run_requests(
+            self.request(
+                'POST',
+                f'/devices/{self.device_uuid}/readings',
+                {'type': 'temperature', 'value': 50},
+            ),
+            self.request(
+                'POST',
+                '/devices/readings/batch',
+                [
+                    {'device_uuid': 'other', 'type': 'pH', 'value': 7},
+                    {'device_uuid': 'other', 'type': 'temperature'},
+                ],
+            ),
+        )
+
+        # Then both should be created, with the invalid item reported
+        self.assertEqual(responses[0], (201, b'success'))
+        self.assertEqual(responses[1][0], 201)
+        self.assertEqual(
+            json.loads(responses[1][1]),
+            {
+                'inserted': 1,
+                'errors': [{'index': 1, 'error': 'Validation fields error'}],
+            },
+        )
+
+        # And the readings should be in the database
+        self.assertEqual(Reading.query.count(), 2)
+
+    def test_concurrent_readings_are_group_committed(self):
+        # When many devices POST at once
+        responses = self.run_requests(
+            *(
+                self.request(
+                    'POST',
+                    f'/devices/device_{index}/readings',
+                    {'type': 'temperature', 'value': 1 + index % 100},
+                )
+                for index in range(1000)
+            )
+        )
+
+        # Then every reading should be committed in a few transactions
+        self.assertEqual({status for status, _ in responses}, {201})
+        self.assertEqual(Reading.query.count(), 1000)
+
+        stats = self.service.stats()
+        self.assertEqual(stats['rows_flushed'], 1000)
+        self.assertLess(stats['flushes'], 10)
+        self.assertEqual(stats['queue_depth'], 0)
+
+    def test_full_queue_applies_backpressure(self):
+        # Given a queue of at most 10 readings
+        self.app.config['INGEST_QUEUE_MAX_SIZE'] = 10
+
+        # When more readings arrive than the queue holds
+        responses = self.run_requests(
+            *(
+                self.request(
+                    'POST',
+                    f'/devices/{self.device_uuid}/readings',
+                    {'type': 'temperature', 'value': 10},
+                )
+                for _ in range(50)
+            )
+        )
+
+        # Then the readings past the queue size should be turned away
+        statuses = [status for status, _ in responses]
+        self.assertEqual(statuses.count(201), 10)
+        self.assertEqual(statuses.count(503), 40)
+        self.assertEqual(Reading.query.count(), 10)
+        self.assertEqual(self.service.stats()['rows_rejected'], 40)
+
+    def test_poisoned_request_only_fails_itself(self):
+        # Given rows of three requests queued for the same group commit,
+        # the second of which cannot be stored
+        def row(sensor_type, value):
+            return {
+                'device_uuid': self.device_uuid,
+                'type': sensor_type,
+                'value': value,
+                'date_created': 1,
+            }
+
+        async def run():
+            futures = [
+                self.service.submit([row('temperature', 10)]),
+                self.service.submit([row(['pH'], 7)]),
+                self.service.submit([row('pH', 7), row('pH', 8)]),
+            ]
+            await self.service.stop()
+            return await asyncio.gather(*futures, return_exceptions=True)
+
+        # When the group is flushed
+        results = asyncio.run(run())
+
+        # Then only the request holding the bad row should fail
+        self.assertIsInstance(results[1], Exception)
+        self.assertNotIsInstance(results[0], Exception)
+        self.assertNotIsInstance(results[2], Exception)
+        self.assertEqual(Reading.query.count(), 3)
+
+        stats = self.service.stats()
+        self.assertEqual(stats['rows_flushed'], 3)
+        self.assertEqual(stats['rows_failed'], 1)
+        self.assertEqual(stats['flush_errors'], 1)
+
+    def test_poisoned_request_is_rejected_before_queueing(self):
+        # When a request with a type that is not a string is sent along
+        # valid ones
+        responses = self.run_requests(
+            self.request(
+                'POST',
+                f'/devices/{self.device_uuid}/readings',
+                {'type': 'temperature', 'value': 50},
+            ),
+            self.request(
+                'POST',
+                f'/devices/{self.device_uuid}/readings',
+                {'type': ['x'], 'value': 50},
+            ),
+            self.request(
+                'POST',
+                '/devices/readings/batch',
+                [{'device_uuid': 'other', 'type': 'pH', 'value': 7}],
+            ),
+        )
+
+        # Then only that request should be rejected
+        self.assertEqual([status for status, _ in responses], [201, 400, 201])
+        self.assertEqual(Reading.query.count(), 2)
+
+    def test_large_bodies_are_rejected(self):
+        # Given bodies of at most 100 bytes
+        self.app.config['INGEST_BODY_MAX_SIZE'] = 100
+
+        # When a larger batch is sent
+        responses = self.run_requests(
+            self.request(
+                'POST',
+                f'/devices/{self.device_uuid}/readings/batch',
+                [{'type': 'pH', 'value': 7}] * 10,
+            )
+        )
+
+        # Then it should be turned away without queueing anything
+        self.assertEqual(responses[0], (413, b'Request body is too large'))
+        self.assertEqual(self.service.stats()['rows_queued'], 0)
+
+    def test_binary_readings(self):
+        # When we POST binary records
+        data = encode_records(
+            [{'type': 'humidity', 'value': value} for value in range(1, 6)],
+            {'humidity': 2},
+        )
+        responses = self.run_requests(
+            self.request(
+                'POST',
+                f'/devices/{self.device_uuid}/readings/batch',
+                data,
+                BINARY_MIMETYPE,
+            )
+        )
+
+        # Then they should be decoded and inserted
+        self.assertEqual(responses[0][0], 201)
+        self.assertEqual(Reading.query.filter_by(type='humidity').count(), 5)
+
+    def test_invalid_requests(self):
+        # When we send requests the service does not accept
+        responses = self.run_requests(
+            self.request(
+                'POST', f'/devices/{self.device_uuid}/readings', {'type': 'x'}
+            ),
+            self.request(
+                'POST', f'/devices/{self.device_uuid}/readings/batch', {}
+            ),
+            self.request('GET', f'/devices/{self.device_uuid}/readings'),
+            self.request('POST', '/devices/readings'),
+        )
+
+        # Then they should be rejected without queueing anything
+        statuses = [status for status, _ in responses]
+        self.assertEqual(statuses, [400, 400, 405, 404])
+        self.assertEqual(self.service.stats()['rows_queued'], 0)
+
+    def test_lifespan_drains_the_queue_on_shutdown(self):
+        # Given a service started by the ASGI lifespan protocol
+        async def run():
+            messages = asyncio.Queue()
+            sent = []
+
+            async def send(message):
+                sent.append(message['type'])
+
+            lifespan = asyncio.ensure_future(
+                self.service({'type': 'lifespan'}, messages.get, send)
+            )
+            await messages.put({'type': 'lifespan.startup'})
+
+            # When a reading is queued and the server shuts down
+            future = self.service.submit(
+                [
+                    {
+                        'device_uuid': self.device_uuid,
+                        'type': 'temperature',
+                        'value': 10,
+                        'date_created': 1,
+                    }
+                ]
+            )
+            await messages.put({'type': 'lifespan.shutdown'})
+            await lifespan
+            return sent, future.result()
+
+        sent, inserted = asyncio.run(run())
+
+        # Then the queued reading should be committed before shutdown
+        self.assertEqual(
+            sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+        )
+        self.assertEqual(inserted, 1)
+        self.assertEqual(Reading.query.count(), 1)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
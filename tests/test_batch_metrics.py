@@ -0,0 +1,171 @@
+import json
+import unittest
+
+from api import create_app, db
+
+from tests import QueryCountAssertions
+
+
+class BatchMetricsTestCase(QueryCountAssertions, unittest.TestCase):
+    def setUp(self):
+        # Define test variables and initialize app
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        self.query = {'start': 1000, 'end': 200000}
+
+        # Setup the SQLite DB
+        db.drop_all()
+        db.create_all()
+
+        self.seed(3)
+
+    def seed(self, devices, first=0):
+        # Devices hold an odd number of readings of each type, so that the
+        # median route finds a reading of the median value
+        readings = [
+            {
+                'device_uuid': f'device_{device}',
+                'type': sensor_type,
+                'value': (value * (device + 7)) % 90 + 1,
+                'date_created': 1000 + value * 997,
+            }
+            for device in range(first, first + devices)
+            for sensor_type in ('temperature', 'pressure')
+            for value in range(1, 42 + 2 * device)
+        ]
+        request = self.client.post(
+            '/devices/readings/batch', data=json.dumps(readings)
+        )
+        self.assertEqual(request.status_code, 201)
+
+    def get(self, path, **params):
+        request = self.client.get(path, query_string=params)
+        self.assertEqual(request.status_code, 200)
+        return json.loads(request.data)
+
+    def single(self, device_uuid, sensor_type):
+        # The metrics of a device from the single device routes
+        route = f'/devices/{device_uuid}/readings'
+        params = dict(self.query, type=sensor_type)
+        maximum = self.get(f'{route}/max', **params)
+        quartiles = self.get(f'{route}/quartiles', **params)
+        return {
+            'number_of_readings': len(self.get(route, **params)),
+            'max': maximum[0]['value'] if maximum else None,
+            'mean': self.get(f'{route}/mean', **params)['value'],
+            'median': self.get(f'{route}/median', **params)[0]['value'],
+            'quartile_1': quartiles['quartile_1'],
+            'quartile_3': quartiles['quartile_3'],
+        }
+
+    def test_batch_metrics_match_the_single_device_routes(self):
+        # When we GET the metrics of every device at once
+        devices = ['device_0', 'device_1', 'device_2']
+        for sensor_type in ('temperature', 'pressure'):
+            results = self.get(
+                '/devices/readings/metrics',
+                devices=','.join(devices),
+                type=sensor_type,
+                **self.query,
+            )
+
+            # Then each device should match the single device routes
+            for device_uuid in devices:
+                with self.subTest(sensor_type=sensor_type, device=device_uuid):
+                    self.assertEqual(
+                        results[device_uuid],
+                        self.single(device_uuid, sensor_type),
+                    )
+
+    def test_requested_metrics_only(self):
+        # When we POST for the max and mean of a known and unknown device
+        request = self.client.post(
+            '/devices/readings/metrics',
+            data=json.dumps(
+                {
+                    'devices': ['device_0', 'unknown'],
+                    'type': 'pressure',
+                    'metrics': ['max', 'mean'],
+                }
+            ),
+        )
+        self.assertEqual(request.status_code, 200)
+        results = json.loads(request.data)
+
+        # Then only those metrics should be returned, null without readings
+        self.assertEqual(
+            set(results['device_0']), {'number_of_readings', 'max', 'mean'}
+        )
+        self.assertEqual(results['device_0']['number_of_readings'], 41)
+        self.assertEqual(
+            results['unknown'],
+            {'number_of_readings': 0, 'max': None, 'mean': None},
+        )
+
+    def test_queries_do_not_grow_with_devices(self):
+        # Given many more devices
+        self.seed(30, 3)
+
+        # When we GET the metrics of 1 and then 33 devices
+        counts = []
+        for devices in (1, 33):
+            for sensor_type, metrics in (
+                ('pressure', 'max,mean'),
+                ('temperature', 'max,mean,median,quartiles'),
+                ('pressure', 'max,mean,median,quartiles'),
+            ):
+                with self.assertMaxQueries(2) as batch:
+                    self.get(
+                        '/devices/readings/metrics',
+                        devices=','.join(
+                            f'device_{device}' for device in range(devices)
+                        ),
+                        type=sensor_type,
+                        metrics=metrics,
+                        **self.query,
+                    )
+
+                counts.append((devices, metrics, batch.queries))
+
+        # Then the number of queries should not depend on the devices
+        self.assertEqual(
+            [queries for devices, _, queries in counts if devices == 1],
+            [queries for devices, _, queries in counts if devices == 33],
+        )
+
+    def test_invalid_requests(self):
+        # Given a limit of two devices
+        self.app.config['BATCH_METRICS_MAX_DEVICES'] = 2
+        path = '/devices/readings/metrics'
+
+        # Then missing parameters and unknown metrics should be rejected
+        for params in (
+            {'type': 'pressure'},
+            {'devices': 'device_0'},
+            {'devices': 'device_0', 'type': 'pressure', 'metrics': 'min'},
+        ):
+            with self.subTest(params=params):
+                request = self.client.get(path, query_string=params)
+                self.assertEqual(request.status_code, 400)
+
+        request = self.client.post(
+            path, data=json.dumps({'devices': 'device_0', 'type': 'pressure'})
+        )
+        self.assertEqual(request.status_code, 400)
+
+        # And too many devices should be rejected
+        request = self.client.get(
+            path,
+            query_string={
+                'devices': 'device_0,device_1,device_2',
+                'type': 'pressure',
+            },
+        )
+        self.assertEqual(request.status_code, 413)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
@@ -0,0 +1,151 @@
+import json
+import unittest
+
+from api import create_app, db
+from api.cache import MetricCache
+
+from tests import QueryCountAssertions
+
+
+class MetricCacheTestCase(QueryCountAssertions, unittest.TestCase):
+    def setUp(self):
+        # Define test variables and initialize app
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        self.device_uuid = 'test_device'
+        self.cache = self.app.extensions['metric_cache']
+
+        # Setup the SQLite DB
+        db.drop_all()
+        db.create_all()
+
+        self.post(
+            [
+                {'type': 'temperature', 'value': v, 'date_created': 1000 + v}
+                for v in range(1, 51)
+            ]
+        )
+
+    def post(self, readings):
+        request = self.client.post(
+            f'/devices/{self.device_uuid}/readings/batch',
+            data=json.dumps(readings),
+        )
+        self.assertEqual(request.status_code, 201)
+
+    def get(self, metric, **params):
+        params.setdefault('type', 'temperature')
+        request = self.client.get(
+            f'/devices/{self.device_uuid}/readings/{metric}',
+            query_string=params,
+        )
+        self.assertEqual(request.status_code, 200)
+        return json.loads(request.data)
+
+    def test_repeated_metrics_are_served_from_the_cache(self):
+        # When we GET the same metrics twice
+        for metric in ('max', 'mean', 'median', 'quartiles'):
+            first = self.get(metric, start=1000, end=1100)
+
+            # Then the second request should only look up the marks
+            with self.assertMaxQueries(1):
+                self.assertEqual(self.get(metric, start=1000, end=1100), first)
+
+        self.assertEqual(self.cache.stats()['hits'], 4)
+        self.assertEqual(self.cache.stats()['misses'], 4)
+
+    def test_readings_inside_a_window_invalidate_it(self):
+        # Given cached maxes of two windows
+        self.assertEqual(self.get('max', start=1000, end=1025)[0]['value'], 25)
+        self.assertEqual(self.get('max', start=1026, end=1100)[0]['value'], 50)
+
+        # When readings land outside the windows or of another type
+        self.post(
+            [
+                {'type': 'temperature', 'value': 99, 'date_created': 2000},
+                {'type': 'humidity', 'value': 99, 'date_created': 1010},
+            ]
+        )
+
+        # Then both should still be cached
+        self.assertEqual(self.cache.stats()['invalidations'], 0)
+
+        # And a reading inside the first window should only drop it
+        self.post([{'type': 'temperature', 'value': 90, 'date_created': 1010}])
+        self.assertEqual(self.cache.stats()['invalidations'], 1)
+        self.assertEqual(self.get('max', start=1000, end=1025)[0]['value'], 90)
+        self.assertEqual(self.get('max', start=1026, end=1100)[0]['value'], 50)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_readings_changed_elsewhere_invalidate_windows(self):
+        # Given cached maxes of a closed window
+        self.assertEqual(self.get('max', start=1000, end=1025)[0]['value'], 25)
+
+        # When another process deletes and inserts readings of the window,
+        # which only the reading marks record
+        db.session.execute('DELETE FROM readings WHERE date_created = 1025')
+        db.session.execute(
+            "INSERT INTO readings (device_uuid, type, value, date_created) "
+            f"VALUES ('{self.device_uuid}', 'temperature', 60, 2000)"
+        )
+        db.session.commit()
+
+        # Then the window should be recomputed
+        self.assertEqual(self.get('max', start=1000, end=1025)[0]['value'], 24)
+        self.assertEqual(self.cache.stats()['hits'], 0)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        # Given a cache of two entries
+        self.cache = self.app.extensions['metric_cache'] = MetricCache(2, 30)
+
+        # When three windows are requested
+        for end in (1010, 1020, 1030):
+            self.get('max', start=1000, end=end)
+
+        # Then the oldest should be evicted
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+        self.assertEqual(self.cache.stats()['size'], 2)
+        self.get('max', start=1000, end=1030)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_only_open_windows_expire(self):
+        # Given a cache expiring open windows at once
+        self.cache = self.app.extensions['metric_cache'] = MetricCache(10, 0)
+
+        # When a closed and an open window are requested twice
+        for _ in range(2):
+            self.get('mean', start=1000, end=1100)
+            self.get('mean', start=1000)
+
+        # Then only the closed window should be served from the cache
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['expirations'], 1)
+
+    def test_values_computed_during_ingest_are_not_cached(self):
+        # Given a value computed before a reading of its device is ingested
+        cache = MetricCache(10, 30)
+        window = (self.device_uuid, 'temperature', False, None, None)
+        version = cache.version(self.device_uuid)
+        cache.invalidate(
+            [
+                {
+                    'device_uuid': self.device_uuid,
+                    'type': 'temperature',
+                    'date_created': 1,
+                }
+            ]
+        )
+
+        # When it is stored
+        cache.put('key', b'stale', window, version, 0)
+
+        # Then it should be dropped
+        self.assertIsNone(cache.get('key', 0))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
@@ -0,0 +1,407 @@
+import json
+import os
+import random
+import tempfile
+import unittest
+from operator import itemgetter
+
+import numpy as np
+from api import create_app, db
+from api.cold import cold_readings, open_segment, write_segment
+from api.models import ReadingMark, ReadingSegment
+from api.partitions import (
+    compact_cold_partitions,
+    drop_expired_partitions,
+    partition_starts,
+)
+
+DAY = 86400
+
+
+class SegmentTestCase(unittest.TestCase):
+    def test_segments_are_read_back_without_copies(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # Given readings with small and large values
+            for values, dtype in (([5, -3, 100], 'i1'), ([7, 70000, 2], 'i4')):
+                path = os.path.join(directory, f'{dtype}.seg')
+                first, minimum, maximum = write_segment(
+                    path, [1, 2, 3], [1000, 1000, 1060], values
+                )
+
+                # When we map their segment
+                segment = open_segment(path)
+
+                # Then the values should be stored in the narrowest type
+                self.assertEqual(segment.values.dtype, np.dtype(dtype))
+                self.assertEqual(segment.values.tolist(), values)
+                self.assertEqual(segment.ids.tolist(), [1, 2, 3])
+                self.assertEqual(
+                    segment.dates(slice(None)).tolist(), [1000, 1000, 1060]
+                )
+
+                # And the footer should summarize them
+                self.assertEqual(
+                    (segment.count, segment.minimum, segment.maximum),
+                    (3, min(values), max(values)),
+                )
+                self.assertEqual(
+                    (first, minimum, maximum), (1000, min(values), max(values))
+                )
+
+                # And the arrays should be views of the mapped file
+                for array in (segment.ids, segment.offsets, segment.values):
+                    self.assertFalse(array.flags.owndata)
+                    self.assertFalse(array.flags.writeable)
+
+                # And ranges should be sliced by date_created
+                self.assertEqual(segment.select(1000, 1000), slice(0, 2))
+                self.assertEqual(segment.select(1001, None), slice(2, 3))
+                self.assertEqual(segment.select(None, 999), slice(0, 0))
+
+
+class ColdTierTestCase(unittest.TestCase):
+    def setUp(self):
+        # Define test variables and initialize app with daily partitions
+        # compacted after a day
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = create_app('testing')
+        self.app.config.update(
+            SQLALCHEMY_DATABASE_URI='sqlite:///'
+            + os.path.join(self.directory.name, 'cold.db'),
+            COLD_SEGMENT_DIRECTORY=os.path.join(
+                self.directory.name, 'segments'
+            ),
+            PARTITION_SECONDS=DAY,
+            COLD_AFTER_SECONDS=DAY,
+        )
+        # Every response must be computed from the readings
+        self.app.extensions.pop('metric_cache')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        self.days = [DAY * 20000 + DAY * offset for offset in range(3)]
+
+        # Setup the SQLite DB
+        db.create_all()
+
+        # Readings of two devices spread over three days
+        generator = random.Random(2)
+        readings = [
+            {
+                'device_uuid': device_uuid,
+                'type': sensor_type,
+                'value': generator.randint(1, high),
+                'date_created': generator.randint(
+                    self.days[0], self.days[2] + DAY - 1
+                ),
+            }
+            for device_uuid in ('device_0', 'device_1')
+            for sensor_type, high in (
+                ('temperature', 100),
+                ('pressure', 90000),
+            )
+            for _ in range(300)
+        ]
+        request = self.client.post(
+            '/devices/readings/batch', data=json.dumps(readings)
+        )
+        self.assertEqual(request.status_code, 201)
+
+    def responses(self):
+        # Responses of every read route over ranges that start and end
+        # inside a day
+        start = self.days[0] + 3 * 3600 + 17
+        end = self.days[2] + 5 * 3600 + 31
+        paths = [
+            '/devices/readings',
+            f'/devices/readings?start={start}&end={end}',
+        ]
+        for device_uuid in ('device_0', 'device_1'):
+            route = f'/devices/{device_uuid}/readings'
+            paths.append(route)
+            paths.append(f'{route}?limit=50&cursor=')
+            for sensor_type in ('temperature', 'pressure'):
+                query = f'type={sensor_type}&start={start}&end={end}'
+                paths.extend(
+                    [
+                        f'{route}?{query}',
+                        f'{route}?{query}&limit=7',
+                        f'{route}/max?{query}',
+                        f'{route}/top?{query}',
+                        f'{route}/bottom?{query}',
+                        f'{route}/median?{query}',
+                        f'{route}/median?{query}&approx=true',
+                        f'{route}/mean?{query}',
+                        f'{route}/quartiles?{query}',
+                        f'{route}/series?{query}&interval=3600'
+                        '&agg=count,sum,min,max',
+                        f'{route}/series?{query}&interval=45&agg=mean',
+                        f'{route}/series?{query}&points=40',
+                        f'{route}/mean?type=temp&type_match=substring',
+                    ]
+                )
+
+            paths.append(
+                '/devices/readings/metrics?devices=device_0,device_1'
+                f'&type=pressure&start={start}&end={end}'
+            )
+
+        responses = {}
+        for path in paths:
+            request = self.client.get(path)
+            self.assertEqual(request.status_code, 200, path)
+            responses[path] = (request.get_json(), request.headers.get('ETag'))
+
+        # Readings of every type are not returned in any particular order
+        for device_uuid in ('device_0', 'device_1'):
+            readings, etag = responses[f'/devices/{device_uuid}/readings']
+            readings.sort(key=itemgetter('date_created', 'type', 'value'))
+
+        return responses
+
+    def test_compacted_readings_are_still_served(self):
+        # Given the responses of every route
+        before = self.responses()
+
+        # When the partitions older than a day are compacted
+        compacted = compact_cold_partitions(now=self.days[2] + DAY + 1)
+
+        # Then only the last day should be left in row form
+        self.assertEqual(compacted, 2)
+        self.assertEqual(partition_starts(), self.days[2:])
+        self.assertEqual(ReadingSegment.query.count(), 8)
+        self.assertEqual(
+            db.session.query(db.func.sum(ReadingSegment.count)).scalar()
+            + db.session.execute(
+                f'SELECT COUNT(*) FROM readings_p{self.days[2]}'
+            ).scalar(),
+            1200,
+        )
+
+        # And every route should answer exactly as before, with the same
+        # tags since the readings did not change
+        after = self.responses()
+        for path, response in before.items():
+            with self.subTest(path=path):
+                self.assertEqual(after[path], response)
+
+    def cold_rows(self, path):
+        # Response of a request and the number of cold readings handed to
+        # SQLite by its statements
+        rows = []
+
+        def count(conn, cursor, statement, parameters, context, many):
+            for parameter in set(parameters):
+                if isinstance(parameter, str) and parameter.startswith('[['):
+                    slices = json.loads(parameter)
+                    rows.extend(
+                        stop - position for *_, position, stop in slices
+                    )
+
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            request = self.client.get(path)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count)
+
+        self.assertEqual(request.status_code, 200, path)
+        return request.get_json(), sum(rows)
+
+    def test_paged_reads_only_hand_their_page_to_sqlite(self):
+        # Given the pages of a device's readings and its top and bottom
+        # readings
+        route = '/devices/device_0/readings'
+        paths = [f'{route}/top?type=pressure&k=5']
+        paths.append(f'{route}/bottom?type=pressure&k=5')
+        before = {path: self.client.get(path).get_json() for path in paths}
+        pages = []
+        cursor = ''
+        while cursor is not None:
+            path = f'{route}?type=pressure&limit=7&cursor={cursor}'
+            pages.append(self.client.get(path).get_json())
+            cursor = pages[-1]['next']
+
+        # When the partitions older than a day are compacted
+        compact_cold_partitions(now=self.days[2] + DAY + 1)
+
+        # Then every page should be served as before, with at most a page
+        # of cold readings handed to SQLite for each
+        cursor = ''
+        for page in pages:
+            path = f'{route}?type=pressure&limit=7&cursor={cursor}'
+            response, rows = self.cold_rows(path)
+            self.assertEqual(response, page)
+            self.assertLessEqual(rows, 8)
+            cursor = page['next']
+
+        # And so should the top and bottom readings, with at most k
+        for path, readings in before.items():
+            response, rows = self.cold_rows(path)
+            self.assertEqual(response, readings)
+            self.assertLessEqual(rows, 5)
+
+        # While unpaged reads hand every cold reading of the range
+        response, rows = self.cold_rows(f'{route}?type=pressure')
+        cold = [
+            reading
+            for page in pages
+            for reading in page['readings']
+            if reading['date_created'] < self.days[2]
+        ]
+        self.assertEqual(rows, len(cold))
+
+    def test_cold_slices_are_parsed_once(self):
+        # Given compacted days
+        compact_cold_partitions(now=self.days[2] + DAY + 1)
+
+        # When we read the cold readings of one and of both days
+        statements = [
+            cold_readings(start, end).compile(db.engine)
+            for start, end in (
+                (self.days[0], self.days[1] - 1),
+                (self.days[0], self.days[2] - 1),
+            )
+        ]
+
+        # Then the statement should not grow with the number of segments,
+        # see benchmarks/cold_scaling.py
+        self.assertEqual(str(statements[0]), str(statements[1]))
+        for statement, segments in zip(statements, (4, 8)):
+            # And their slices should be bound once, for json_each to parse
+            # them in a single pass
+            slices = [
+                json.loads(value)
+                for value in statement.params.values()
+                if isinstance(value, str) and value.startswith('[[')
+            ]
+            self.assertEqual([len(value) for value in slices], [segments])
+            self.assertEqual(str(statement).count('json_each'), 1)
+
+    def test_late_readings_of_compacted_days(self):
+        # Given compacted days
+        compact_cold_partitions(now=self.days[2] + DAY + 1)
+        path = '/devices/device_0/readings?type=pressure&limit=1000'
+        readings = self.client.get(path).get_json()['readings']
+
+        # When a late reading lands on the first day
+        late = {
+            'type': 'pressure',
+            'value': 7,
+            'date_created': self.days[0] + 1,
+        }
+        request = self.client.post(
+            '/devices/device_0/readings/batch', data=json.dumps([late])
+        )
+        self.assertEqual(request.status_code, 201)
+
+        # Then it should be paged through along the cold readings
+        late['device_uuid'] = 'device_0'
+        self.assertEqual(
+            self.client.get(path).get_json()['readings'],
+            [late] + readings,
+        )
+
+        # And its id should follow the ids of the compacted readings
+        max_id = (
+            db.session.query(db.func.max(ReadingSegment.max_id))
+            .filter(ReadingSegment.start == self.days[0])
+            .scalar()
+        )
+        late_id = db.session.execute(
+            f'SELECT id FROM readings_p{self.days[0]}'
+        ).scalar()
+        self.assertGreater(late_id, max_id)
+
+    def test_partitions_with_real_values_are_not_compacted(self):
+        # Given a REAL value stored in the first day before values were
+        # validated as integers
+        db.session.execute(
+            f'INSERT INTO readings_p{self.days[0]} '
+            '(device_uuid, type, value, date_created) '
+            f"VALUES ('device_0', 'pressure', 2.5, {self.days[0] + 1})"
+        )
+        db.session.commit()
+
+        # When the partitions older than a day are compacted
+        compacted = compact_cold_partitions(now=self.days[2] + DAY + 1)
+
+        # Then the first day should be left in row form
+        self.assertEqual(compacted, 1)
+        self.assertEqual(partition_starts(), [self.days[0], self.days[2]])
+        self.assertEqual(
+            {segment.start for segment in ReadingSegment.query},
+            {self.days[1]},
+        )
+
+        # And segment files should refuse values that are not integers
+        with self.assertRaises(ValueError):
+            write_segment(
+                os.path.join(self.directory.name, 'real.seg'),
+                [1, 2],
+                [1000, 1001],
+                [1, 2.5],
+            )
+
+    def test_retention_drops_segments(self):
+        # Given compacted days
+        compact_cold_partitions(now=self.days[2] + DAY + 1)
+        paths = [segment.path for segment in ReadingSegment.query]
+        versions = {
+            (mark.device_uuid, mark.type): mark.version
+            for mark in ReadingMark.query
+        }
+
+        # When retention drops the first day
+        self.app.config['RETENTION_SECONDS'] = 2 * DAY
+        dropped = drop_expired_partitions(now=self.days[1] + 2 * DAY)
+
+        # Then its segments and their files should be removed
+        self.assertEqual(dropped, 1)
+        self.assertEqual(
+            {segment.start for segment in ReadingSegment.query},
+            {self.days[1]},
+        )
+        removed = [
+            path for path in paths if path.startswith(f'{self.days[0]}/')
+        ]
+        self.assertEqual(len(removed), 4)
+        for path in removed:
+            self.assertFalse(
+                os.path.exists(
+                    os.path.join(
+                        self.app.config['COLD_SEGMENT_DIRECTORY'], path
+                    )
+                )
+            )
+
+        # And the marks of their devices and types should be bumped
+        for mark in ReadingMark.query:
+            self.assertEqual(
+                mark.version, versions[(mark.device_uuid, mark.type)] + 1
+            )
+
+    def test_retention_with_missing_segment_files(self):
+        # Given compacted days, one of whose segment files is already gone
+        compact_cold_partitions(now=self.days[2] + DAY + 1)
+        stored = ReadingSegment.query.filter_by(start=self.days[0]).first()
+        os.remove(
+            os.path.join(
+                self.app.config['COLD_SEGMENT_DIRECTORY'], stored.path
+            )
+        )
+
+        # When retention drops the first two days
+        self.app.config['RETENTION_SECONDS'] = DAY
+        dropped = drop_expired_partitions(now=self.days[2] + DAY)
+
+        # Then every segment of both days should still be dropped
+        self.assertEqual(dropped, 2)
+        self.assertEqual(
+            {segment.start for segment in ReadingSegment.query}, set()
+        )
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.directory.cleanup()
@@ -0,0 +1,128 @@
+import json
+import unittest
+
+from api import create_app, db
+from api.models import Reading, ReadingMark
+
+from tests import QueryCountAssertions
+
+
+class ConditionalGetTestCase(QueryCountAssertions, unittest.TestCase):
+    def setUp(self):
+        # Define test variables and initialize app
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        self.device_uuid = 'test_device'
+        self.path = f'/devices/{self.device_uuid}/readings'
+
+        # Setup the SQLite DB
+        db.drop_all()
+        db.create_all()
+
+        self.post('temperature', 10)
+
+    def post(self, sensor_type, value):
+        request = self.client.post(
+            self.path, data=json.dumps({'type': sensor_type, 'value': value})
+        )
+        self.assertEqual(request.status_code, 201)
+
+    def test_unchanged_readings_are_not_modified(self):
+        # Given a tagged response
+        request = self.client.get(
+            self.path, query_string={'type': 'temperature'}
+        )
+        self.assertEqual(request.status_code, 200)
+        etag = request.headers['ETag']
+        self.assertIsNotNone(request.last_modified)
+
+        # When it is requested again with its tag
+        with self.assertMaxQueries(1):
+            request = self.client.get(
+                self.path,
+                query_string={'type': 'temperature'},
+                headers={'If-None-Match': etag},
+            )
+
+        # Then it should be answered without running the route's query
+        self.assertEqual(request.status_code, 304)
+        self.assertEqual(request.data, b'')
+        self.assertEqual(request.headers['ETag'], etag)
+
+        # And readings of other types should not change it
+        self.post('humidity', 20)
+        request = self.client.get(
+            self.path,
+            query_string={'type': 'temperature'},
+            headers={'If-None-Match': etag},
+        )
+        self.assertEqual(request.status_code, 304)
+
+        # And a reading of its type should
+        self.post('temperature', 30)
+        request = self.client.get(
+            self.path,
+            query_string={'type': 'temperature'},
+            headers={'If-None-Match': etag},
+        )
+        self.assertEqual(request.status_code, 200)
+        self.assertNotEqual(request.headers['ETag'], etag)
+
+    def test_metric_routes_are_tagged_per_query(self):
+        # Given the mean and max of the same readings
+        tags = set()
+        for route in ('mean', 'max', 'median', 'quartiles', 'top', 'bottom'):
+            request = self.client.get(
+                f'{self.path}/{route}',
+                query_string={'type': 'temperature', 'start': 0, 'end': 1},
+            )
+            self.assertEqual(request.status_code, 200)
+            tags.add(request.headers['ETag'])
+
+            # Then each should be answered from its own tag
+            request = self.client.get(
+                f'{self.path}/{route}',
+                query_string={'type': 'temperature', 'start': 0, 'end': 1},
+                headers={'If-None-Match': request.headers['ETag']},
+            )
+            self.assertEqual(request.status_code, 304)
+
+        self.assertEqual(len(tags), 6)
+
+    def test_if_modified_since(self):
+        # Given the time readings last changed
+        request = self.client.get(self.path)
+        last_modified = request.headers['Last-Modified']
+
+        # Then it should not be modified since then
+        request = self.client.get(
+            self.path, headers={'If-Modified-Since': last_modified}
+        )
+        self.assertEqual(request.status_code, 304)
+
+        # And it should be modified since an earlier time
+        request = self.client.get(
+            self.path,
+            headers={'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'},
+        )
+        self.assertEqual(request.status_code, 200)
+
+    def test_deleted_readings_bump_the_mark(self):
+        # Given the mark of a device's readings
+        mark = ReadingMark.query.one()
+        version = mark.version
+
+        # When a reading is deleted
+        Reading.query.delete()
+        db.session.commit()
+
+        # Then its version should grow
+        db.session.refresh(mark)
+        self.assertEqual(mark.version, version + 1)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
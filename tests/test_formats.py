@@ -0,0 +1,177 @@
+import json
+import unittest
+
+import msgpack
+from api import create_app, db
+from api.formats import (
+    BINARY_MIMETYPE,
+    MSGPACK_MIMETYPE,
+    RECORD,
+    SECTION,
+    decode_records,
+    decode_sections,
+    encode_records,
+)
+from api.models import Reading
+
+TYPE_CODES = {1: 'temperature', 2: 'humidity'}
+TYPE_NAMES = {name: code for code, name in TYPE_CODES.items()}
+
+
+def encode_section(device_uuid, readings):
+    device = device_uuid.encode()
+    return (
+        SECTION.pack(len(device), len(readings))
+        + device
+        + encode_records(readings, TYPE_NAMES)
+    )
+
+
+class FormatsTestCase(unittest.TestCase):
+    def test_records_round_trip(self):
+        # Given readings encoded as binary records
+        readings = [
+            {'type': 'temperature', 'value': 22, 'date_created': 1000},
+            {'type': 'humidity', 'value': -5},
+        ]
+        data = encode_records(readings, TYPE_NAMES)
+
+        # Then each record should take a fixed width and decode back
+        self.assertEqual(len(data), 2 * RECORD.size)
+        self.assertEqual(decode_records(data, TYPE_CODES), readings)
+
+        # And unknown type codes should decode without a type
+        data = RECORD.pack(9, 1, 0)
+        self.assertEqual(
+            decode_records(data, TYPE_CODES), [{'type': None, 'value': 1}]
+        )
+
+        # And truncated records should be rejected
+        with self.assertRaises(ValueError):
+            decode_records(data[:-1], TYPE_CODES)
+
+    def test_sections_carry_their_device(self):
+        # Given readings of two devices in binary sections
+        data = encode_section(
+            'a', [{'type': 'temperature', 'value': 1}]
+        ) + encode_section('bb', [{'type': 'humidity', 'value': 2}] * 2)
+
+        # Then every reading should decode with its device_uuid
+        self.assertEqual(
+            [
+                item['device_uuid']
+                for item in decode_sections(data, TYPE_CODES)
+            ],
+            ['a', 'bb', 'bb'],
+        )
+
+        # And truncated sections should be rejected
+        with self.assertRaises(ValueError):
+            decode_sections(data[:-1], TYPE_CODES)
+
+
+class BinaryIngestTestCase(unittest.TestCase):
+    def setUp(self):
+        # Define test variables and initialize app
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        self.device_uuid = 'test_device'
+
+        # Setup the SQLite DB
+        db.drop_all()
+        db.create_all()
+
+    def test_device_readings_post_binary(self):
+        # When we make a binary POST request with a single record
+        request = self.client.post(
+            f'/devices/{self.device_uuid}/readings',
+            data=encode_records(
+                [{'type': 'temperature', 'value': 42}], TYPE_NAMES
+            ),
+            content_type=BINARY_MIMETYPE,
+        )
+
+        # Then the reading should be created
+        self.assertEqual(request.status_code, 201)
+        self.assertEqual(Reading.query.one().value, 42)
+
+        # And a body with more than one record should be rejected
+        request = self.client.post(
+            f'/devices/{self.device_uuid}/readings',
+            data=encode_records(
+                [{'type': 'temperature', 'value': 42}] * 2, TYPE_NAMES
+            ),
+            content_type=BINARY_MIMETYPE,
+        )
+        self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_batch_binary(self):
+        # When we POST binary records, one of them out of range
+        readings = [
+            {'type': 'temperature', 'value': value, 'date_created': 1000}
+            for value in (10, 20, 300)
+        ]
+        request = self.client.post(
+            f'/devices/{self.device_uuid}/readings/batch',
+            data=encode_records(readings, TYPE_NAMES),
+            content_type=BINARY_MIMETYPE,
+        )
+
+        # Then the valid records should be inserted
+        self.assertEqual(request.status_code, 201)
+        self.assertEqual(
+            json.loads(request.data),
+            {
+                'inserted': 2,
+                'errors': [{'index': 2, 'error': 'Validation fields error'}],
+            },
+        )
+        self.assertEqual(
+            [reading.date_created for reading in Reading.query], [1000, 1000]
+        )
+
+        # And truncated bodies should be rejected
+        request = self.client.post(
+            f'/devices/{self.device_uuid}/readings/batch',
+            data=encode_records(readings, TYPE_NAMES)[:-1],
+            content_type=BINARY_MIMETYPE,
+        )
+        self.assertEqual(request.status_code, 400)
+
+    def test_readings_batch_binary_sections(self):
+        # When we POST binary sections of two devices
+        request = self.client.post(
+            '/devices/readings/batch',
+            data=encode_section('a', [{'type': 'temperature', 'value': 1}])
+            + encode_section('b', [{'type': 'humidity', 'value': 2}]),
+            content_type=BINARY_MIMETYPE,
+        )
+
+        # Then each device should get its reading
+        self.assertEqual(request.status_code, 201)
+        self.assertEqual(
+            sorted((r.device_uuid, r.type) for r in Reading.query),
+            [('a', 'temperature'), ('b', 'humidity')],
+        )
+
+    def test_readings_batch_msgpack(self):
+        # When we POST a msgpack array of readings
+        request = self.client.post(
+            f'/devices/{self.device_uuid}/readings/batch',
+            data=msgpack.packb(
+                [{'type': 'pressure', 'value': 1013}] * 3, use_bin_type=True
+            ),
+            content_type=MSGPACK_MIMETYPE,
+        )
+
+        # Then they should be inserted like JSON readings
+        self.assertEqual(request.status_code, 201)
+        self.assertEqual(json.loads(request.data)['inserted'], 3)
+        self.assertEqual(Reading.query.count(), 3)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
@@ -0,0 +1,25 @@
+import unittest
+
+from api.helpers import downsample_lttb
+
+
+class HelpersTestCase(unittest.TestCase):
+    def test_lttb_keeps_the_shape_of_a_series(self):
+        # Given a flat series with a single spike
+        points = [(x, 0) for x in range(1000)]
+        points[437] = (437, 100)
+
+        # When we downsample it from an iterator
+        for threshold in (3, 10, 100, 999):
+            sampled = downsample_lttb(iter(points), len(points), threshold)
+
+            # Then it should keep threshold points in order, the first, the
+            # last and the spike among them
+            self.assertEqual(len(sampled), threshold)
+            self.assertEqual(sampled, sorted(set(sampled)))
+            self.assertEqual(sampled[0], points[0])
+            self.assertEqual(sampled[-1], points[-1])
+            self.assertIn((437, 100), sampled)
+
+        # And short series should be kept whole
+        self.assertEqual(downsample_lttb(points[:5], 5, 10), points[:5])
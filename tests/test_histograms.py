@@ -0,0 +1,95 @@
+import random
+import unittest
+
+from api import create_app, db
+from api.helpers import get_histogram_summary, get_median, get_quartiles
+from api.histograms import histogram_counts
+from api.ingest import insert_readings
+from api.models import Reading, ReadingHistogram
+
+
+class HistogramsTestCase(unittest.TestCase):
+    def setUp(self):
+        # Define test variables and initialize app
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.device_uuid = 'test_device'
+
+        # Setup the SQLite DB
+        db.drop_all()
+        db.create_all()
+
+        # Setup readings spread over a few hours
+        generator = random.Random(42)
+        self.rows = [
+            {
+                'device_uuid': self.device_uuid,
+                'type': generator.choice(['temperature', 'humidity']),
+                'value': generator.randint(0, 100),
+                'date_created': generator.randint(0, 5 * 3600),
+            }
+            for _ in range(500)
+        ]
+        insert_readings(self.rows)
+
+    def expected_values(self, sensor_type, start, end):
+        return [
+            row['value']
+            for row in self.rows
+            if row['type'] == sensor_type
+            and (start is None or row['date_created'] >= start)
+            and (end is None or row['date_created'] <= end)
+        ]
+
+    def test_histograms_maintained_on_ingest(self):
+        # Given readings inserted through the ingest path
+        # When we sum the histogram counts
+        total = db.session.query(db.func.sum(ReadingHistogram.count)).scalar()
+
+        # Then every reading should have been counted once
+        self.assertEqual(total, len(self.rows))
+
+        # And when readings are deleted
+        Reading.query.filter(Reading.type == 'humidity').delete()
+        db.session.commit()
+
+        # Then their counts should be removed from the histograms
+        self.assertEqual(
+            ReadingHistogram.query.filter_by(type='humidity').count(), 0
+        )
+
+    def test_histograms_backfilled_on_create(self):
+        # Given readings that predate the histogram table
+        ReadingHistogram.__table__.drop(db.engine)
+
+        # When the histogram table is created
+        db.create_all()
+
+        # Then it should be backfilled from the existing readings
+        total = db.session.query(db.func.sum(ReadingHistogram.count)).scalar()
+        self.assertEqual(total, len(self.rows))
+
+    def test_histogram_counts_match_raw_readings(self):
+        # Given random ranges, aligned or not to the hourly buckets
+        generator = random.Random(7)
+        ranges = [(None, None), (3600, 7199), (None, 9000), (4000, None)]
+        for _ in range(20):
+            start = generator.randint(0, 5 * 3600)
+            ranges.append((start, start + generator.randint(0, 3 * 3600)))
+
+        for start, end in ranges:
+            # When we summarize the histogram counts for the range
+            counts = histogram_counts('temperature', start, end)
+            summary = get_histogram_summary(counts.get(self.device_uuid, []))
+
+            # Then they should match the statistics of the raw readings
+            values = self.expected_values('temperature', start, end)
+            self.assertEqual(summary[0], len(values))
+            self.assertEqual(summary[3], get_median(values))
+            self.assertEqual(summary[4], get_quartiles(values))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
@@ -0,0 +1,127 @@
+import json
+import threading
+import unittest
+
+from api import create_app, db
+from api.metrics import REQUEST_DURATION, REQUESTS, Registry
+
+
+def samples(text):
+    # Parse the Prometheus text format into {'name{labels}': value}
+    return {
+        line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1])
+        for line in text.splitlines()
+        if line and not line.startswith('#')
+    }
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        # Define test variables and initialize app
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        self.device_uuid = 'test_device'
+        self.route = (
+            'method="GET",route="/devices/<string:device_uuid>/readings"'
+        )
+
+        # Setup the SQLite DB
+        db.drop_all()
+        db.create_all()
+
+    def test_metrics_record_requests(self):
+        # Given a device with 50 readings
+        request = self.client.post(
+            f'/devices/{self.device_uuid}/readings/batch',
+            data=json.dumps(
+                [{'type': 'temperature', 'value': v} for v in range(1, 51)]
+            ),
+        )
+        self.assertEqual(request.status_code, 201)
+
+        # When we GET its readings, once streamed, and an unknown route
+        body = self.client.get(
+            f'/devices/{self.device_uuid}/readings'
+        ).get_data()
+        self.client.get(
+            f'/devices/{self.device_uuid}/readings?stream=1'
+        ).get_data()
+        self.client.get('/unknown')
+
+        request = self.client.get('/metrics')
+        self.assertEqual(request.status_code, 200)
+        self.assertTrue(request.content_type.startswith('text/plain'))
+        metrics = samples(request.get_data(as_text=True))
+
+        # Then both reads should be counted in the route's histograms
+        self.assertEqual(
+            metrics[f'http_requests_total{{{self.route},status="200"}}'], 2
+        )
+        self.assertEqual(
+            metrics[f'http_request_duration_seconds_count{{{self.route}}}'],
+            2,
+        )
+        self.assertEqual(
+            metrics[
+                f'http_request_duration_seconds_bucket'
+                f'{{{self.route},le="+Inf"}}'
+            ],
+            2,
+        )
+        self.assertGreater(
+            metrics[f'db_duration_seconds_sum{{{self.route}}}'], 0
+        )
+
+        # And the rows fetched, readings and marks, and the bytes sent,
+        # streamed or not
+        self.assertEqual(metrics[f'db_rows_returned_sum{{{self.route}}}'], 102)
+        self.assertGreater(
+            metrics[f'http_response_size_bytes_sum{{{self.route}}}'],
+            len(body),
+        )
+
+        # And unknown routes should be grouped together
+        self.assertEqual(
+            metrics[
+                'http_requests_total{method="GET",route="<unmatched>",'
+                'status="404"}'
+            ],
+            1,
+        )
+
+        # And the write-behind buffer counters should be exported
+        self.assertEqual(metrics['ingest_queue_depth'], 0)
+
+    def test_registry_merges_threads(self):
+        # Given a registry written to by many threads
+        registry = Registry()
+        labels = ('GET', '/route')
+
+        def record():
+            for _ in range(100):
+                registry.inc(REQUESTS, labels + ('200',))
+                registry.observe(REQUEST_DURATION, labels, 0.002)
+
+        threads = [threading.Thread(target=record) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        # Then a scrape should merge every thread's values
+        collected = registry.collect()
+        self.assertEqual(collected[(REQUESTS, labels + ('200',))], [800])
+        duration = collected[(REQUEST_DURATION, labels)]
+        self.assertEqual(duration[:3], [0, 800, 0])
+        self.assertAlmostEqual(duration[-1], 1.6)
+
+        # And finished threads should be folded into the retired values
+        self.assertEqual(registry.collect(), collected)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
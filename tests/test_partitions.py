@@ -0,0 +1,193 @@
+import json
+import os
+import tempfile
+import unittest
+
+from api import create_app, db
+from api.helpers import get_quartiles
+from api.models import (
+    Reading,
+    ReadingHistogram,
+    ReadingMark,
+    ReadingRollup,
+    ReadingSketch,
+)
+from api.partitions import (
+    PARTITION_TABLE,
+    drop_expired_partitions,
+    partition_starts,
+    partition_table,
+)
+from api.queries import readings_query
+
+DAY = 86400
+
+
+class PartitionsTestCase(unittest.TestCase):
+    def setUp(self):
+        # Define test variables and initialize app with daily partitions
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = create_app('testing')
+        self.app.config.update(
+            SQLALCHEMY_DATABASE_URI='sqlite:///'
+            + os.path.join(self.directory.name, 'partitions.db'),
+            PARTITION_SECONDS=DAY,
+        )
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        self.device_uuid = 'test_device'
+        self.days = [DAY * 20000 + DAY * offset for offset in range(3)]
+
+        # Setup the SQLite DB
+        db.create_all()
+
+        # Ten readings per day, 1..10 on the first day, 11..20 on the second
+        readings = [
+            {
+                'type': sensor_type,
+                'value': index * 10 + value,
+                'date_created': day + value * 60,
+            }
+            for index, day in enumerate(self.days)
+            for value in range(1, 11)
+            for sensor_type in ('temperature', 'pressure')
+        ]
+        request = self.client.post(
+            f'/devices/{self.device_uuid}/readings/batch',
+            data=json.dumps(readings),
+        )
+        self.assertEqual(request.status_code, 201)
+
+    def get(self, route, **params):
+        query = '&'.join(f'{name}={value}' for name, value in params.items())
+        request = self.client.get(
+            f'/devices/{self.device_uuid}/readings{route}?{query}'
+        )
+        return json.loads(request.data)
+
+    def test_readings_are_written_to_their_day(self):
+        # Then every day should have its own partition
+        self.assertEqual(partition_starts(), self.days)
+        self.assertEqual(Reading.query.count(), 0)
+
+        # And the readings should be read back in order with unique ids
+        readings = self.get('', type='temperature')
+        self.assertEqual(
+            [reading['value'] for reading in readings], list(range(1, 31))
+        )
+        ids = {reading.id for reading in readings_query(self.device_uuid)}
+        self.assertEqual(len(ids), 60)
+
+        # And the metrics should span every partition
+        self.assertEqual(self.get('/max', type='temperature')[0]['value'], 30)
+        self.assertEqual(self.get('/mean', type='pressure')['value'], 15.5)
+        median = self.get(
+            '/median',
+            type='pressure',
+            start=self.days[0] + 120,
+            end=self.days[1] + DAY,
+        )
+        self.assertEqual(median[0]['value'], 11)
+        self.assertEqual(
+            self.get(
+                '/quartiles',
+                type='temperature',
+                start=self.days[0],
+                end=self.days[2] + DAY,
+            ),
+            {'quartile_1': 8.0, 'quartile_3': 23.0},
+        )
+
+    def test_non_integer_dates_do_not_create_partitions(self):
+        # When we post a reading whose date is not an integer
+        request = self.client.post(
+            f'/devices/{self.device_uuid}/readings',
+            data=json.dumps(
+                {
+                    'type': 'pressure',
+                    'value': 3,
+                    'date_created': self.days[2] + DAY + 0.5,
+                }
+            ),
+        )
+
+        # Then it should be rejected without creating its partition
+        self.assertEqual(request.status_code, 400)
+        self.assertEqual(partition_starts(), self.days)
+
+        # And partitions should only be named after integer starts
+        with self.assertRaises(TypeError):
+            partition_table(float(self.days[0]))
+
+    def test_range_queries_only_touch_overlapping_partitions(self):
+        # When we query the last day only
+        query = readings_query(
+            self.device_uuid,
+            'temperature',
+            self.days[2],
+            self.days[2] + DAY - 1,
+        )
+        sql = str(query.statement)
+
+        # Then only the last day's partition should be read
+        self.assertIn(PARTITION_TABLE.format(self.days[2]), sql)
+        self.assertNotIn(PARTITION_TABLE.format(self.days[1]), sql)
+        self.assertNotIn(PARTITION_TABLE.format(self.days[0]), sql)
+        self.assertEqual([reading.value for reading in query][0], 21)
+
+    def test_expired_partitions_are_dropped(self):
+        # Given readings kept for a day
+        self.app.config['RETENTION_SECONDS'] = DAY
+        versions = {mark.type: mark.version for mark in ReadingMark.query}
+
+        # When retention runs at the end of the last day
+        dropped = drop_expired_partitions(now=self.days[2] + DAY)
+
+        # Then the first two days should be dropped whole
+        self.assertEqual(dropped, 2)
+        self.assertEqual(partition_starts(), self.days[2:])
+
+        # And so should their histograms, sketches and rollups
+        for model in (ReadingHistogram, ReadingSketch, ReadingRollup):
+            self.assertEqual(
+                model.query.filter(model.bucket < self.days[2]).count(), 0
+            )
+
+        # And the marks of their devices and types should be bumped
+        for mark in ReadingMark.query:
+            self.assertEqual(mark.version, versions[mark.type] + 2)
+
+        # And the metrics should only cover the remaining day
+        self.assertEqual(self.get('/mean', type='pressure')['value'], 25.5)
+        quartiles = get_quartiles(list(range(21, 31)))
+        self.assertEqual(
+            self.get(
+                '/quartiles',
+                type='temperature',
+                start=self.days[0],
+                end=self.days[2] + DAY,
+            ),
+            {'quartile_1': quartiles[0], 'quartile_3': quartiles[1]},
+        )
+
+    def test_dropped_partitions_are_not_served_from_the_cache(self):
+        # Given cached metrics of windows closed on the first two days
+        params = {'type': 'pressure', 'start': self.days[0]}
+        params['end'] = self.days[2] - 1
+        self.assertEqual(self.get('/mean', **params)['value'], 10.5)
+        self.assertEqual(self.get('/max', **params)[0]['value'], 20)
+
+        # When retention drops them
+        self.app.config['RETENTION_SECONDS'] = DAY
+        drop_expired_partitions(now=self.days[2] + DAY)
+
+        # Then the metrics should be computed without their readings
+        self.assertEqual(self.get('/mean', **params)['value'], None)
+        self.assertEqual(self.get('/max', **params), [])
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.directory.cleanup()
@@ -0,0 +1,120 @@
+import json
+import logging
+import unittest
+
+from api import create_app, db
+
+from tests import QueryCountAssertions
+
+
+class QueryCountsTestCase(QueryCountAssertions, unittest.TestCase):
+    def setUp(self):
+        # Define test variables and initialize app
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        self.device_uuid = 'test_device'
+
+        # Setup the SQLite DB
+        db.drop_all()
+        db.create_all()
+
+    def seed(self, devices, first=0):
+        readings = [
+            {
+                'device_uuid': f'device_{device}',
+                'type': sensor_type,
+                'value': value,
+                'date_created': 1000 + value * 60,
+            }
+            for device in range(first, first + devices)
+            for sensor_type in ('temperature', 'pressure')
+            for value in range(1, 21)
+        ]
+        request = self.client.post(
+            '/devices/readings/batch', data=json.dumps(readings)
+        )
+        self.assertEqual(request.status_code, 201)
+
+    def test_routes_run_a_bounded_number_of_queries(self):
+        # Given a device with readings of a restricted and another type
+        self.seed(1)
+        route = '/devices/device_0/readings'
+        query = 'start=0&end=5000'
+
+        # Then every route should run a handful of queries, device routes
+        # including the lookup of their marks
+        for path, maximum in (
+            (f'{route}?type=temperature&{query}', 2),
+            (f'{route}?type=temperature&{query}&limit=5', 2),
+            (f'{route}?type=temperature&{query}&stream=1', 2),
+            (f'{route}/max?type=temperature&{query}', 2),
+            (f'{route}/top?type=pressure&{query}', 2),
+            (f'{route}/bottom?type=pressure&{query}', 2),
+            (f'{route}/median?type=temperature&{query}', 4),
+            (f'{route}/median?type=pressure&{query}', 4),
+            (f'{route}/median?type=pressure&{query}&approx=true', 4),
+            (f'{route}/mean?type=pressure&{query}', 3),
+            (f'{route}/quartiles?type=temperature&{query}', 3),
+            (f'{route}/quartiles?type=pressure&{query}', 5),
+            (f'/devices/readings?{query}', 1),
+            (f'/devices/readings?type=temperature&{query}', 2),
+        ):
+            with self.subTest(path=path), self.assertMaxQueries(maximum):
+                request = self.client.get(path)
+                request.get_data()
+                self.assertEqual(request.status_code, 200)
+
+    def test_queries_do_not_grow_with_devices(self):
+        # When we ingest and summarize 1 and then 20 new devices
+        counts = []
+        for first, devices in ((0, 1), (1, 20)):
+            with self.assertMaxQueries(5) as ingest:
+                self.seed(devices, first)
+
+            with self.assertMaxQueries(1) as summary:
+                self.client.get('/devices/readings')
+
+            counts.append((ingest.queries, summary.queries))
+
+        # Then the number of queries should not depend on the devices
+        self.assertEqual(counts[0], counts[1])
+
+    def test_debug_headers(self):
+        # When we make a request in debug mode
+        request = self.client.get(
+            f'/devices/{self.device_uuid}/readings?type=temperature'
+        )
+
+        # Then its queries should be reported in the headers
+        self.assertEqual(request.headers['X-Query-Count'], '2')
+        self.assertGreater(float(request.headers['X-Query-Time-Ms']), 0)
+
+        # And not outside debug mode
+        self.app.debug = False
+        request = self.client.get(
+            f'/devices/{self.device_uuid}/readings?type=temperature'
+        )
+        self.assertNotIn('X-Query-Count', request.headers)
+
+    def test_slow_queries_are_logged_with_their_plan(self):
+        # Given a threshold every statement exceeds
+        self.app.config['SLOW_QUERY_SECONDS'] = 1e-9
+
+        # When we make a request
+        with self.assertLogs('api.slow_queries', logging.WARNING) as logs:
+            self.client.get(
+                f'/devices/{self.device_uuid}/readings?type=temperature'
+            )
+
+        # Then its statements should be logged with parameters and plan
+        message = logs.output[-1]
+        self.assertIn('SELECT', message)
+        self.assertIn(f"'{self.device_uuid}'", message)
+        self.assertIn('SEARCH readings USING', message)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
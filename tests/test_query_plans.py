@@ -0,0 +1,123 @@
+import unittest
+
+from api import create_app, db
+from api.queries import (
+    aggregate_query,
+    extreme_readings_query,
+    page_readings,
+    readings_query,
+    sorted_values_query,
+    summary_query,
+)
+
+INDEX = 'ix_readings_device_type_date'
+
+
+class QueryPlansTestCase(unittest.TestCase):
+    def setUp(self):
+        # Define test variables and initialize app
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.device_uuid = 'test_device'
+
+        # Setup the SQLite DB
+        db.drop_all()
+        db.create_all()
+
+    def explain(self, query):
+        statement = query.statement.compile(
+            dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}
+        )
+        rows = db.session.execute(f'EXPLAIN QUERY PLAN {statement}')
+        return ' '.join(row[-1] for row in rows)
+
+    def assertSearchesIndex(self, query):
+        plan = self.explain(query)
+        self.assertIn(f'SEARCH readings USING INDEX {INDEX}', plan)
+        self.assertIn('type=?', plan)
+        self.assertIn('date_created>?', plan)
+
+    def test_device_readings_query_plan(self):
+        # Given a device, type and date range
+        # When we explain the readings list query
+        query = readings_query(self.device_uuid, 'temperature', 1, 2)
+
+        # Then it should be a range scan on the composite index
+        self.assertSearchesIndex(query)
+
+    def test_device_readings_max_query_plan(self):
+        # Given the max, top and bottom route queries
+        for descending in (True, False):
+            query = extreme_readings_query(
+                self.device_uuid, 'temperature', 1, 2, descending=descending
+            ).limit(10)
+
+            # Then they should walk the value index without sorting
+            plan = self.explain(query)
+            self.assertIn(
+                'SEARCH readings USING COVERING INDEX '
+                'ix_readings_device_type_value',
+                plan,
+            )
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_device_readings_median_query_plan(self):
+        # Given the median route selecting a value by position
+        query = readings_query(self.device_uuid, 'pressure', 1, 2)
+        statement = sorted_values_query(query).offset(10).limit(1)
+
+        # Then it should walk the value index without sorting
+        plan = self.explain(statement)
+        self.assertIn(
+            'SEARCH readings USING COVERING INDEX '
+            'ix_readings_device_type_value',
+            plan,
+        )
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_device_readings_mean_query_plan(self):
+        # Given the mean route query
+        query = aggregate_query(
+            db.func.avg, self.device_uuid, 'temperature', 1, 2
+        )
+
+        # Then it should be a range scan on the composite index
+        self.assertSearchesIndex(query)
+
+    def test_readings_summary_query_plan(self):
+        # Given the summary route query
+        query = summary_query('temperature', 1, 2)
+
+        # Then the scan should be served by the value index alone
+        self.assertIn(
+            'USING COVERING INDEX ix_readings_device_type_value',
+            self.explain(query),
+        )
+
+    def test_substring_type_match_query_plan(self):
+        # Given a client opting into substring type matching
+        query = readings_query(self.device_uuid, 'temp', 1, 2, substring=True)
+
+        # Then an index should still narrow the scan to the device
+        plan = self.explain(query)
+        self.assertIn('SEARCH readings USING INDEX', plan)
+        self.assertIn('device_uuid=?', plan)
+
+    def test_device_readings_page_query_plan(self):
+        # Given a page of readings after a cursor position
+        for type in ('temperature', None):
+            query = page_readings(
+                readings_query(self.device_uuid, type), (1, 2), 10
+            )
+
+            # Then it should seek past the position without sorting
+            plan = self.explain(query)
+            self.assertIn('SEARCH readings USING INDEX', plan)
+            self.assertIn('date_created>?', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
@@ -0,0 +1,102 @@
+import random
+import unittest
+
+from api import create_app, db
+from api.helpers import plan_time_range
+from api.ingest import insert_readings
+from api.models import ROLLUP_WIDTHS, Reading
+from api.rollups import rollup_aggregates
+
+
+class RollupsTestCase(unittest.TestCase):
+    def setUp(self):
+        # Define test variables and initialize app
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.device_uuid = 'test_device'
+
+        # Setup the SQLite DB
+        db.drop_all()
+        db.create_all()
+
+        # Setup readings spread over a few days
+        generator = random.Random(5)
+        self.rows = [
+            {
+                'device_uuid': self.device_uuid,
+                'type': 'pressure',
+                'value': generator.randint(-500, 500),
+                'date_created': generator.randint(0, 4 * 86400),
+            }
+            for _ in range(2000)
+        ]
+        insert_readings(self.rows)
+
+    def expected(self, start, end):
+        values = [
+            row['value']
+            for row in self.rows
+            if (start is None or row['date_created'] >= start)
+            and (end is None or row['date_created'] <= end)
+        ]
+        return (
+            len(values),
+            sum(values),
+            min(values, default=None),
+            max(values, default=None),
+        )
+
+    def random_ranges(self):
+        generator = random.Random(11)
+        ranges = [(None, None), (None, 100000), (86400, 2 * 86400 - 1)]
+        for _ in range(30):
+            start = generator.randint(0, 4 * 86400)
+            ranges.append((start, start + generator.randint(0, 2 * 86400)))
+
+        return ranges
+
+    def test_plan_time_range_covers_range(self):
+        for start, end in self.random_ranges()[3:]:
+            # Given a range planned over the rollup widths
+            segments, edges = plan_time_range(start, end, ROLLUP_WIDTHS)
+
+            # Then segments and edges should tile the range exactly
+            pieces = [(first, stop - 1) for _, first, stop in segments] + edges
+            pieces.sort()
+            self.assertEqual(pieces[0][0], start)
+            self.assertEqual(pieces[-1][1], end)
+            for (_, previous_end), (next_start, _) in zip(pieces, pieces[1:]):
+                self.assertEqual(previous_end + 1, next_start)
+
+            # And the edges should be shorter than the smallest rollup
+            for edge_start, edge_end in edges:
+                self.assertLess(edge_end - edge_start, ROLLUP_WIDTHS[-1])
+
+    def test_rollup_aggregates_match_raw_readings(self):
+        for start, end in self.random_ranges():
+            # When we aggregate a range from the rollups
+            aggregates = rollup_aggregates(
+                self.device_uuid, 'pressure', start, end
+            )
+
+            # Then it should match the raw readings
+            self.assertEqual(aggregates, self.expected(start, end))
+
+    def test_rollups_maintained_on_delete(self):
+        # Given some readings are deleted
+        Reading.query.filter(Reading.value > 0).delete()
+        db.session.commit()
+        self.rows = [row for row in self.rows if row['value'] <= 0]
+
+        # Then the rollups should only reflect the readings left
+        for start, end in self.random_ranges():
+            aggregates = rollup_aggregates(
+                self.device_uuid, 'pressure', start, end
+            )
+            self.assertEqual(aggregates, self.expected(start, end))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
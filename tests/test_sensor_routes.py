@@ -4,6 +4,7 @@ import unittest
 
 import pytest
 from api import create_app, db
+from api.helpers import get_quartiles
 from api.models import Reading
 
 
@@ -101,6 +102,322 @@ class SensorRoutesTestCase(unittest.TestCase):
         # We should have five
         self.assertTrue(rows == 5)
 
+    def test_device_readings_batch_post(self):
+        # Given a device UUID
+        # When we make a request with a batch of readings
+        request = self.client.post(
+            f'/devices/{self.device_uuid}/readings/batch',
+            data=json.dumps(
+                [
+                    {'type': 'temperature', 'value': 30},
+                    {'type': 'humidity', 'value': 40},
+                    {'type': 'temperature', 'value': 101},
+                    {'type': 'humidity'},
+                ]
+            ),
+        )
+
+        # Then we should receive a 201
+        self.assertEqual(request.status_code, 201)
+
+        # And the invalid readings should be reported by position
+        data = json.loads(request.data)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual([e['index'] for e in data['errors']], [2, 3])
+
+        # And when we check for readings in the db
+        rows = Reading.query.filter_by(device_uuid=self.device_uuid).count()
+
+        # We should have six
+        self.assertTrue(rows == 6)
+
+        # And when no reading in the batch is valid
+        request = self.client.post(
+            f'/devices/{self.device_uuid}/readings/batch',
+            data=json.dumps([{'type': 'temperature', 'value': 101}]),
+        )
+
+        # Then we should receive a 400
+        self.assertEqual(request.status_code, 400)
+
+        # And when the body is not an array
+        request = self.client.post(
+            f'/devices/{self.device_uuid}/readings/batch',
+            data=json.dumps({'type': 'temperature', 'value': 30}),
+        )
+
+        # Then we should receive a 400
+        self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_post_non_integer(self):
+        # Given values that are not integers, for an unrestricted type
+        for value in (2.5, 50.0, '7', True, 2**63):
+            # When we make a request to create a reading
+            with self.subTest(value=value):
+                request = self.client.post(
+                    f'/devices/{self.device_uuid}/readings',
+                    data=json.dumps({'type': 'pressure', 'value': value}),
+                )
+
+                # Then we should receive a 400
+                self.assertEqual(request.status_code, 400)
+
+        # And when one is part of a batch
+        request = self.client.post(
+            f'/devices/{self.device_uuid}/readings/batch',
+            data=json.dumps(
+                [
+                    {'type': 'pressure', 'value': 2.5},
+                    {'type': 'pressure', 'value': 3},
+                ]
+            ),
+        )
+
+        # Then only that reading should be rejected
+        self.assertEqual(request.status_code, 201)
+        data = json.loads(request.data)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual([e['index'] for e in data['errors']], [0])
+        self.assertEqual(
+            [
+                reading.value
+                for reading in Reading.query.filter_by(type='pressure')
+            ],
+            [3],
+        )
+
+    def test_device_readings_post_non_string_fields(self):
+        # Given types that are not strings
+        for sensor_type in (['temperature'], {'name': 'temperature'}, 7):
+            # When we make a request to create a reading
+            with self.subTest(type=sensor_type):
+                request = self.client.post(
+                    f'/devices/{self.device_uuid}/readings',
+                    data=json.dumps({'type': sensor_type, 'value': 30}),
+                )
+
+                # Then we should receive a 400
+                self.assertEqual(request.status_code, 400)
+
+        # And when readings of a batch have a type or device_uuid that is
+        # not a string
+        request = self.client.post(
+            '/devices/readings/batch',
+            data=json.dumps(
+                [
+                    {'device_uuid': 'a', 'type': ['x'], 'value': 30},
+                    {'device_uuid': 7, 'type': 'pressure', 'value': 30},
+                    {'device_uuid': ['a'], 'type': 'pressure', 'value': 30},
+                    {'device_uuid': 'a', 'type': 'pressure', 'value': 30},
+                ]
+            ),
+        )
+
+        # Then only those readings should be rejected
+        self.assertEqual(request.status_code, 201)
+        data = json.loads(request.data)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual([e['index'] for e in data['errors']], [0, 1, 2])
+        self.assertEqual(Reading.query.filter_by(device_uuid='a').count(), 1)
+
+    def test_device_readings_post_non_integer_dates(self):
+        # Given dates that are not integers
+        for date_created in ('abc', '1000', 1000.5, True, 2**63):
+            # When we make a request to create a reading
+            with self.subTest(date_created=date_created):
+                request = self.client.post(
+                    f'/devices/{self.device_uuid}/readings',
+                    data=json.dumps(
+                        {
+                            'type': 'pressure',
+                            'value': 3,
+                            'date_created': date_created,
+                        }
+                    ),
+                )
+
+                # Then we should receive a 400
+                self.assertEqual(request.status_code, 400)
+
+        # And when one is part of a batch
+        request = self.client.post(
+            f'/devices/{self.device_uuid}/readings/batch',
+            data=json.dumps(
+                [
+                    {'type': 'pressure', 'value': 3, 'date_created': 'abc'},
+                    {'type': 'pressure', 'value': 4, 'date_created': 1000},
+                ]
+            ),
+        )
+
+        # Then only that reading should be rejected
+        self.assertEqual(request.status_code, 201)
+        data = json.loads(request.data)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual([e['index'] for e in data['errors']], [0])
+        self.assertEqual(
+            [
+                reading.value
+                for reading in Reading.query.filter_by(type='pressure')
+            ],
+            [4],
+        )
+
+    def test_readings_batch_post(self):
+        # Given readings for several devices
+        # When we make a request to the fleet-wide batch endpoint
+        request = self.client.post(
+            '/devices/readings/batch',
+            data=json.dumps(
+                [
+                    {'device_uuid': 'a', 'type': 'temperature', 'value': 30},
+                    {'device_uuid': 'b', 'type': 'temperature', 'value': 40},
+                    {'type': 'temperature', 'value': 50},
+                ]
+            ),
+        )
+
+        # Then we should receive a 201
+        self.assertEqual(request.status_code, 201)
+
+        # And readings without a device_uuid should be rejected
+        data = json.loads(request.data)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(data['errors'][0]['index'], 2)
+
+        # And each reading should belong to its device
+        self.assertEqual(Reading.query.filter_by(device_uuid='a').count(), 1)
+        self.assertEqual(Reading.query.filter_by(device_uuid='b').count(), 1)
+
+    def test_device_readings_post_buffered(self):
+        # Given the write-behind buffer is enabled
+        self.app.config['INGEST_BUFFER_ENABLED'] = True
+
+        # When we make a request with the given UUID to create a reading
+        request = self.client.post(
+            f'/devices/{self.device_uuid}/readings',
+            data=json.dumps({'type': 'temperature', 'value': 100}),
+        )
+
+        # Then we should receive a 202
+        self.assertEqual(request.status_code, 202)
+
+        # And when the buffer is shut down
+        self.app.extensions['ingest_buffer'].stop()
+
+        # Then the reading should have been flushed to the db
+        rows = Reading.query.filter_by(device_uuid=self.device_uuid).count()
+        self.assertTrue(rows == 5)
+
+        # And the counters should reflect the flush
+        request = self.client.get('/ingest/stats')
+        stats = json.loads(request.data)
+        self.assertEqual(stats['rows_flushed'], 1)
+        self.assertEqual(stats['queue_depth'], 0)
+
+        # And further readings should be rejected once stopped
+        request = self.client.post(
+            f'/devices/{self.device_uuid}/readings',
+            data=json.dumps({'type': 'temperature', 'value': 100}),
+        )
+        self.assertEqual(request.status_code, 503)
+
+    def test_device_readings_buffered_poisoned_row(self):
+        # Given queued readings, one of which SQLite cannot store
+        buffer = self.app.extensions['ingest_buffer']
+        for value in (1, 2, 2**64, 4, 5):
+            buffer.submit(
+                {
+                    'device_uuid': 'buffered',
+                    'type': 'pressure',
+                    'value': value,
+                    'date_created': 1000 + value,
+                }
+            )
+
+        # When the buffer is shut down
+        buffer.stop()
+
+        # Then every other reading should have been flushed to the db
+        self.assertEqual(
+            sorted(
+                reading.value
+                for reading in Reading.query.filter_by(device_uuid='buffered')
+            ),
+            [1, 2, 4, 5],
+        )
+
+        # And only the poisoned reading should be counted as failed
+        stats = buffer.stats()
+        self.assertEqual(stats['rows_flushed'], 4)
+        self.assertEqual(stats['rows_failed'], 1)
+
+    def test_device_readings_get_stream(self):
+        # Given a device UUID
+        # When we request the readings as a stream
+        request = self.client.get(
+            f'/devices/{self.device_uuid}/readings?stream=1'
+        )
+
+        # Then we should receive newline delimited JSON
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.mimetype, 'application/x-ndjson')
+
+        # And each of the four sensor readings should be on its own line
+        lines = request.data.decode().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(json.loads(lines[0])['device_uuid'], self.device_uuid)
+
+        # And when we ask for it through the Accept header
+        request = self.client.get(
+            f'/devices/{self.device_uuid}/readings?type=temperature',
+            headers={'Accept': 'application/x-ndjson'},
+        )
+
+        # Then the readings should be streamed as well
+        self.assertEqual(len(request.data.decode().splitlines()), 4)
+
+    def test_device_readings_get_pages(self):
+        # Given a device UUID
+        # When we page through its readings two at a time
+        pages = []
+        url = f'/devices/{self.device_uuid}/readings?limit=2'
+        while url:
+            request = self.client.get(url)
+            self.assertEqual(request.status_code, 200)
+            page = json.loads(request.data)
+            pages.append(page['readings'])
+            url = None
+            if page['next']:
+                url = (
+                    f'/devices/{self.device_uuid}/readings'
+                    f'?limit=2&cursor={page["next"]}'
+                )
+
+        # Then we should receive the four readings over two pages
+        self.assertEqual([len(page) for page in pages], [2, 2])
+
+        # And they should be ordered by date_created
+        dates = [reading['date_created'] for page in pages for reading in page]
+        self.assertEqual(dates, sorted(dates))
+
+        # And when the cursor is malformed
+        request = self.client.get(
+            f'/devices/{self.device_uuid}/readings?limit=2&cursor=bogus'
+        )
+
+        # Then we should receive a 400
+        self.assertEqual(request.status_code, 400)
+
+        # And when the limit is not an integer
+        for limit in ('two', '2.5'):
+            request = self.client.get(
+                f'/devices/{self.device_uuid}/readings?limit={limit}'
+            )
+
+            # Then we should receive a 400
+            self.assertEqual(request.status_code, 400)
+
     def test_device_readings_get_temperature(self):
         # Given a device UUID
         # When we filter by temperature type
@@ -121,6 +438,25 @@ class SensorRoutesTestCase(unittest.TestCase):
         # Then the response data should have 0 sensor readings
         self.assertTrue(len(json.loads(request.data)) == 0)
 
+    def test_device_readings_get_type_match(self):
+        # Given a device UUID
+        # When we filter by a partial type name
+        request = self.client.get(
+            f'/devices/{self.device_uuid}/readings?type=temp'
+        )
+
+        # Then the type should be matched exactly and find no readings
+        self.assertTrue(len(json.loads(request.data)) == 0)
+
+        # And when we opt into substring matching
+        request = self.client.get(
+            f'/devices/{self.device_uuid}/readings'
+            '?type=temp&type_match=substring'
+        )
+
+        # Then the response data should have four sensor readings
+        self.assertTrue(len(json.loads(request.data)) == 4)
+
     def test_device_readings_get_past_dates(self):
         # Given a device UUID
         # When we filter by end date using now
@@ -149,6 +485,72 @@ class SensorRoutesTestCase(unittest.TestCase):
         # Then the response data value should be 100
         self.assertEqual(json.loads(request.data)[0]['value'], 100)
 
+    def test_device_readings_max_scoped(self):
+        # Given another device with an equal max reading
+        self.client.post(
+            '/devices/other/readings',
+            data=json.dumps({'type': 'temperature', 'value': 100}),
+        )
+
+        # When we make a request to get the max value of our device
+        request = self.client.get(
+            f'/devices/{self.device_uuid}/readings/max?type=temperature'
+        )
+
+        # Then only our device's reading should be returned
+        data = json.loads(request.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['device_uuid'], self.device_uuid)
+
+        # And when the range excludes the latest readings
+        end = int(time.time()) - 10
+        request = self.client.get(
+            f'/devices/{self.device_uuid}/readings/max'
+            f'?type=temperature&end={end}'
+        )
+
+        # Then the max should be taken within the range
+        self.assertEqual(json.loads(request.data)[0]['value'], 50)
+
+    def test_device_readings_top_and_bottom(self):
+        # Given a device UUID
+        # When we make a request to get the top two readings
+        request = self.client.get(
+            f'/devices/{self.device_uuid}/readings/top?type=temperature&k=2'
+        )
+
+        # Then the two highest values should be returned, highest first
+        values = [reading['value'] for reading in json.loads(request.data)]
+        self.assertEqual(values, [100, 50])
+
+        # And when we make a request to get the bottom three readings
+        request = self.client.get(
+            f'/devices/{self.device_uuid}/readings/bottom'
+            '?type=temperature&k=3'
+        )
+
+        # Then the three lowest values should be returned, lowest first
+        values = [reading['value'] for reading in json.loads(request.data)]
+        self.assertEqual(values, [22, 22, 50])
+
+        # And when k is out of range
+        request = self.client.get(
+            f'/devices/{self.device_uuid}/readings/top?type=temperature&k=0'
+        )
+
+        # Then we should receive a 400
+        self.assertEqual(request.status_code, 400)
+
+        # And when k is not an integer
+        for route in ('top', 'bottom'):
+            request = self.client.get(
+                f'/devices/{self.device_uuid}/readings/{route}'
+                '?type=temperature&k=many'
+            )
+
+            # Then we should receive a 400
+            self.assertEqual(request.status_code, 400)
+
     def test_device_readings_median(self):
         # Given a device UUID
         # When we make a request to get median value by temperature type
@@ -173,6 +575,62 @@ class SensorRoutesTestCase(unittest.TestCase):
         # Then the response data should have one sensor readings
         self.assertTrue(len(json.loads(request.data)) == 1)
 
+    def test_device_readings_median_approx(self):
+        # Given readings of an unrestricted sensor type
+        self.client.post(
+            f'/devices/{self.device_uuid}/readings/batch',
+            data=json.dumps(
+                [
+                    {'type': 'pressure', 'value': value, 'date_created': 10}
+                    for value in (1010, 990, 1000)
+                ]
+            ),
+        )
+
+        # When we make a request to get an approximate median
+        request = self.client.get(
+            f'/devices/{self.device_uuid}/readings/median'
+            '?type=pressure&approx=true'
+        )
+
+        # Then the response data should have the median reading
+        data = json.loads(request.data)
+        self.assertEqual([reading['value'] for reading in data], [1000])
+
+    def test_device_readings_median_and_quartiles_selected(self):
+        # Given readings of an unrestricted sensor type
+        values = [1010, 990, 1000, 1020, 970, 1000, 1035]
+        self.client.post(
+            f'/devices/{self.device_uuid}/readings/batch',
+            data=json.dumps(
+                [
+                    {'type': 'pressure', 'value': value, 'date_created': 10}
+                    for value in values
+                ]
+            ),
+        )
+
+        # When we make a request to get the median
+        request = self.client.get(
+            f'/devices/{self.device_uuid}/readings/median?type=pressure'
+        )
+
+        # Then the median readings should be returned
+        data = json.loads(request.data)
+        self.assertEqual([reading['value'] for reading in data], [1000, 1000])
+
+        # And when we make a request to get the quartiles
+        request = self.client.get(
+            f'/devices/{self.device_uuid}/readings/quartiles'
+            '?type=pressure&start=0&end=20'
+        )
+
+        # Then they should match the quartiles of the values
+        data = json.loads(request.data)
+        self.assertEqual(
+            (data['quartile_1'], data['quartile_3']), get_quartiles(values)
+        )
+
     def test_device_readings_mean(self):
         # Given a device UUID
         # When we make a request to get mean value by temperature type
@@ -206,6 +664,46 @@ class SensorRoutesTestCase(unittest.TestCase):
         self.assertTrue(len(json.loads(request.data)) == 1)
         self.assertEqual(json.loads(request.data)[0]['number_of_readings'], 4)
 
+    def test_device_readings_filters(self):
+        # Given readings for a second device and another type
+        self.client.post(
+            '/devices/readings/batch',
+            data=json.dumps(
+                [
+                    {'device_uuid': 'b', 'type': 'humidity', 'value': 90},
+                    {'device_uuid': 'b', 'type': 'temperature', 'value': 1},
+                    {'device_uuid': 'b', 'type': 'temperature', 'value': 3},
+                ]
+            ),
+        )
+
+        # When we make a request to get the temperature summary
+        request = self.client.get('/devices/readings?type=temperature')
+        data = json.loads(request.data)
+
+        # Then devices should be sorted by number of readings
+        self.assertEqual(
+            [summary['device_uuid'] for summary in data],
+            [self.device_uuid, 'b'],
+        )
+
+        # And every statistic should ignore the humidity reading
+        other = data[1]
+        self.assertEqual(other['number_of_readings'], 2)
+        self.assertEqual(other['max_reading_value'], 3)
+        self.assertEqual(other['median_reading_value'], 2)
+        self.assertEqual(other['mean_reading_value'], 2)
+        self.assertEqual(other['quartile_1_value'], '1')
+        self.assertEqual(other['quartile_3_value'], '3')
+
+        # And the first device should match the per device metrics
+        summary = data[0]
+        self.assertEqual(summary['max_reading_value'], 100)
+        self.assertEqual(summary['median_reading_value'], 36)
+        self.assertEqual(summary['mean_reading_value'], 48.5)
+        self.assertEqual(summary['quartile_1_value'], '22')
+        self.assertEqual(summary['quartile_3_value'], '75')
+
     def tearDown(self):
         db.session.remove()
         db.drop_all()
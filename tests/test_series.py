@@ -0,0 +1,142 @@
+import json
+import random
+import unittest
+
+from api import create_app, db
+from api.ingest import insert_readings
+from api.series import bucket_series
+
+from tests import QueryCountAssertions
+
+
+class SeriesTestCase(QueryCountAssertions, unittest.TestCase):
+    def setUp(self):
+        # Define test variables and initialize app
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        self.device_uuid = 'test_device'
+        self.path = f'/devices/{self.device_uuid}/readings/series'
+
+        # Setup the SQLite DB
+        db.drop_all()
+        db.create_all()
+
+        # Setup readings spread over a few days
+        generator = random.Random(7)
+        self.rows = [
+            {
+                'device_uuid': self.device_uuid,
+                'type': 'pressure',
+                'value': generator.randint(1, 500),
+                'date_created': generator.randint(0, 3 * 86400),
+            }
+            for _ in range(2000)
+        ]
+        insert_readings(self.rows)
+
+    def expected(self, interval, start, end):
+        buckets = {}
+        for row in self.rows:
+            if start is not None and row['date_created'] < start:
+                continue
+
+            if end is not None and row['date_created'] > end:
+                continue
+
+            bucket = row['date_created'] // interval * interval
+            buckets.setdefault(bucket, []).append(row['value'])
+
+        return [
+            (bucket, len(values), sum(values), min(values), max(values))
+            for bucket, values in sorted(buckets.items())
+        ]
+
+    def test_buckets_match_raw_readings(self):
+        # Given intervals grouped from rollups or only from raw readings
+        generator = random.Random(3)
+        ranges = [(None, None), (None, 100000), (5000, None)]
+        for _ in range(10):
+            start = generator.randint(0, 3 * 86400)
+            ranges.append((start, start + generator.randint(0, 86400)))
+
+        for interval in (45, 60, 300, 3600, 7200, 86400):
+            for start, end in ranges:
+                # When we bucket the readings of the range
+                with self.subTest(interval=interval, start=start, end=end):
+                    series = bucket_series(
+                        self.device_uuid, 'pressure', interval, start, end
+                    )
+
+                    # Then each bucket should match the raw readings
+                    self.assertEqual(
+                        series, self.expected(interval, start, end)
+                    )
+
+        # And substring types should be bucketed from raw readings
+        self.assertEqual(
+            bucket_series(
+                self.device_uuid, 'press', 3600, 1000, 90000, substring=True
+            ),
+            self.expected(3600, 1000, 90000),
+        )
+
+    def test_series_route(self):
+        # When we GET hourly aggregates
+        with self.assertMaxQueries(4):
+            request = self.client.get(
+                self.path,
+                query_string={
+                    'type': 'pressure',
+                    'interval': 3600,
+                    'agg': 'mean,max,min,count',
+                    'start': 1000,
+                    'end': 90000,
+                },
+            )
+
+        # Then one point per bucket should be returned
+        self.assertEqual(request.status_code, 200)
+        points = json.loads(request.data)
+        expected = self.expected(3600, 1000, 90000)
+        self.assertEqual(len(points), len(expected))
+        for point, (bucket, count, total, minimum, maximum) in zip(
+            points, expected
+        ):
+            self.assertEqual(point['date_created'], bucket)
+            self.assertEqual(point['count'], count)
+            self.assertEqual(point['min'], minimum)
+            self.assertEqual(point['max'], maximum)
+            self.assertAlmostEqual(point['mean'], total / count)
+
+        # And a capped number of readings should be picked in date order
+        request = self.client.get(
+            self.path, query_string={'type': 'pressure', 'points': 100}
+        )
+        points = json.loads(request.data)
+        self.assertEqual(len(points), 100)
+        dates = [point['date_created'] for point in points]
+        self.assertEqual(dates, sorted(dates))
+        self.assertEqual(
+            dates[0], min(row['date_created'] for row in self.rows)
+        )
+
+    def test_invalid_series_requests(self):
+        for params in (
+            {'interval': 60},
+            {'type': 'pressure'},
+            {'type': 'pressure', 'interval': 60, 'points': 100},
+            {'type': 'pressure', 'interval': 0},
+            {'type': 'pressure', 'interval': 60, 'agg': 'median'},
+            {'type': 'pressure', 'points': 2},
+            {'type': 'pressure', 'points': 10001},
+        ):
+            with self.subTest(params=params):
+                request = self.client.get(self.path, query_string=params)
+                self.assertEqual(request.status_code, 400)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
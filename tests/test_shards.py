@@ -0,0 +1,238 @@
+import json
+import os
+import tempfile
+import unittest
+from collections import Counter
+
+from api import create_app, db
+from api.models import Reading
+from api.partitions import compact_cold_partitions
+from api.shards import jump_hash, rebalance_shards, shard_bind, use_shard
+
+
+class JumpHashTestCase(unittest.TestCase):
+    def test_growing_only_moves_keys_to_the_new_bucket(self):
+        # Given keys hashed into 4 and then 5 buckets
+        keys = [key * 0x9E3779B97F4A7C15 % 2**64 for key in range(10000)]
+        before = [jump_hash(key, 4) for key in keys]
+        after = [jump_hash(key, 5) for key in keys]
+
+        # Then the keys that moved should all be in the new bucket
+        moved = [b for a, b in zip(before, after) if a != b]
+        self.assertEqual(set(moved), {4})
+
+        # And about a fifth of the keys should have moved
+        self.assertAlmostEqual(len(moved) / len(keys), 0.2, delta=0.02)
+
+        # And the keys should be spread evenly across the buckets
+        for count in Counter(after).values():
+            self.assertAlmostEqual(count / len(keys), 0.2, delta=0.02)
+
+
+class ShardsTestCase(unittest.TestCase):
+    def setUp(self):
+        # Define test variables and initialize app sharded across 4 files
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = create_app('testing')
+        self.app.config.update(
+            SQLALCHEMY_DATABASE_URI='sqlite:///'
+            + os.path.join(self.directory.name, 'default.db'),
+            SHARD_DATABASE_URI='sqlite:///'
+            + os.path.join(self.directory.name, 'shard_{shard}.db'),
+            SHARD_COUNT=4,
+        )
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        self.devices = [f'device_{index}' for index in range(12)]
+
+        # Setup the shard databases
+        db.create_all()
+
+    def ingest(self):
+        for index, device_uuid in enumerate(self.devices):
+            request = self.client.post(
+                f'/devices/{device_uuid}/readings/batch',
+                data=json.dumps(
+                    [
+                        {'type': 'temperature', 'value': value}
+                        for value in range(1, index + 2)
+                    ]
+                ),
+            )
+            self.assertEqual(request.status_code, 201)
+
+    def device_counts(self, bind):
+        with use_shard(bind):
+            query = db.session.query(
+                Reading.device_uuid, db.func.count(Reading.id)
+            ).group_by(Reading.device_uuid)
+            return dict(query.all())
+
+    def test_devices_are_written_to_a_single_shard(self):
+        # When we ingest readings of many devices
+        self.ingest()
+
+        # Then each device's readings should be in its shard only
+        for shard in range(4):
+            bind = f'shard_{shard}'
+            for device_uuid in self.device_counts(bind):
+                self.assertEqual(shard_bind(device_uuid), bind)
+
+        # And nothing should have been written to the default database
+        self.assertEqual(self.device_counts(None), {})
+
+        # And per-device routes should read from the device's shard
+        request = self.client.get(
+            '/devices/device_5/readings/max?type=temperature'
+        )
+        self.assertEqual(json.loads(request.data)[0]['value'], 6)
+
+    def test_multi_device_batches_are_split_by_shard(self):
+        # When we ingest readings of many devices in one batch
+        request = self.client.post(
+            '/devices/readings/batch',
+            data=json.dumps(
+                [
+                    {'device_uuid': device_uuid, 'type': 'pH', 'value': 7}
+                    for device_uuid in self.devices
+                ]
+                + [{'device_uuid': 7, 'type': 'pH', 'value': 7}]
+            ),
+        )
+
+        # Then every reading should land in its device's shard
+        self.assertEqual(request.status_code, 201)
+        errors = json.loads(request.data)['errors']
+        self.assertEqual(
+            [error['index'] for error in errors], [len(self.devices)]
+        )
+        for device_uuid in self.devices:
+            counts = self.device_counts(shard_bind(device_uuid))
+            self.assertEqual(counts[device_uuid], 1)
+
+    def test_summary_merges_every_shard(self):
+        # Given readings spread across the shards
+        self.ingest()
+
+        # When we request the fleet summary
+        request = self.client.get('/devices/readings')
+        summaries = json.loads(request.data)
+
+        # Then every device should be summarized, most active first
+        self.assertEqual(
+            [summary['device_uuid'] for summary in summaries],
+            list(reversed(self.devices)),
+        )
+        self.assertEqual(summaries[0]['number_of_readings'], 12)
+        self.assertEqual(summaries[0]['median_reading_value'], 6.5)
+
+        # And restricted types should be summarized from every shard too
+        request = self.client.get('/devices/readings?type=temperature')
+        self.assertEqual(len(json.loads(request.data)), 12)
+
+    def test_batch_metrics_merge_every_shard(self):
+        # Given readings spread across the shards
+        self.ingest()
+
+        # When we POST for the metrics of every device
+        request = self.client.post(
+            '/devices/readings/metrics',
+            data=json.dumps({'devices': self.devices, 'type': 'temperature'}),
+        )
+        results = json.loads(request.data)
+
+        # Then each device should be measured from its shard
+        self.assertEqual(set(results), set(self.devices))
+        for index, device_uuid in enumerate(self.devices):
+            self.assertEqual(
+                results[device_uuid]['number_of_readings'], index + 1
+            )
+            self.assertEqual(results[device_uuid]['max'], index + 1)
+
+    def test_rebalance_moves_devices_to_their_new_shard(self):
+        # Given readings sharded across 4 files
+        self.ingest()
+        before = {
+            device_uuid: shard_bind(device_uuid)
+            for device_uuid in self.devices
+        }
+        summary = json.loads(self.client.get('/devices/readings').data)
+
+        # When the shard count grows and we rebalance
+        self.app.config['SHARD_COUNT'] = 5
+        moved = rebalance_shards(4)
+
+        # Then only the devices whose shard changed should have moved
+        changed = [
+            device_uuid
+            for device_uuid in self.devices
+            if shard_bind(device_uuid) != before[device_uuid]
+        ]
+        self.assertEqual(moved, len(changed))
+        for device_uuid in changed:
+            self.assertEqual(shard_bind(device_uuid), 'shard_4')
+            self.assertNotIn(
+                device_uuid, self.device_counts(before[device_uuid])
+            )
+
+        # And the summary, histograms included, should be unchanged
+        request = self.client.get('/devices/readings')
+        self.assertEqual(json.loads(request.data), summary)
+        request = self.client.get('/devices/readings?type=temperature')
+        self.assertEqual(json.loads(request.data), summary)
+
+    def test_rebalance_moves_cold_segments(self):
+        # Given a past day of readings compacted to cold segments
+        day = 86400 * 20000
+        self.app.config.update(
+            PARTITION_SECONDS=86400,
+            COLD_AFTER_SECONDS=86400,
+            COLD_SEGMENT_DIRECTORY=os.path.join(
+                self.directory.name, 'segments'
+            ),
+        )
+        self.app.extensions.pop('metric_cache')
+        request = self.client.post(
+            '/devices/readings/batch',
+            data=json.dumps(
+                [
+                    {
+                        'device_uuid': device_uuid,
+                        'type': 'pressure',
+                        'value': value,
+                        'date_created': day + value * 97,
+                    }
+                    for index, device_uuid in enumerate(self.devices)
+                    for value in range(1, index + 120)
+                ]
+            ),
+        )
+        self.assertEqual(request.status_code, 201)
+
+        for shard in range(4):
+            with use_shard(f'shard_{shard}'):
+                compact_cold_partitions(now=day + 2 * 86400)
+
+        paths = [
+            f'/devices/{device_uuid}/readings/{metric}'
+            f'?type=pressure&start={day + 90}&end={day + 9000}'
+            for device_uuid in self.devices
+            for metric in ('mean', 'median', 'top')
+        ]
+        before = [json.loads(self.client.get(path).data) for path in paths]
+
+        # When the shard count grows and we rebalance
+        self.app.config['SHARD_COUNT'] = 5
+        self.assertGreater(rebalance_shards(4), 0)
+
+        # Then the metrics of the moved devices should be unchanged, from
+        # their rollups and cold readings
+        after = [json.loads(self.client.get(path).data) for path in paths]
+        self.assertEqual(after, before)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.directory.cleanup()
@@ -0,0 +1,84 @@
+import bisect
+import random
+import unittest
+
+from api import create_app, db
+from api.helpers import get_summary_positions
+from api.ingest import insert_readings
+from api.sketches import QuantileSketch, merged_sketch
+
+
+class SketchesTestCase(unittest.TestCase):
+    def setUp(self):
+        # Define test variables and initialize app
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.device_uuid = 'test_device'
+
+        # Setup the SQLite DB
+        db.drop_all()
+        db.create_all()
+
+    def assertRankError(self, sketch, values, max_error):
+        # Every estimate should sit within max_error * n ranks of the
+        # position it was asked for
+        sorted_values = sorted(values)
+        positions = set()
+        for group in get_summary_positions(len(values)):
+            positions.update(group)
+
+        for position, value in sketch.get_values_at(positions).items():
+            low = bisect.bisect_left(sorted_values, value)
+            high = bisect.bisect_right(sorted_values, value) - 1
+            error = max(low - position, position - high, 0)
+            self.assertLessEqual(error, max_error * len(values))
+
+    def test_sketch_serialization(self):
+        # Given a sketch that has compacted several levels
+        sketch = QuantileSketch()
+        for value in range(5000):
+            sketch.update(value)
+
+        # When we serialize and load it back
+        loaded = QuantileSketch.from_bytes(sketch.to_bytes())
+
+        # Then it should hold the same levels in a compact form
+        self.assertEqual(loaded.count, 5000)
+        self.assertEqual(loaded.levels, sketch.levels)
+        self.assertLess(len(sketch.to_bytes()), 8 * 1000)
+
+    def test_merged_sketches_error_bound(self):
+        # Given readings of an unrestricted type spread over a day
+        generator = random.Random(99)
+        rows = [
+            {
+                'device_uuid': self.device_uuid,
+                'type': 'pressure',
+                'value': int(generator.gauss(1000, 250)),
+                'date_created': generator.randint(0, 24 * 3600),
+            }
+            for _ in range(20000)
+        ]
+        insert_readings(rows)
+
+        # When we merge the sketches over ranges of the day
+        for start, end in ((None, None), (1800, 20 * 3600 + 5)):
+            sketch = merged_sketch(self.device_uuid, 'pressure', start, end)
+            values = [
+                row['value']
+                for row in rows
+                if (start is None or row['date_created'] >= start)
+                and (end is None or row['date_created'] <= end)
+            ]
+
+            # Then the count should be exact
+            self.assertEqual(sketch.count, len(values))
+
+            # And the median and quartiles within the documented rank error
+            self.assertRankError(sketch, values, 0.0165)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
@@ -0,0 +1,84 @@
+import json
+import random
+import unittest
+
+from api import create_app, db
+from api.helpers import get_median, get_quartiles
+from api.queries import summarize_devices, summary_query
+
+
+def expected_summary(values):
+    # The statistics of the list based helpers
+    count = len(values)
+    return (
+        count,
+        max(values, default=None),
+        sum(values) / count if count else None,
+        get_median(values),
+        get_quartiles(values),
+    )
+
+
+class SummarizeDevicesTestCase(unittest.TestCase):
+    def setUp(self):
+        # Define test variables and initialize app
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+
+        # Setup the SQLite DB
+        db.drop_all()
+        db.create_all()
+
+        # Devices with fewer and more readings than a chunk
+        generator = random.Random(27)
+        self.values = {
+            f'device_{device}': [
+                generator.randint(1, 1000) for _ in range(size)
+            ]
+            for device, size in enumerate((1, 2, 3, 9, 30, 4, 25, 1))
+        }
+        # Values whose sum overflows 64 bits
+        self.values['device_8'] = [2**62, 2**62 + 1, 2**62 + 3]
+        readings = [
+            {
+                'device_uuid': device_uuid,
+                'type': 'pressure',
+                'value': value,
+                'date_created': 1000 + index,
+            }
+            for device_uuid, values in self.values.items()
+            for index, value in enumerate(values)
+        ]
+        request = self.client.post(
+            '/devices/readings/batch', data=json.dumps(readings)
+        )
+        self.assertEqual(request.status_code, 201)
+
+    def test_devices_spanning_chunks(self):
+        for chunk_size in (1, 2, 7, 10, 1000):
+            # When we summarize the devices a few rows at a time
+            with self.subTest(chunk_size=chunk_size):
+                summaries = list(
+                    summarize_devices(
+                        summary_query('pressure'), chunk_size=chunk_size
+                    )
+                )
+
+                # Then each device should be summarized once, from all of
+                # its values
+                self.assertEqual(
+                    [summary[0] for summary in summaries],
+                    sorted(self.values),
+                )
+                for device_uuid, *summary in summaries:
+                    self.assertEqual(
+                        repr(tuple(summary)),
+                        repr(expected_summary(self.values[device_uuid])),
+                    )
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
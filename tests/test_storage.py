@@ -0,0 +1,115 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from api import create_app, db
+from api.config import ProductionConfig
+
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        # Define test variables and initialize app with the production
+        # storage profile on a scratch database
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = create_app('testing')
+        self.app.config.update(
+            SQLALCHEMY_DATABASE_URI='sqlite:///'
+            + os.path.join(self.directory.name, 'storage.db'),
+            SQLITE_PRAGMAS=ProductionConfig.SQLITE_PRAGMAS,
+            SQLITE_SINGLE_WRITER=True,
+            SQLITE_READ_POOL_SIZE=4,
+        )
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        self.device_uuid = 'test_device'
+
+        # Setup the SQLite DB
+        db.create_all()
+
+    def pragma(self, engine, name):
+        with engine.connect() as connection:
+            return connection.execute(f'PRAGMA {name}').scalar()
+
+    def test_pragmas_applied(self):
+        # Given the production storage profile
+        writer = db.get_engine(self.app)
+        reader = db.get_reader(self.app)
+
+        # Then the writer should run in WAL mode with the tuned pragmas
+        self.assertEqual(self.pragma(writer, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(writer, 'synchronous'), 1)
+        self.assertEqual(self.pragma(writer, 'busy_timeout'), 5000)
+        self.assertEqual(writer.pool.size(), 1)
+
+        # And the reader connections should be read only
+        self.assertEqual(self.pragma(reader, 'query_only'), 1)
+        self.assertEqual(self.pragma(reader, 'cache_size'), -65536)
+
+    def test_get_requests_use_reader(self):
+        # Given a GET request
+        with self.app.test_request_context('/devices/readings'):
+            # Then the session should read through the read-only pool
+            bind = db.session.get_bind()
+            self.assertIs(bind, db.get_reader(self.app))
+
+        # And given a POST request
+        with self.app.test_request_context('/', method='POST'):
+            # Then the session should use the writer
+            self.assertIs(db.session.get_bind(), db.get_engine(self.app))
+
+    def test_concurrent_readers_and_writers(self):
+        # Given writers ingesting batches while readers run summaries
+        errors = []
+
+        def write(worker):
+            for batch in range(20):
+                request = self.client.post(
+                    f'/devices/{self.device_uuid}_{worker}/readings/batch',
+                    data=json.dumps(
+                        [
+                            {'type': 'temperature', 'value': value}
+                            for value in range(1, 51)
+                        ]
+                    ),
+                )
+                if request.status_code != 201:
+                    errors.append(request.data)
+
+        def read():
+            deadline = time.monotonic() + 2
+            while time.monotonic() < deadline:
+                request = self.client.get('/devices/readings')
+                if request.status_code != 200:
+                    errors.append(request.data)
+
+        threads = [
+            threading.Thread(target=write, args=(worker,))
+            for worker in range(4)
+        ]
+        threads += [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        # Then no request should have failed with database is locked
+        self.assertEqual(errors, [])
+
+        # And every reading should have been written
+        request = self.client.get('/devices/readings')
+        counts = [
+            summary['number_of_readings']
+            for summary in json.loads(request.data)
+        ]
+        self.assertEqual(counts, [1000] * 4)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.directory.cleanup()